@@ -1,9 +1,32 @@
-from flask import Flask, render_template, redirect, url_for, request, session
+from flask import Flask, render_template, redirect, url_for, request, session, Response, send_from_directory
 import subprocess
+import time
 from utils import get_all_containers_details
 import os
-from utils import get_global_limits, save_global_limits, get_all_requests, delete_request, provision_container, get_available_resources
-from app import create_container, get_user_container_details
+from utils import get_global_limits, save_global_limits, get_all_requests, delete_request, request_key, parse_disk_size_gb, get_available_resources, render_prometheus_metrics
+from utils import get_hibernated, hibernate_container, resume_container, forget_hibernated, fast_restart_container, release_cpuset
+from utils import IO_LIMIT_FIELDS, apply_io_profile, resize_user_disk
+from package_cache import get_package_cache_usage, purge_package_cache, refresh_package_cache, remove_package_cache_volumes
+from mounts import unmount, get_mounted_volumes
+from recovery import recover_host, get_last_recovery
+from storage_usage import get_all_storage_usage
+from ssh_gateway import remove_routes
+from health import get_health, forget_health, render_health_metrics
+from rebalancer import get_rebalance_state, render_rebalance_metrics
+from yarn_metrics import get_weekly_peaks, get_yarn_overview, render_yarn_metrics
+from lifecycle_trace import record_event
+from usage import QUOTA_WINDOW_HOURS, forget_usage, get_all_usage, get_quotas, reset_usage, render_usage_metrics
+from snapshots import (create_snapshot, get_backup_usage, get_jobs, list_snapshots, restore_snapshot,
+                       retain_before_delete)
+from leases import (decide_renewal, describe_lease, end_lease, forget_leases, get_leases, grant_lease,
+                    parse_lease_form, provision_approved)
+from migration import (ARCHIVE_EXT, EXPORTS_DIR, delete_export, export_environment, import_environment, list_exports,
+                       prune_exports)
+from shared_cluster import release_tenants, delete_tenant_data, ensure_shared_cluster, get_cluster_overview
+from utils import set_desired_state
+import threading
+from datasets import get_datasets, add_dataset, remove_dataset, refresh_dataset_sizes, DATASETS_DIR, DATASETS_MOUNT
+from app import create_container
 import fcntl
 
 app = Flask(__name__)
@@ -48,7 +71,18 @@ def admin():
     """Displays the admin monitoring page."""
     all_containers = get_all_containers_details()
     resources = get_available_resources()
-    return render_template('monitoring.html', containers=all_containers, **resources)
+    hibernated = get_hibernated()
+    io_profiles = get_global_limits()['io_profiles']
+    return render_template('monitoring.html', containers=all_containers, hibernated=hibernated, io_profiles=io_profiles,
+                           recovery=get_last_recovery(), health=get_health(), rebalance=get_rebalance_state(),
+                           **resources)
+
+# Prometheus scrape target (no login so the scraper can reach it)
+@app.route('/metrics')
+def metrics():
+    """Exposes host capacity and tenancy metrics from the cached snapshot."""
+    return Response(render_prometheus_metrics() + render_health_metrics() + render_usage_metrics()
+                    + render_rebalance_metrics() + render_yarn_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/stop/<container_id>', methods=['POST'])
 @login_required
@@ -56,22 +90,77 @@ def stop_container(container_id):
     """Stops a specific container."""
     if container_id:
         subprocess.run(["docker", "stop", container_id], check=True)
+        username = get_container_owner(container_id)
+        if username:
+            set_desired_state(username, 'stopped')
     return redirect(url_for('admin')) # Redirect back to the monitoring page
 
+def get_container_owner(container_id):
+    """Maps a container ID to the username it was provisioned for (None if not a user container)."""
+    for c in get_all_containers_details():
+        if c['ID'].startswith(container_id) and c['Names'].endswith('_container'):
+            return c['Names'][:-len('_container')]
+    return None
+
 @app.route('/start/<container_id>', methods=['POST'])
 @login_required
 def start_container(container_id):
     """Starts a specific container."""
     if container_id:
-        subprocess.run(["docker", "start", container_id], check=True)
+        username = get_container_owner(container_id)
+        if username and username in get_hibernated():
+            success, msg = resume_container(username)
+            if not success:
+                return f"Error resuming container: {msg}", 500
+        elif username:
+            success, msg = fast_restart_container(username)
+            if not success:
+                return f"Error restarting container: {msg}", 500
+        else:
+            subprocess.run(["docker", "start", container_id], check=True)
     return redirect(url_for('admin')) # Redirect back to the monitoring page
 
+@app.route('/io_profile/<container_id>', methods=['POST'])
+@login_required
+def change_io_profile(container_id):
+    """Applies a different I/O profile to a running container without restarting it."""
+    username = get_container_owner(container_id)
+    if not username:
+        return "Only user containers have I/O profiles.", 400
+    success, msg = apply_io_profile(username, request.form.get('io_profile', 'standard'))
+    if not success:
+        return f"Error changing I/O profile: {msg}", 500
+    return redirect(url_for('admin'))
+
+@app.route('/hibernate/<container_id>', methods=['POST'])
+@login_required
+def hibernate(container_id):
+    """Checkpoints (or stops with a service manifest) a user container to free its RAM."""
+    username = get_container_owner(container_id)
+    if not username:
+        return "Only user containers can be hibernated.", 400
+    success, msg = hibernate_container(username)
+    if not success:
+        return f"Error hibernating container: {msg}", 500
+    return redirect(url_for('admin'))
+
 @app.route('/delete/<container_id>', methods=['POST'])
 @login_required
 def delete_container(container_id):
     """Starts a specific container."""
     if container_id:
+        username = get_container_owner(container_id)
         subprocess.run(["docker", "rm", container_id], check=True)
+        if username:
+            set_desired_state(username, None)
+            forget_hibernated(username)
+            release_cpuset(username)
+            release_tenants([username])
+            remove_routes([username])
+            remove_package_cache_volumes([username])
+            forget_health([f"{username}_container"])
+            forget_usage([username])
+            forget_leases([username])
     return redirect(url_for('admin')) # Redirect back to the monitoring page
 
 # In admin.py
@@ -85,6 +174,7 @@ def delete_all_containers():
     containers = get_all_containers_details()
     
     count = 0
+    deleted = []
     for c in containers:
         # Safety Check: Only delete containers created by our app
         # (We assume they all end in "_container" based on your provision logic)
@@ -94,13 +184,32 @@ def delete_all_containers():
             try:
                 # Docker remove with -f (Force) kills it even if running
                 subprocess.run(["docker", "rm", "-f", c['ID']], check=False)
+                set_desired_state(name[:-len('_container')], None)
+                forget_hibernated(name[:-len('_container')])
+                release_cpuset(name[:-len('_container')])
+                deleted.append(name[:-len('_container')])
                 count += 1
             except Exception as e:
                 print(f"Failed to delete {name}: {e}")
 
+    # One queue refresh for all of them
+    release_tenants(deleted)
+    remove_routes(deleted)
+    remove_package_cache_volumes(deleted)
+    forget_health([f"{u}_container" for u in deleted])
+    forget_usage(deleted)
+    forget_leases(deleted)
     print(f"Admin deleted {count} containers.")
     return redirect(url_for('admin'))
     
+@app.route('/recover', methods=['POST'])
+@login_required
+def recover():
+    """Runs host recovery (remount volumes, restart intended-running containers) in the background."""
+    if get_last_recovery().get('status') != 'in_progress':
+        threading.Thread(target=recover_host, daemon=True).start()
+    return redirect(url_for('admin'))
+
 @app.route('/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
@@ -108,60 +217,84 @@ def settings():
         cpu = request.form.get('max_cpu')
         mem = request.form.get('max_memory_gb')
         ram = request.form.get('max_ram_gb')
-        save_global_limits(cpu, mem, ram)
+        io_profiles = {}
+        for name in get_global_limits()['io_profiles']:
+            io_profiles[name] = {
+                field: float(request.form.get(f"io_{name}_{field}") or 0)
+                for field in IO_LIMIT_FIELDS
+            }
+        save_global_limits(cpu, mem, ram, io_profiles, request.form.get('pin_threshold_cpus'),
+                           request.form.get('package_cache_enabled') == 'on',
+                           request.form.get('shared_cluster_enabled') == 'on',
+                           request.form.get('shared_cluster_cpus'), request.form.get('shared_cluster_ram_gb'),
+                           request.form.get('quota_cpu_hours_week'), request.form.get('quota_ram_gb_hours_week'),
+                           request.form.get('quota_action'), request.form.get('lease_default_hours'),
+                           request.form.get('lease_expiry_action'),
+                           request.form.get('rebalance_enabled') == 'on',
+                           request.form.get('rebalance_min_fraction'), request.form.get('rebalance_max_factor'))
         return redirect(url_for('admin'))
     # Load current settings to fill the form
     current_limits = get_global_limits()
-    return render_template('admin_setting.html', limits=current_limits)
+    return render_template('admin_setting.html', limits=current_limits, io_fields=IO_LIMIT_FIELDS)
 
 @app.route('/requests')
 @login_required
 def admin_requests():
     requests = get_all_requests()
-    return render_template('admin_request.html', requests=requests)
+    leases = {u: describe_lease(l) for u, l in get_leases().items()}
+    return render_template('admin_request.html', requests=requests, leases=leases,
+                           limits=get_global_limits())
 
 @app.route('/approve/<username>', methods=['POST'])
 @login_required
 def approve_request(username):
     requests = get_all_requests()
-    if username in requests:
-        req = requests[username]
-        lock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'request.lock')
-        with open(lock_path, 'w') as lockfile:
-            fcntl.flock(lockfile, fcntl.LOCK_EX)
-            # Check if user already has a container (atomic)
-            existing_container = get_user_container_details(username)
-            if existing_container:
-                fcntl.flock(lockfile, fcntl.LOCK_UN)
-                return f"User '{username}' already has an active container. A user can only have one container at a time.", 400
-            available = get_available_resources()
-            ram_str = req['ram_gb']  # Already in format like "4g"
-            cpus_requested = float(req['cpu'])
-            ram_requested = int(ram_str.lower().replace("g", ""))
-            memory_requested = req['memory_gb']
-            if cpus_requested > available['cores_available']:
+    request_type = request.form.get('type') or None
+    key = request_key(username, request_type)
+    if key in requests:
+        req = requests[key]
+        if req.get('type') == 'disk_resize':
+            lock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'request.lock')
+            with open(lock_path, 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                success, msg = resize_user_disk(username, req['memory_gb'])
                 fcntl.flock(lockfile, fcntl.LOCK_UN)
-                return f"Insufficient CPU resources. Requested: {cpus_requested}, Available: {available['cores_available']}", 400
-            if ram_requested > available['ram_available_gb']:
-                fcntl.flock(lockfile, fcntl.LOCK_UN)
-                return f"Insufficient RAM. Requested: {ram_requested}GB, Available: {available['ram_available_gb']}GB", 400
-            if memory_requested > available['host_free_disk_gb']:
-                fcntl.flock(lockfile, fcntl.LOCK_UN)
-                return f"Insufficient disk space. Requested: {memory_requested}GB, Available: {available['host_free_disk_gb']}GB", 400
-            # Resources are available, proceed with provisioning
-            success, msg = provision_container(username, req['cpu'], req['memory_gb'], req['ram_gb'])
-            fcntl.flock(lockfile, fcntl.LOCK_UN)
-        if success:
-            delete_request(username) # Remove from pending list
+            if not success:
+                return f"Error resizing disk: {msg}", 400
+            delete_request(username, 'disk_resize')
+            return redirect(url_for('admin_requests'))
+        # Super user containers are leased, optionally from a later start time
+        try:
+            starts_at, lease_hours = parse_lease_form(request.form.get('starts_at'), request.form.get('lease_hours'))
+        except ValueError as e:
+            return str(e), 400
+        if not starts_at or starts_at <= time.time():
+            success, msg, status = provision_approved(username, req)
+            if not success:
+                return msg, status
             print(f"Approved and created container for {username}")
-        else:
-            return f"Error creating container: {msg}", 500
+        lease = grant_lease(username, req, lease_hours, starts_at, request.form.get('on_expiry'))
+        record_event('approve', username, hours=(lease['expires_at'] - lease['starts_at']) / 3600,
+                     starts_at=lease['starts_at'])
+        delete_request(username) # Remove from pending list
+    return redirect(url_for('admin_requests'))
+
+@app.route('/lease/<username>/<action>', methods=['POST'])
+@login_required
+def lease_action(username, action):
+    if action == 'renew':
+        decide_renewal(username, approve=True)
+    elif action == 'deny':
+        decide_renewal(username, approve=False)
+    elif action == 'end':
+        end_lease(username)
     return redirect(url_for('admin_requests'))
 
 @app.route('/reject/<username>', methods=['POST'])
 @login_required
 def reject_request(username):
-    delete_request(username)
+    delete_request(username, request.form.get('type') or None)
+    record_event('deny', username)
     return redirect(url_for('admin_requests'))
 
 @app.route('/delete_user_data/<username>', methods=['POST'])
@@ -175,12 +308,16 @@ def delete_user_data(username):
     user_folder = os.path.join(user_data_dir, username)
     user_img = os.path.join(user_data_dir, f"{username}.img")
 
-    # Remove user folder (with SSH keys, hdfs, etc)
+    # Remove user folder (with SSH keys, hdfs, etc), never while the image is still mounted on it
     if os.path.exists(user_folder) and os.path.isdir(user_folder):
+        unmounted, msg = unmount(user_folder, user_img)
+        if not unmounted:
+            return f"Error deleting storage: {msg}", 409
         shutil.rmtree(user_folder)
-    # Remove user .img file
+    # Remove user .img file (kept until its last snapshot is taken)
     if os.path.exists(user_img):
-        os.remove(user_img)
+        retain_before_delete(username, user_img)
+    delete_tenant_data(username)
     return redirect(url_for('admin'))
 
 @app.route('/storage')
@@ -195,19 +332,69 @@ def storage():
         if c['Names'].endswith('_container'):
             users_with_container.add(c['Names'][:-10])
     users = []
+    mounted = get_mounted_volumes()
     for fname in os.listdir(user_data_dir):
         if fname.endswith('.img'):
             username = fname[:-4]
             img_path = os.path.join(user_data_dir, fname)
             size_gb = os.path.getsize(img_path) / (1024**3)
-            is_mounted = username in users_with_container
+            # Disabled delete while a container still uses it or the image is mounted
+            is_mounted = username in users_with_container or os.path.realpath(
+                os.path.join(user_data_dir, username)) in mounted
             users.append({
                 'username': username,
                 'img': fname,
                 'size_gb': f"{size_gb:.2f}",
                 'mounted': is_mounted
             })
-    return render_template('storage.html', users=users)
+    usage = get_all_storage_usage([u['username'] for u in users], refresh=bool(request.args.get('refresh')))
+    for u in users:
+        u['usage'] = usage.get(u['username'])
+    # Shared by every container, so counted once here rather than per user
+    package_cache = [{'name': name, 'size_gb': f"{size / (1024**3):.2f}"}
+                     for name, size in get_package_cache_usage().items()]
+    datasets_gb = sum(d.get('size_bytes', 0) for d in get_datasets().values()) / (1024**3)
+    return render_template('storage.html', users=users, package_cache=package_cache,
+                           datasets_gb=f"{datasets_gb:.2f}")
+
+@app.route('/resize_disk', methods=['POST'])
+@login_required
+def resize_disk():
+    username = request.form.get('username')
+    new_size_gb = request.form.get('new_size_gb')
+    if not username or not new_size_gb:
+        return "Missing required fields", 400
+    new_size_gb = parse_disk_size_gb(new_size_gb)
+    if new_size_gb is None:
+        return "Disk size must be a positive number of GB", 400
+    lock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'request.lock')
+    with open(lock_path, 'w') as lockfile:
+        # Same admission lock as provisioning, both draw from host_free_disk_gb
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        success, msg = resize_user_disk(username, new_size_gb)
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+    if not success:
+        return f"Error resizing disk: {msg}", 400
+    return redirect(url_for('storage'))
+
+@app.route('/purge_package_cache', methods=['POST'])
+@login_required
+def purge_cache():
+    try:
+        purge_package_cache(request.form.get('cache'))
+    except ValueError as e:
+        print(e)
+    return redirect(url_for('storage'))
+
+@app.route('/refresh_package_cache', methods=['POST'])
+@login_required
+def refresh_cache():
+    pip_packages = request.form.get('pip_packages', '').split()
+
+    def refresh():
+        print(f"Package cache refresh: {refresh_package_cache(pip_packages)[1]}")
+    threading.Thread(target=refresh, daemon=True).start()
+    return redirect(url_for('storage'))
 
 @app.route('/delete_user_data', methods=['POST'])
 @login_required
@@ -219,16 +406,154 @@ def delete_user_data_form():
         user_data_dir = os.path.join(base_dir, 'user_data')
         user_folder = os.path.join(user_data_dir, username)
         user_img = os.path.join(user_data_dir, f"{username}.img")
-        # Try to unmount before deleting (ignore errors)
+        # Unmount (and detach the loop device) before deleting; a busy volume is left alone
         if os.path.exists(user_folder) and os.path.isdir(user_folder):
-            try:
-                subprocess.run(["sudo", "umount", "-l", user_folder], check=False)
-            except Exception:
-                pass
+            unmounted, msg = unmount(user_folder, user_img)
+            if not unmounted:
+                return f"Error deleting storage: {msg}", 409
             shutil.rmtree(user_folder)
         if os.path.exists(user_img):
-            os.remove(user_img)
+            retain_before_delete(username, user_img)
+            record_event('disk_delete', username)
+        delete_tenant_data(username)
     return redirect(url_for('storage'))
 
+@app.route('/jobs')
+@login_required
+def jobs():
+    overview = get_yarn_overview(max_age=0 if request.args.get('refresh') else 30)
+    allocated = {c['Names'][:-len('_container')]: c['GrantedCPUs'] for c in get_all_containers_details()
+                 if c['Names'].endswith('_container')}
+    return render_template('admin_jobs.html', overview=overview, peaks=get_weekly_peaks(), allocated=allocated,
+                           max_cpu=get_global_limits()['max_cpu'])
+
+@app.route('/usage')
+@login_required
+def usage_report():
+    return render_template('admin_usage.html', usage=get_all_usage(), quotas=get_quotas(),
+                           window_days=QUOTA_WINDOW_HOURS // 24)
+
+@app.route('/usage/reset/<username>', methods=['POST'])
+@login_required
+def usage_reset(username):
+    reset_usage(username)
+    return redirect(url_for('usage_report'))
+
+@app.route('/backups')
+@login_required
+def backups():
+    return render_template('admin_backups.html', snapshots=list_snapshots(), usage=get_backup_usage(),
+                           jobs=get_jobs(), exports=list_exports(), message=request.args.get('message'))
+
+@app.route('/backups/snapshot', methods=['POST'])
+@login_required
+def snapshot_now():
+    username = request.form.get('username')
+    if username:
+        # Throttled reads take minutes for a large image, the job list shows the result
+        threading.Thread(target=create_snapshot, args=(username,), kwargs={'reason': 'manual'}, daemon=True).start()
+    return redirect(url_for('backups', message=f"Snapshot of {username} started"))
+
+@app.route('/backups/restore', methods=['POST'])
+@login_required
+def restore_backup():
+    username = request.form.get('username')
+    snapshot_id = request.form.get('snapshot_id')
+
+    def restore():
+        try:
+            print(f"Restored {username}/{snapshot_id} to {restore_snapshot(username, snapshot_id)}")
+        except Exception as e:
+            print(f"Restore of {username}/{snapshot_id} failed: {e}")
+    threading.Thread(target=restore, daemon=True).start()
+    return redirect(url_for('backups', message=f"Restore of {username}/{snapshot_id} started"))
+
+@app.route('/migration/export', methods=['POST'])
+@login_required
+def migration_export():
+    username = request.form.get('username')
+    base_id = request.form.get('base_id') or None
+    stop = bool(request.form.get('stop'))
+
+    def export():
+        try:
+            export_environment(username, base_id=base_id, stop=stop)
+        except Exception as e:
+            print(f"Export of {username} failed: {e}")
+    threading.Thread(target=export, daemon=True).start()
+    return redirect(url_for('backups', message=f"Export of {username} started"))
+
+@app.route('/migration/import', methods=['POST'])
+@login_required
+def migration_import():
+    source = request.form.get('source', '').strip()
+    start = not request.form.get('no_start')
+
+    def run_import():
+        try:
+            print(f"Import of {source}: {import_environment(source, start=start)[1]}")
+        except Exception as e:
+            print(f"Import of {source} failed: {e}")
+    threading.Thread(target=run_import, daemon=True).start()
+    return redirect(url_for('backups', message=f"Import of {source} started"))
+
+@app.route('/exports/<path:name>')
+def download_export(name):
+    # No login: the target host fetches it, the random part of the name is the credential.
+    # Range requests are honoured, so an interrupted transfer resumes where it stopped.
+    if not name.endswith((ARCHIVE_EXT, ARCHIVE_EXT + '.sha256')):
+        return "Not found", 404
+    prune_exports()
+    return send_from_directory(EXPORTS_DIR, name, conditional=True)
+
+@app.route('/exports/<path:name>', methods=['DELETE'])
+def remove_export(name):
+    # Sent by the target after a successful import; knowing the name is the credential here too
+    if not name.endswith(ARCHIVE_EXT) or '/' in name or not os.path.exists(os.path.join(EXPORTS_DIR, name)):
+        return "Not found", 404
+    delete_export(name)
+    return "", 204
+
+@app.route('/shared_cluster')
+@login_required
+def shared_cluster():
+    overview = get_cluster_overview()
+    usage = get_all_storage_usage(list(overview['tenants']))
+    return render_template('admin_shared_cluster.html', cluster=overview, usage=usage,
+                           enabled=get_global_limits()['shared_cluster_enabled'], error=request.args.get('error'))
+
+@app.route('/shared_cluster/start', methods=['POST'])
+@login_required
+def start_shared_cluster():
+    try:
+        ensure_shared_cluster()
+    except (RuntimeError, subprocess.CalledProcessError) as e:
+        return redirect(url_for('shared_cluster', error=str(e)))
+    return redirect(url_for('shared_cluster'))
+
+@app.route('/datasets', methods=['GET', 'POST'])
+@login_required
+def datasets():
+    error = None
+    if request.method == 'POST':
+        try:
+            add_dataset(request.form.get('name', '').strip(),
+                        request.form.get('description', '').strip(),
+                        request.form.get('source_path', '').strip() or None)
+            return redirect(url_for('datasets'))
+        except (ValueError, subprocess.CalledProcessError) as e:
+            error = str(e)
+    catalog = refresh_dataset_sizes() if request.args.get('refresh') else get_datasets()
+    total_gb = sum(d.get('size_bytes', 0) for d in catalog.values()) / (1024**3)
+    return render_template('admin_datasets.html', datasets=catalog, error=error,
+                           datasets_dir=DATASETS_DIR, datasets_mount=DATASETS_MOUNT,
+                           total_gb=f"{total_gb:.2f}")
+
+@app.route('/datasets/delete/<name>', methods=['POST'])
+@login_required
+def delete_dataset(name):
+    remove_dataset(name)
+    return redirect(url_for('datasets'))
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=7000)
@@ -8,15 +8,32 @@ import json
 import shutil
 from werkzeug.security import generate_password_hash, check_password_hash
 import fcntl
+import threading
 
 
 # Import our custom helper functions from utils.py
-from utils import get_available_resources, parse_memory_to_mb, get_all_containers_details, extract_host_port, get_global_limits, generate_user_keys, provision_container, save_resource_request, get_all_requests
+from utils import get_available_resources, parse_memory_to_mb, get_all_containers_details, get_global_limits, generate_user_keys, provision_container, save_resource_request, get_all_requests
+from utils import save_disk_resize_request, parse_disk_size_gb, set_desired_state, load_users, USERS_FILE
+from utils import get_hibernated, hibernate_container, resume_container, forget_hibernated, fast_restart_container, release_cpuset
+from datasets import get_datasets, DATASETS_MOUNT
+from hadoop_config import minimum_ram_gb
+from mounts import mount_image, unmount
+from recovery import recover_host
+from storage_usage import get_storage_usage
+from shared_cluster import host_footprint, release_tenants, delete_tenant_data
+from ssh_gateway import SSH_GATEWAY_PORT, remove_routes
+from package_cache import remove_package_cache_volumes
+from health import get_health, forget_health, start_watchdog
+from snapshots import retain_before_delete, start_backup_scheduler
+from usage import check_quota, forget_usage, get_user_usage, start_usage_accounting
+from rebalancer import start_rebalancer
+from yarn_metrics import start_yarn_collector
+from lifecycle_trace import record_event, record_host
+from leases import forget_leases, get_user_lease, request_renewal, start_lease_manager
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 app.config['SESSION_COOKIE_NAME'] = 'user_session'
-USERS_FILE = "users.json"
 
 # Function to help to find if user has a container
 def get_user_container_details(username):
@@ -30,15 +47,6 @@ def get_user_container_details(username):
             return container
     return None
 # ===========================register & login function===========================
-def load_users():
-    if not os.path.exists(USERS_FILE):
-        return {}
-    try:
-        with open(USERS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {}
-
 def save_new_user(username, password):
     users = load_users()
     if username in users:
@@ -119,6 +127,8 @@ def dashboard():
     max_cpu = limits['max_cpu']
     max_mem_gb = limits['max_memory_gb']
     max_ram_gb = limits['max_ram_gb']
+    # A shared-cluster client runs no daemons of its own, so only HDFS and YARN set a floor
+    min_ram_gb = 1 if limits['shared_cluster_enabled'] else minimum_ram_gb()
 
     ssh_port = "N/A"
     if existing_container and 'Ports' in existing_container:
@@ -134,6 +144,9 @@ def dashboard():
                     ssh_port = host_side.split(':')[-1]
                 except:
                     ssh_port = "Unknown"
+        # Containers without a published port are reached through the SSH gateway
+        if ssh_port == "N/A":
+            ssh_port = SSH_GATEWAY_PORT
 
     # Get server stats for the form (if they need to create one)
     resources = get_available_resources()
@@ -164,9 +177,18 @@ def dashboard():
         max_cpu=max_cpu,
         max_mem_gb=max_mem_gb,
         max_ram_gb=max_ram_gb,
+        min_ram_gb=min_ram_gb,
         pending_request = user_request,
+        io_profiles=limits['io_profiles'],
+        datasets=get_datasets(),
+        storage_usage=get_storage_usage(username) if has_existing_disk else None,
+        datasets_mount=DATASETS_MOUNT,
         has_existing_disk = has_existing_disk,
         existing_disk_size=existing_disk_size,
+        hibernated=get_hibernated().get(username),
+        health=get_health().get(f"{username}_container"),
+        usage=get_user_usage(username),
+        lease=get_user_lease(username),
         **resources
     )
 
@@ -193,16 +215,9 @@ def setup_user_disk(username, size_gb=5):
         # Format the file as ext4 (like a USB drive)
         subprocess.run(["mkfs.ext4", disk_image], check=True)
 
-    # 3. Mount the disk image to the folder
-    # We check if it's already mounted to avoid errors
-    is_mounted = subprocess.run(f"mount | grep {user_folder}", shell=True, stdout=subprocess.PIPE).stdout
-    if not is_mounted:
-        # Requires sudo usually, but if you run python as root it works.
-        # If running as normal user, you might need to configure /etc/fstab or sudoers
-        subprocess.run(["sudo", "mount", "-o", "loop", disk_image, user_folder], check=True)
-        
-        # Fix permissions so the user can write to it
-        subprocess.run(["sudo", "chmod", "777", user_folder], check=True)
+    # 3. Mount the disk image to the folder (no-op if the mount index already has it)
+    # If running as normal user, you might need to configure /etc/fstab or sudoers
+    mount_image(disk_image, user_folder)
     
     return user_folder
 
@@ -218,6 +233,16 @@ def delete_disk():
         subprocess.run(["docker", "rm", "-f", container_name], check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except:
         pass # It's okay if container didn't exist
+    set_desired_state(username, None)
+    forget_hibernated(username)
+    release_cpuset(username)
+    remove_routes([username])
+    remove_package_cache_volumes([username])
+    forget_health([container_name])
+    forget_usage([username])
+    forget_leases([username])
+    # Shared-cluster users keep their HDFS data in the cluster, it goes with the disk
+    delete_tenant_data(username)
 
     # 2. Define Paths
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -226,13 +251,16 @@ def delete_disk():
 
     # 3. Unmount and Delete
     try:
-        # A. Unmount the folder (Important! Linux locks mounted files)
-        # We use lazy unmount (-l) just in case it's busy
-        subprocess.run(["sudo", "umount", "-l", user_folder], check=False)
+        # A. Unmount the folder and free its loop device (Important! Linux locks mounted files)
+        # Never delete while still mounted, rmtree would wipe the volume's contents instead
+        unmounted, msg = unmount(user_folder, disk_image)
+        if not unmounted:
+            return f"Error deleting volume: {msg}"
         
-        # B. Delete the .img file (The Data)
+        # B. Delete the .img file (The Data), after one last snapshot taken in the background
         if os.path.exists(disk_image):
-            os.remove(disk_image)
+            retain_before_delete(username, disk_image)
+            record_event('disk_delete', username)
             print(f"Deleted disk image for {username}")
             
         # C. Delete the folder mount point (Cleanup)
@@ -257,14 +285,22 @@ def create_container():
     except KeyError:
         memory = request.form['memory_new']
     print(memory)
+    record_event('request', username, cpu=float(cpus_str), ram=float(ram), disk=int(float(memory)), kind='standard')
+    allowed, msg = check_quota(username)
+    if not allowed:
+        record_event('reject', username, reason='quota')
+        return msg, 403
     # --- ATOMIC RESOURCE VALIDATION ---
     lock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'request.lock')
     with open(lock_path, 'w') as lockfile:
         fcntl.flock(lockfile, fcntl.LOCK_EX)
         available = get_available_resources()
         ram_str = f"{ram}g"
-        if float(cpus_str) > available['cores_available'] or int(ram) > available['ram_available_gb'] or int(float(memory)) > available['host_free_disk_gb']:
+        # In shared-cluster mode only the client container is placed on the host
+        cpus_needed, ram_needed = host_footprint(cpus_str, ram)
+        if cpus_needed > available['cores_available'] or ram_needed > available['ram_available_gb'] or int(float(memory)) > available['host_free_disk_gb']:
             fcntl.flock(lockfile, fcntl.LOCK_UN)
+            record_event('reject', username, reason='capacity')
             return "Insufficient Resources", 400
         success, msg = provision_container(username, cpus_str, memory, ram_str)
         fcntl.flock(lockfile, fcntl.LOCK_UN)
@@ -283,6 +319,7 @@ def request_special():
     ram = request.form.get('ram')
     memory_gb = request.form.get('memory')
     reason = request.form.get('reason')
+    io_profile = request.form.get('io_profile', 'standard')
     
     # Validate that all required fields are present
     if not cpus or not ram or not memory_gb or not reason:
@@ -293,11 +330,43 @@ def request_special():
     ram_str = f"{ram}g"
     
     # Save to JSON
-    save_resource_request(username, cpus, memory_gb, ram_str, reason)
+    save_resource_request(username, cpus, memory_gb, ram_str, reason, io_profile)
+    record_event('request', username, cpu=float(cpus), ram=float(ram), disk=int(float(memory_gb)), kind='special')
     
     # Redirect back to dashboard
     return redirect(url_for('dashboard'))
 
+@app.route('/request_resize', methods=['POST'])
+def request_resize():
+    if 'username' not in session: return redirect(url_for('login'))
+
+    username = session['username']
+    new_size_gb = request.form.get('new_size_gb')
+    reason = request.form.get('reason')
+    if not new_size_gb or not reason:
+        return "Missing required fields", 400
+    if parse_disk_size_gb(new_size_gb) is None:
+        return "Disk size must be a positive number of GB", 400
+
+    # Applied (with the free-disk admission check) when the admin approves
+    save_disk_resize_request(username, new_size_gb, reason)
+    return redirect(url_for('dashboard'))
+
+@app.route('/request_renewal', methods=['POST'])
+def request_lease_renewal():
+    if 'username' not in session: return redirect(url_for('login'))
+
+    username = session['username']
+    hours = request.form.get('hours')
+    reason = request.form.get('reason')
+    if not hours or not reason:
+        return "Missing required fields", 400
+
+    # The admin extends the lease from the requests page
+    if not request_renewal(username, hours, reason):
+        return "No active lease to renew", 400
+    return redirect(url_for('dashboard'))
+
 @app.route('/control/<action>', methods=['POST'])
 def control_container(action):
     if 'username' not in session: return redirect(url_for('login'))
@@ -306,13 +375,36 @@ def control_container(action):
 
     if action == "stop":
         subprocess.run(["docker", "stop", container_name])
+        set_desired_state(username, 'stopped')
+    elif action == "hibernate":
+        success, msg = hibernate_container(username)
+        if not success:
+            return f"Error: {msg}"
     elif action == "start":
-        setup_user_disk(username)
-        subprocess.run(["docker", "start", container_name])
+        allowed, msg = check_quota(username)
+        if not allowed:
+            return f"Error: {msg}", 403
+        if username in get_hibernated():
+            success, msg = resume_container(username)
+            if not success:
+                return f"Error: {msg}"
+        else:
+            success, msg = fast_restart_container(username)
+            if not success:
+                return f"Error: {msg}"
     elif action == "delete":
         # Force remove the container. 
         # Because we used -v (Volume), the data in 'user_data' folder remains safe!
         subprocess.run(["docker", "rm", "-f", container_name])
+        forget_hibernated(username)
+        release_cpuset(username)
+        release_tenants([username])
+        remove_routes([username])
+        remove_package_cache_volumes([username])
+        forget_health([container_name])
+        forget_usage([username])
+        forget_leases([username])
+        set_desired_state(username, None)
     
     return redirect(url_for('dashboard'))
 
@@ -330,4 +422,20 @@ def download_key():
         return "Key file not found. Please create a container first.", 404
 
 if __name__ == '__main__':
+    # Remount volumes and restart intended-running containers (after a host reboot) while serving
+    threading.Thread(target=recover_host, daemon=True).start()
+    # Restarts daemons that crash (often OOM) instead of leaving the environment broken
+    start_watchdog()
+    # Daily incremental snapshots of the disk images, throttled
+    start_backup_scheduler()
+    # Per-user CPU/RAM/disk ledger and the weekly quotas
+    start_usage_accounting()
+    # Starts scheduled super-user leases and scales expired ones back down
+    start_lease_manager()
+    # Lends idle containers' CPU quota to busy ones (when enabled in the global limits)
+    start_rebalancer()
+    # Hourly peaks of what users' YARN jobs actually hold, for the admin's job view
+    start_yarn_collector()
+    # Capacity the lifecycle trace was recorded on, for simulator.py
+    record_host()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,319 @@
+# Load-test harness for the user and admin portals, driven against fake_docker.FakeDockerEngine
+#
+#   python3 benchmark.py --users 20 --output bench.json
+#   python3 benchmark.py --users 20 --baseline bench.json   # compare against an earlier run
+#   python3 benchmark.py --startup --rounds 3   # JVM time-to-ready on the real engine and image
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_docker import FakeDockerEngine
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_PREFIX = 'benchuser'
+SUPER_PREFIX = 'benchsuper'
+PASSWORD = 'benchpass'
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies, errors, wall_time):
+    return {
+        'ops': len(latencies),
+        'errors': errors,
+        'throughput_ops_s': len(latencies) / wall_time if wall_time > 0 else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def run_phase(workers, jobs):
+    """Runs jobs (callables returning True on success) concurrently and times each one."""
+    latencies = []
+    errors = 0
+
+    def timed(job):
+        t0 = time.perf_counter()
+        try:
+            ok = job()
+        except Exception as e:
+            print(f"benchmark job failed: {e}", file=sys.__stderr__)
+            ok = False
+        return time.perf_counter() - t0, ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for elapsed, ok in pool.map(timed, jobs):
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def relocate_portal_state(workdir):
+    """Points the portal modules' checkout paths at workdir.
+
+    request.lock, user_data/, datasets/, package_cache/ etc. are built from each module's
+    __file__, at import time (BASE_DIR, USER_DATA_DIR, ...) or when used, so both the
+    module-level paths and __file__ itself are rewritten for every loaded portal module.
+    """
+    roots = {BASE_DIR, os.path.realpath(BASE_DIR)}
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, '__file__', None)
+        if not module_file or os.path.dirname(os.path.abspath(module_file)) not in roots:
+            continue
+        for attr, value in list(vars(module).items()):
+            if not isinstance(value, str):
+                continue
+            for root in roots:
+                if value == root or value.startswith(root + os.sep):
+                    setattr(module, attr, workdir + value[len(root):])
+                    break
+
+
+def run_benchmark(users, dashboard_loads, engine, workdir):
+    import app as user_portal
+    import admin as admin_portal
+    relocate_portal_state(workdir)
+    user_portal.app.config['TESTING'] = True
+    admin_portal.app.config['TESTING'] = True
+
+    names = [f"{USER_PREFIX}{i}" for i in range(users)]
+    supers = [f"{SUPER_PREFIX}{i}" for i in range(max(1, users // 4))]
+    for name in names + supers:
+        user_portal.save_new_user(name, PASSWORD)
+
+    clients = {name: user_portal.app.test_client() for name in names + supers}
+    results = {}
+
+    def login(name):
+        resp = clients[name].post('/', data={'username': name, 'password': PASSWORD})
+        return resp.status_code == 302
+
+    def dashboard(name):
+        return clients[name].get('/dashboard').status_code == 200
+
+    def provision(name):
+        resp = clients[name].post('/request', data={'cpus': '1', 'Ram': '2', 'memory_new': '1'})
+        return resp.status_code == 302
+
+    def restart(name):
+        clients[name].post('/control/stop')
+        return clients[name].post('/control/start').status_code == 302
+
+    def special_request(name):
+        resp = clients[name].post('/request_special', data={
+            'cpus': '1', 'ram': '2', 'memory': '1', 'reason': 'benchmark'})
+        return resp.status_code == 302
+
+    results['login'] = run_phase(users, [lambda n=n: login(n) for n in names + supers])
+    results['dashboard'] = run_phase(
+        users, [lambda n=n: dashboard(n) for n in names for _ in range(dashboard_loads)])
+    results['provision'] = run_phase(users, [lambda n=n: provision(n) for n in names])
+    results['restart'] = run_phase(users, [lambda n=n: restart(n) for n in names])
+    results['special_request'] = run_phase(users, [lambda n=n: special_request(n) for n in supers])
+
+    admin_client = admin_portal.app.test_client()
+    admin_client.post('/login', data={'username': admin_portal.ADMIN_USERNAME,
+                                      'password': admin_portal.ADMIN_PASSWORD})
+    admin_clients = [admin_portal.app.test_client() for _ in supers]
+    for c in admin_clients:
+        c.post('/login', data={'username': admin_portal.ADMIN_USERNAME,
+                               'password': admin_portal.ADMIN_PASSWORD})
+
+    def approve(idx):
+        resp = admin_clients[idx].post(f'/approve/{supers[idx]}')
+        return resp.status_code == 302
+
+    results['approve'] = run_phase(users, [lambda i=i: approve(i) for i in range(len(supers))])
+    results['admin_monitoring'] = run_phase(
+        users, [lambda: admin_client.get('/').status_code == 200 for _ in range(users)])
+    # Populates the metrics cache on first call, subsequent scrapes should be near-free
+    results['metrics_scrape'] = run_phase(
+        users, [lambda: admin_client.get('/metrics').status_code == 200 for _ in range(users)])
+
+    waits = engine.lock_waits
+    results['admission_lock'] = {
+        'acquisitions': len(waits),
+        'wait_p50_ms': percentile(waits, 50) * 1000,
+        'wait_p99_ms': percentile(waits, 99) * 1000,
+        'wait_max_ms': max(waits) * 1000 if waits else 0.0,
+        'hold_mean_ms': (sum(engine.lock_holds) / len(engine.lock_holds) * 1000) if engine.lock_holds else 0.0,
+    }
+    results['docker'] = engine.summary()
+    return results
+
+
+def startup_round(variant, cpus, ram_gb):
+    """Creates a container from hadoop_container and times its daemons and one CLI call.
+
+    'baseline' renders -Xshare:off everywhere, 'fast' the class data sharing archive
+    and short-lived-JVM flags the portals use.
+    """
+    from hadoop_config import SHORT_JVM, ConfigProfile, compute_hadoop_sizing, deliver_config_bundle, docker_env_flags
+    from utils import container_services, prepare_hdfs_volume, probe_service_ports, start_services, wait_for_services
+
+    fast = variant == 'fast'
+    container_name = f"pdl_bench_startup_{variant}"
+    data_dir = tempfile.mkdtemp(prefix='pdl-bench-data-')
+    open(os.path.join(data_dir, '.skip_service_start'), 'w').close()
+    ram_mb = int(ram_gb * 1024)
+    services = container_services(cpus, ram_mb)
+    profile = ConfigProfile(cpus=cpus, ram_mb=ram_mb, services=tuple(services), fast_startup=fast)
+    subprocess.run(["docker", "rm", "-f", container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        subprocess.run([
+            "docker", "create", "--name", container_name,
+            f"--cpus={cpus}", f"--memory={ram_gb}g",
+            "-v", f"{data_dir}:/data",
+            *docker_env_flags(compute_hadoop_sizing(cpus, ram_mb, services=services)),
+            *([] if fast else ["-e", "KAFKA_OPTS=-Xshare:off"]),
+            "hadoop_container"
+        ], stdout=subprocess.DEVNULL, check=True)
+        deliver_config_bundle(container_name, profile)
+        subprocess.run(["docker", "start", container_name], stdout=subprocess.DEVNULL, check=True)
+        deadline = time.time() + 30
+        while 22 not in probe_service_ports(container_name, [22]) and time.time() < deadline:
+            time.sleep(0.2)
+        prepare_hdfs_volume(container_name)
+
+        t0 = time.perf_counter()
+        start_services(container_name, services)
+        not_ready = wait_for_services(container_name, services)
+        services_s = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        cli = subprocess.run(["docker", "exec", container_name, "bash", "-c",
+                              f"{SHORT_JVM if fast else ''}hdfs dfs -ls / > /dev/null"])
+        cli_s = time.perf_counter() - t0
+        return {'services_s': services_s, 'cli_s': cli_s, 'ok': not not_ready and cli.returncode == 0}
+    finally:
+        subprocess.run(["docker", "rm", "-f", container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def run_startup_benchmark(rounds, cpus, ram_gb):
+    """Alternates baseline and fast rounds so host noise hits both variants alike."""
+    samples = {'baseline': [], 'fast': []}
+    for i in range(rounds):
+        for variant in samples:
+            r = startup_round(variant, cpus, ram_gb)
+            print(f"round {i + 1} {variant:<9} services {r['services_s']:6.1f}s  cli {r['cli_s']:5.2f}s"
+                  f"{'' if r['ok'] else '  (not ready)'}", file=sys.__stderr__)
+            samples[variant].append(r)
+    results = {}
+    for variant, runs in samples.items():
+        results[variant] = {
+            'rounds': len(runs),
+            'failed': sum(1 for r in runs if not r['ok']),
+            'services_p50_s': percentile([r['services_s'] for r in runs], 50),
+            'cli_p50_s': percentile([r['cli_s'] for r in runs], 50),
+        }
+    return results
+
+
+def print_startup_report(results):
+    print(f"{'variant':<12}{'rounds':>7}{'failed':>7}{'services p50 s':>16}{'cli p50 s':>11}")
+    for variant in ('baseline', 'fast'):
+        r = results[variant]
+        print(f"{variant:<12}{r['rounds']:>7}{r['failed']:>7}{r['services_p50_s']:>16.1f}{r['cli_p50_s']:>11.2f}")
+    base, fast = results['baseline'], results['fast']
+    if fast['services_p50_s'] and fast['cli_p50_s']:
+        print(f"\nspeedup: services {base['services_p50_s'] / fast['services_p50_s']:.2f}x, "
+              f"cli {base['cli_p50_s'] / fast['cli_p50_s']:.2f}x")
+
+
+def print_report(results, baseline=None):
+    print(f"{'phase':<18}{'ops':>6}{'err':>5}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for phase, r in results.items():
+        if 'p50_ms' not in r:
+            continue
+        line = (f"{phase:<18}{r['ops']:>6}{r['errors']:>5}{r['throughput_ops_s']:>10.1f}"
+                f"{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+        if baseline and phase in baseline and baseline[phase].get('p99_ms'):
+            delta = (r['p99_ms'] - baseline[phase]['p99_ms']) / baseline[phase]['p99_ms'] * 100
+            line += f"   p99 {delta:+.1f}% vs baseline"
+        print(line)
+    lock = results['admission_lock']
+    print(f"\nadmission lock: {lock['acquisitions']} acquisitions, wait p50 {lock['wait_p50_ms']:.1f} ms, "
+          f"p99 {lock['wait_p99_ms']:.1f} ms, max {lock['wait_max_ms']:.1f} ms, mean hold {lock['hold_mean_ms']:.1f} ms")
+    print(f"docker calls: {json.dumps(results['docker']['calls'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the portals against a fake Docker engine.")
+    parser.add_argument('--users', type=int, default=10, help="concurrent users")
+    parser.add_argument('--dashboard-loads', type=int, default=5, help="dashboard loads per user")
+    parser.add_argument('--time-scale', type=float, default=0.01,
+                        help="multiplier for time.sleep() inside the provisioning path")
+    parser.add_argument('--hdfs-delay', type=float, default=0.5, help="simulated HDFS readiness delay (s)")
+    parser.add_argument('--yarn-delay', type=float, default=0.3, help="simulated YARN readiness delay (s)")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="multiplier for simulated docker latency")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--verbose', action='store_true', help="show the portals' own output")
+    parser.add_argument('--startup', action='store_true',
+                        help="time daemon and CLI startup with and without the JVM startup flags "
+                             "(needs the real Docker engine and the hadoop_container image)")
+    parser.add_argument('--rounds', type=int, default=3, help="containers started per variant with --startup")
+    parser.add_argument('--cpus', type=float, default=2, help="container CPUs with --startup")
+    parser.add_argument('--ram-gb', type=float, default=4, help="container RAM with --startup")
+    args = parser.parse_args()
+
+    if args.startup:
+        sys.path.insert(0, BASE_DIR)
+        results = run_startup_benchmark(args.rounds, args.cpus, args.ram_gb)
+        results['config'] = vars(args)
+        print_startup_report(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    latency = {k: v * args.latency_scale for k, v in FakeDockerEngine().latency.items()}
+    engine = FakeDockerEngine(latency=latency, hdfs_ready_delay=args.hdfs_delay,
+                              yarn_ready_delay=args.yarn_delay, time_scale=args.time_scale,
+                              host_cores=args.users * 2 + 4, host_ram_gb=args.users * 4 + 16)
+
+    sys.path.insert(0, BASE_DIR)
+    workdir = tempfile.mkdtemp(prefix='pdl-bench-')
+    old_cwd = os.getcwd()
+    # users.json, requests.json, settings.json live in the working directory, the rest is relocated
+    os.chdir(workdir)
+    try:
+        quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+        with engine, quiet:
+            results = run_benchmark(args.users, args.dashboard_loads, engine, workdir)
+    finally:
+        os.chdir(old_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results['config'] = vars(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
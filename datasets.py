@@ -0,0 +1,97 @@
+# Admin-managed dataset catalog, mounted read-only into every user container
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+from package_cache import directory_disk_usage
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASETS_DIR = os.path.join(BASE_DIR, 'datasets')
+DATASETS_FILE = 'datasets.json'
+# In-container mount point; Spark/MapReduce jobs read it as file:///datasets/<name>
+DATASETS_MOUNT = '/datasets'
+
+DATASET_NAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$')
+
+
+def get_datasets():
+    """Reads the dataset catalog: {name: {description, size_bytes, created_at}}."""
+    if not os.path.exists(DATASETS_FILE):
+        return {}
+    try:
+        with open(DATASETS_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return {}
+
+
+def _save_datasets(datasets):
+    with open(DATASETS_FILE, 'w') as f:
+        json.dump(datasets, f, indent=4)
+
+
+def dataset_path(name):
+    return os.path.join(DATASETS_DIR, name)
+
+
+def add_dataset(name, description='', source_path=None):
+    """Registers a dataset, optionally copying its files from a host path.
+
+    Without a source the directory is created empty for the admin to fill
+    (scp/rsync straight into datasets/<name> on the host).
+    """
+    if not DATASET_NAME_RE.match(name or ''):
+        raise ValueError("Dataset names use letters, digits, '.', '_' and '-' only")
+    datasets = get_datasets()
+    if name in datasets:
+        raise ValueError(f"Dataset {name} already exists")
+    target = dataset_path(name)
+    if source_path and not os.path.isdir(source_path):
+        raise ValueError(f"{source_path} is not a directory on the host")
+    os.makedirs(target, exist_ok=True)
+    if source_path:
+        # Reflink where the filesystem supports it, so the import itself costs no space
+        subprocess.run(["cp", "-a", "--reflink=auto", source_path.rstrip('/') + '/.', target + '/'], check=True)
+    datasets[name] = {
+        'description': description,
+        'size_bytes': directory_disk_usage(target),
+        'created_at': time.time(),
+    }
+    _save_datasets(datasets)
+    return datasets[name]
+
+
+def refresh_dataset_sizes():
+    """Re-measures every dataset (files may have been added on the host since registration)."""
+    datasets = get_datasets()
+    seen = set()
+    for name, info in datasets.items():
+        info['size_bytes'] = directory_disk_usage(dataset_path(name), seen)
+    _save_datasets(datasets)
+    return datasets
+
+
+def remove_dataset(name):
+    """Drops a dataset from the catalog and deletes its files (running containers lose it too)."""
+    datasets = get_datasets()
+    if name not in datasets:
+        return False
+    del datasets[name]
+    _save_datasets(datasets)
+    path = dataset_path(name)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    return True
+
+
+def dataset_mount_flags():
+    """docker run flags mounting the whole catalog read-only.
+
+    One bind mount of the parent directory, so datasets added later show up in
+    running containers without recreating them.
+    """
+    os.makedirs(DATASETS_DIR, exist_ok=True)
+    return ["-v", f"{DATASETS_DIR}:{DATASETS_MOUNT}:ro"]
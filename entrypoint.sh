@@ -8,6 +8,21 @@ rm -f /tmp/*.pid
 echo "--- Starting SSH Server ---"
 /usr/sbin/sshd
 
+# Clients of the shared cluster (shared_cluster.py) never run daemons of their own.
+if [ -f /data/.pdl/client_mode ]; then
+    rm -f /data/.skip_service_start
+    echo "--- Shared cluster client, no local services. Container is now running. ---"
+    tail -f /dev/null
+fi
+
+# The manager's fast restart path starts the daemons itself (in parallel, with
+# readiness probes) and leaves this one-shot flag on the persistent volume.
+if [ -f /data/.skip_service_start ]; then
+    rm -f /data/.skip_service_start
+    echo "--- Services will be started by the manager. Container is now running. ---"
+    tail -f /dev/null
+fi
+
 # 2. Give the SSH service a moment to start up.
 sleep 2
 
@@ -19,14 +34,15 @@ $HADOOP_HOME/sbin/start-dfs.sh
 # 4. Start Zookeeper (Kafka's dependency).
 # The "-daemon" flag runs it in the background.
 echo "--- Starting Zookeeper ---"
-$KAFKA_HOME/bin/zookeeper-server-start.sh -daemon $KAFKA_HOME/config/zookeeper.properties
+# Both scripts read KAFKA_HEAP_OPTS; the manager passes sized heaps as PDL_* (empty = defaults).
+KAFKA_HEAP_OPTS="$PDL_ZOOKEEPER_HEAP_OPTS" $KAFKA_HOME/bin/zookeeper-server-start.sh -daemon $KAFKA_HOME/config/zookeeper.properties
 
 # 5. Give Zookeeper a moment to start up.
 sleep 2
 
 # 6. Start the Kafka Broker.
 echo "--- Starting Kafka Server ---"
-$KAFKA_HOME/bin/kafka-server-start.sh -daemon $KAFKA_HOME/config/server.properties
+KAFKA_HEAP_OPTS="$PDL_KAFKA_HEAP_OPTS" $KAFKA_HOME/bin/kafka-server-start.sh -daemon $KAFKA_HOME/config/server.properties
 
 echo "--- All services started. Container is now running. ---"
 echo "--- You can now SSH into the container. ---"
@@ -0,0 +1,405 @@
+# Hadoop/YARN/Spark sizing and config bundles derived from a container's CPU and RAM limits
+import hashlib
+import io
+import json
+import math
+import subprocess
+import tarfile
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from xml.sax.saxutils import escape
+
+from datasets import DATASETS_MOUNT
+
+# Every daemon shares the container's cgroup with YARN containers and the Spark driver.
+# (min heap MB, max heap MB, share of container RAM) per service daemon.
+DAEMON_HEAPS = {
+    'hdfs': {
+        'namenode': (256, 1024, 0.06),
+        'datanode': (256, 768, 0.04),
+        'secondarynamenode': (128, 512, 0.03),
+    },
+    'yarn': {
+        'resourcemanager': (256, 1024, 0.05),
+        'nodemanager': (256, 768, 0.04),
+    },
+    'zookeeper': {
+        'zookeeper': (128, 512, 0.02),
+    },
+    'kafka': {
+        'kafka': (256, 1024, 0.06),
+    },
+}
+# Small containers shrink every daemon heap towards this before starving YARN
+DAEMON_FLOOR_MB = 128
+# Left out, in this order, when the container is too small for them and a YARN job
+OPTIONAL_SERVICES = ('kafka', 'zookeeper')
+# Heap -> resident size (metaspace, thread stacks, direct buffers)
+JVM_OVERHEAD = 1.3
+# sshd, shells and page cache headroom for the OS inside the container
+OS_RESERVE_MB = 384
+# Spark/MapReduce client JVM (runs outside YARN in client mode)
+DRIVER_MIN_MB = 512
+DRIVER_MAX_MB = 2048
+DRIVER_FLOOR_MB = 192
+# Spark JVMs on YARN: the container is the heap plus max(384MB, 10%) overhead
+SPARK_MIN_HEAP_MB = 256
+SPARK_MIN_OVERHEAD_MB = 384
+
+# Rendered bundles are unpacked here (also SPARK_CONF_DIR, see Dockerfile.hadoop)
+HADOOP_CONF_DIR = '/opt/hadoop/etc/hadoop'
+JAVA_HOME = '/usr/lib/jvm/java-8-openjdk-amd64'
+# Written last into the bundle, holds the profile hash the config was rendered from
+PROFILE_MARKER = 'pdl-profile.json'
+# Bumped whenever render_config_bundle's output changes, so running containers pick it up on restart
+CONFIG_BUNDLE_VERSION = 4
+# viewfs://pdl/ shows HDFS with the read-only dataset catalog (datasets.py) linked in at /datasets
+VIEWFS_MOUNTTABLE = 'pdl'
+# spark-submit --packages resolves into this Ivy cache (shared between users, see package_cache.py)
+IVY_CACHE_DIR = '/var/cache/pdl/ivy'
+# Every JVM maps the class data sharing archive Dockerfile.hadoop builds for the Hadoop/Kafka
+# classpaths, and must not block on /dev/random for its first SecureRandom
+STARTUP_JVM_OPTS = '-Xshare:auto -Djava.security.egd=file:/dev/./urandom'
+# Prefix for the manager's own CLI calls (dfsadmin, mkdir, quotas, queue refresh): they exit
+# long before C2 pays off, so hadoop-env.sh runs them C1-only with the serial collector
+SHORT_JVM = 'export PDL_SHORT_JVM=1; '
+SHORT_JVM_OPTS = '-XX:TieredStopAtLevel=1 -XX:+UseSerialGC'
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def _rss(heap_mb):
+    return int(heap_mb * JVM_OVERHEAD)
+
+
+def _min_allocation(yarn_mb):
+    return 256 if yarn_mb < 4096 else 512
+
+
+def _spark_container_mb(heap_mb, min_alloc_mb):
+    """The YARN container a Spark JVM of this heap gets: heap plus overhead, rounded up to whole allocations."""
+    needed = heap_mb + max(SPARK_MIN_OVERHEAD_MB, int(heap_mb * 0.1))
+    return -(-needed // min_alloc_mb) * min_alloc_mb
+
+
+def _memory_budget(ram_mb, services):
+    """(heaps, driver_mb, what is left for YARN) once the OS reserve, daemons and driver are off the top."""
+    heaps = {}
+    for service in services:
+        for daemon, (low, high, share) in DAEMON_HEAPS.get(service, {}).items():
+            heaps[daemon] = int(_clamp(ram_mb * share, low, high))
+    driver_mb = int(_clamp(ram_mb * 0.1, DRIVER_MIN_MB, DRIVER_MAX_MB))
+
+    def left():
+        return ram_mb - OS_RESERVE_MB - sum(_rss(h) for h in heaps.values()) - _rss(driver_mb)
+
+    # Small containers: shrink every daemon and the driver before YARN can't fit a Spark job
+    spark_job_mb = 2 * _spark_container_mb(SPARK_MIN_HEAP_MB, _min_allocation(0))
+    while left() < spark_job_mb and (any(h > DAEMON_FLOOR_MB for h in heaps.values()) or driver_mb > DRIVER_FLOOR_MB):
+        for daemon in heaps:
+            heaps[daemon] = max(DAEMON_FLOOR_MB, int(heaps[daemon] * 0.8))
+        driver_mb = max(DRIVER_FLOOR_MB, int(driver_mb * 0.8))
+    return heaps, driver_mb, left()
+
+
+def compute_hadoop_sizing(cpus, ram_mb, services=('hdfs', 'yarn', 'zookeeper', 'kafka')):
+    """Works out daemon heaps, YARN resources and Spark/MapReduce defaults for a container.
+
+    The budget is the container's --memory: OS reserve, daemon JVMs and the client driver
+    come off the top and what is left goes to the NodeManager, so YARN can never hand out
+    more memory than the cgroup allows. Kafka and ZooKeeper are left out of containers too
+    small for them (see 'services'); a ValueError means not even HDFS and YARN fit.
+    """
+    ram_mb = int(ram_mb)
+    services = list(services)
+    while True:
+        heaps, driver_mb, yarn_mb = _memory_budget(ram_mb, services)
+        if 'yarn' not in services:
+            # A shared-cluster client: YARN is the user's queue on the cluster, not in this container
+            yarn_mb = max(512, yarn_mb)
+            break
+        min_alloc_mb = _min_allocation(yarn_mb)
+        # Room for at least an ApplicationMaster and one task
+        if yarn_mb // min_alloc_mb >= 2:
+            break
+        optional = [s for s in OPTIONAL_SERVICES if s in services]
+        if not optional:
+            raise ValueError(f"{ram_mb} MB of RAM is too little for {', '.join(services)} and a YARN job, "
+                             f"at least {ram_mb - yarn_mb + 2 * min_alloc_mb} MB are needed")
+        services.remove(optional[0])
+
+    vcores = max(1, math.ceil(float(cpus)))
+    min_alloc_mb = _min_allocation(yarn_mb)
+    # Round the NodeManager total down to whole allocations so nothing is stranded
+    yarn_mb = yarn_mb // min_alloc_mb * min_alloc_mb
+
+    # MapReduce: the ApplicationMaster and one task always fit next to each other
+    am_mb = min_alloc_mb * 2 if yarn_mb >= min_alloc_mb * 4 else min_alloc_mb
+    task_room_mb = yarn_mb - am_mb
+    map_mb = max(min_alloc_mb, min(2048, yarn_mb // vcores // min_alloc_mb * min_alloc_mb, task_room_mb))
+    reduce_mb = min(task_room_mb, map_mb * 2)
+
+    # Spark: one ApplicationMaster container, the rest split between executors of up to 4 cores.
+    # Sizes are whole containers (heap + overhead), so YARN's rounding can't push them past yarn_mb.
+    am_container_mb = _spark_container_mb(SPARK_MIN_HEAP_MB, min_alloc_mb)
+    executor_cores = min(vcores, 4)
+    executors = min(max(1, vcores // executor_cores),
+                    max(0, yarn_mb - am_container_mb) // _spark_container_mb(SPARK_MIN_HEAP_MB, min_alloc_mb))
+    spark = {'spark.master': 'yarn', 'spark.driver.memory': f"{driver_mb}m"}
+    if executors:
+        executor_container_mb = (yarn_mb - am_container_mb) // executors // min_alloc_mb * min_alloc_mb
+        executor_mb = min(executor_container_mb - SPARK_MIN_OVERHEAD_MB, int(executor_container_mb / 1.1))
+        spark.update({
+            'spark.yarn.am.memory': f"{SPARK_MIN_HEAP_MB}m",
+            'spark.yarn.am.memoryOverhead': f"{am_container_mb - SPARK_MIN_HEAP_MB}m",
+            'spark.executor.instances': executors,
+            'spark.executor.cores': executor_cores,
+            'spark.executor.memory': f"{executor_mb}m",
+            'spark.executor.memoryOverhead': f"{executor_container_mb - executor_mb}m",
+            'spark.dynamicAllocation.enabled': 'false',
+        })
+    else:
+        # No room for an ApplicationMaster plus an executor: Spark runs inside the driver
+        spark['spark.master'] = f"local[{vcores}]"
+
+    return {
+        'services': services,
+        'heaps_mb': heaps,
+        'driver_mb': driver_mb,
+        'yarn': {
+            'yarn.nodemanager.resource.memory-mb': yarn_mb,
+            'yarn.nodemanager.resource.cpu-vcores': vcores,
+            'yarn.scheduler.minimum-allocation-mb': min_alloc_mb,
+            'yarn.scheduler.maximum-allocation-mb': yarn_mb,
+            'yarn.scheduler.minimum-allocation-vcores': 1,
+            'yarn.scheduler.maximum-allocation-vcores': vcores,
+            # The cgroup enforces physical memory; the virtual check only kills JVMs spuriously
+            'yarn.nodemanager.vmem-check-enabled': 'false',
+        },
+        'mapred': {
+            'mapreduce.framework.name': 'yarn',
+            'yarn.app.mapreduce.am.resource.mb': am_mb,
+            'yarn.app.mapreduce.am.command-opts': f"-Xmx{int(am_mb * 0.8)}m",
+            'mapreduce.map.memory.mb': map_mb,
+            'mapreduce.reduce.memory.mb': reduce_mb,
+            'mapreduce.map.java.opts': f"-Xmx{int(map_mb * 0.8)}m",
+            'mapreduce.reduce.java.opts': f"-Xmx{int(reduce_mb * 0.8)}m",
+        },
+        'spark': spark,
+    }
+
+
+def minimum_ram_gb(cpus=1):
+    """Smallest whole-GB --memory compute_hadoop_sizing accepts, for form limits."""
+    ram_gb = 1
+    while True:
+        try:
+            compute_hadoop_sizing(cpus, ram_gb * 1024)
+            return ram_gb
+        except ValueError:
+            ram_gb += 1
+
+
+def sizing_env_script(sizing):
+    """Shell exports for the daemon heaps (rendered into hadoop-env.sh, PDL_* also passed to docker run)."""
+    heaps = sizing['heaps_mb']
+    lines = ["# Generated by the resource manager from the container's CPU/RAM limits"]
+    hadoop_vars = {
+        'namenode': 'HDFS_NAMENODE_OPTS',
+        'datanode': 'HDFS_DATANODE_OPTS',
+        'secondarynamenode': 'HDFS_SECONDARYNAMENODE_OPTS',
+        'resourcemanager': 'YARN_RESOURCEMANAGER_OPTS',
+        'nodemanager': 'YARN_NODEMANAGER_OPTS',
+    }
+    for daemon, var in hadoop_vars.items():
+        if daemon in heaps:
+            lines.append(f'export {var}="-Xms{heaps[daemon]}m -Xmx{heaps[daemon]}m"')
+    # Kafka and ZooKeeper both read KAFKA_HEAP_OPTS, so keep them apart until start time
+    if 'zookeeper' in heaps:
+        lines.append(f'export PDL_ZOOKEEPER_HEAP_OPTS="-Xms{heaps["zookeeper"]}m -Xmx{heaps["zookeeper"]}m"')
+    if 'kafka' in heaps:
+        lines.append(f'export PDL_KAFKA_HEAP_OPTS="-Xms{heaps["kafka"]}m -Xmx{heaps["kafka"]}m"')
+    return "\n".join(lines) + "\n"
+
+
+def docker_env_flags(sizing):
+    """docker run -e flags so entrypoint.sh starts ZooKeeper/Kafka with the sized heaps."""
+    flags = []
+    for line in sizing_env_script(sizing).splitlines():
+        if line.startswith('export PDL_'):
+            name, value = line[len('export '):].split('=', 1)
+            flags += ["-e", f"{name}={value.strip(chr(34))}"]
+    return flags
+
+
+@dataclass(frozen=True)
+class ConfigProfile:
+    """Everything a container's Hadoop/Spark config is rendered from.
+
+    Two containers with equal profiles get byte-identical bundles, so the rendered
+    tarball is cached by profile hash rather than rebuilt per provision.
+    """
+    cpus: float
+    ram_mb: int
+    services: tuple = ('hdfs', 'yarn', 'zookeeper', 'kafka')
+    default_fs: str = 'hdfs://localhost:9000'
+    namenode_dir: str = '/data/hdfs/namenode'
+    datanode_dir: str = '/data/hdfs/datanode'
+    replication: int = 1
+    fast_startup: bool = True  # STARTUP_JVM_OPTS/SHORT_JVM_OPTS; False renders -Xshare:off (benchmark baseline)
+    extra: tuple = ()  # ((file name, property, value), ...) overrides
+    queues: tuple = ()  # ((name, capacity %, max capacity %, state, user), ...) -> capacity-scheduler.xml
+
+    @classmethod
+    def for_limits(cls, cpus, ram_mb, services=None, **kwargs):
+        return cls(cpus=float(cpus), ram_mb=int(ram_mb),
+                   services=tuple(services or cls.services), **kwargs)
+
+    def digest(self):
+        blob = json.dumps({'version': CONFIG_BUNDLE_VERSION, **asdict(self)}, sort_keys=True)
+        return hashlib.sha256(blob.encode()).hexdigest()[:16]
+
+
+def render_xml(properties):
+    """A Hadoop *-site.xml document for the given {name: value} properties."""
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<?xml-stylesheet type="text/xsl" href="configuration.xsl"?>',
+             '<!-- Generated by the resource manager, changes are overwritten -->',
+             '<configuration>']
+    for name, value in properties.items():
+        if isinstance(value, bool):
+            value = 'true' if value else 'false'
+        lines.append(f"  <property><name>{escape(str(name))}</name><value>{escape(str(value))}</value></property>")
+    lines.append('</configuration>')
+    return "\n".join(lines) + "\n"
+
+
+def hadoop_env_script(sizing, fast_startup=True):
+    """hadoop-env.sh: JAVA_HOME, daemon users, startup flags and the sized heaps (read by HDFS and YARN scripts)."""
+    lines = [
+        "# Generated by the resource manager from the container's CPU/RAM limits",
+        f"export JAVA_HOME={JAVA_HOME}",
+        "export HDFS_NAMENODE_USER=root",
+        "export HDFS_DATANODE_USER=root",
+        "export HDFS_SECONDARYNAMENODE_USER=root",
+        "export YARN_RESOURCEMANAGER_USER=root",
+        "export YARN_NODEMANAGER_USER=root",
+    ]
+    if fast_startup:
+        lines += [
+            f'export HADOOP_OPTS="$HADOOP_OPTS {STARTUP_JVM_OPTS}"',
+            f'if [ -n "$PDL_SHORT_JVM" ]; then export HADOOP_CLIENT_OPTS="$HADOOP_CLIENT_OPTS {SHORT_JVM_OPTS}"; fi',
+        ]
+    else:
+        lines.append('export HADOOP_OPTS="$HADOOP_OPTS -Xshare:off"')
+    lines += sizing_env_script(sizing).splitlines()[1:]
+    return "\n".join(lines) + "\n"
+
+
+def capacity_scheduler_properties(queues):
+    """capacity-scheduler.xml with one queue per user under root, plus 'default' for the remainder.
+
+    Each queue only accepts its own user's applications and every user's jobs are mapped
+    to their queue, whatever queue they ask for.
+    """
+    names = [q[0] for q in queues]
+    default_capacity = max(0.0, round(100 - sum(float(q[1]) for q in queues), 2))
+    props = {
+        'yarn.scheduler.capacity.resource-calculator':
+            'org.apache.hadoop.yarn.util.resource.DominantResourceCalculator',
+        # Small queues still need room for their ApplicationMaster
+        'yarn.scheduler.capacity.maximum-am-resource-percent': 0.5,
+        'yarn.scheduler.capacity.root.queues': ','.join(['default'] + names),
+        # ACLs are inherited, so root must not grant everyone (its default is '*')
+        'yarn.scheduler.capacity.root.acl_submit_applications': ' ',
+        'yarn.scheduler.capacity.root.acl_administer_queue': 'root',
+        'yarn.scheduler.capacity.root.default.capacity': f"{default_capacity:.2f}",
+        'yarn.scheduler.capacity.root.default.maximum-capacity': 100,
+        'yarn.scheduler.capacity.root.default.acl_submit_applications': 'root',
+        'yarn.scheduler.capacity.queue-mappings': ','.join(f"u:{name}:{name}" for name in names),
+        'yarn.scheduler.capacity.queue-mappings-override.enable': 'true',
+    }
+    for name, capacity, max_capacity, state, user in queues:
+        prefix = f'yarn.scheduler.capacity.root.{name}'
+        props.update({
+            f'{prefix}.capacity': capacity,
+            f'{prefix}.maximum-capacity': max_capacity,
+            f'{prefix}.state': state,
+            # One user per queue: let that user grow to the queue's maximum
+            f'{prefix}.user-limit-factor': max(1, math.ceil(float(max_capacity) / max(float(capacity), 0.01))),
+            f'{prefix}.acl_submit_applications': user,
+            f'{prefix}.acl_administer_queue': user,
+        })
+    return props
+
+
+@lru_cache(maxsize=64)
+def render_config_bundle(profile):
+    """{file name: content} for core-, hdfs-, yarn-, mapred-site, spark-defaults and hadoop-env
+    (and capacity-scheduler.xml when the profile defines queues)."""
+    sizing = compute_hadoop_sizing(profile.cpus, profile.ram_mb, services=profile.services)
+    core = {
+        'fs.defaultFS': profile.default_fs,
+        f'fs.viewfs.mounttable.{VIEWFS_MOUNTTABLE}.link.{DATASETS_MOUNT}': f'file://{DATASETS_MOUNT}',
+        f'fs.viewfs.mounttable.{VIEWFS_MOUNTTABLE}.linkFallback': profile.default_fs,
+    }
+    hdfs = {
+        'dfs.namenode.name.dir': profile.namenode_dir,
+        'dfs.datanode.data.dir': profile.datanode_dir,
+        'dfs.replication': profile.replication,
+    }
+    yarn = {
+        'yarn.nodemanager.aux-services': 'mapreduce_shuffle',
+        'yarn.nodemanager.env-whitelist': 'JAVA_HOME,HADOOP_COMMON_HOME,HADOOP_HDFS_HOME,'
+                                          'HADOOP_CONF_DIR,CLASSPATH_PREPEND_DISTCACHE,'
+                                          'HADOOP_YARN_HOME,HADOOP_HOME,PATH,LANG,TZ,HADOOP_MAPRED_HOME',
+        **sizing['yarn'],
+    }
+    mapred_home = 'HADOOP_MAPRED_HOME=/opt/hadoop'
+    mapred = {
+        **sizing['mapred'],
+        'yarn.app.mapreduce.am.env': mapred_home,
+        'mapreduce.map.env': mapred_home,
+        'mapreduce.reduce.env': mapred_home,
+    }
+    spark = {**sizing['spark'], 'spark.jars.ivy': IVY_CACHE_DIR}
+    sections = {'core-site.xml': core, 'hdfs-site.xml': hdfs, 'yarn-site.xml': yarn,
+                'mapred-site.xml': mapred, 'spark-defaults.conf': spark}
+    if profile.queues:
+        sections['capacity-scheduler.xml'] = capacity_scheduler_properties(profile.queues)
+    for file_name, name, value in profile.extra:
+        sections[file_name][name] = value
+
+    files = {name: render_xml(props) for name, props in sections.items() if name.endswith('.xml')}
+    files['spark-defaults.conf'] = "\n".join(f"{k} {v}" for k, v in spark.items()) + "\n"
+    files['hadoop-env.sh'] = hadoop_env_script(sizing, profile.fast_startup)
+    files[PROFILE_MARKER] = json.dumps({'digest': profile.digest(), 'profile': asdict(profile)}, indent=2) + "\n"
+    return files
+
+
+@lru_cache(maxsize=64)
+def config_bundle_tar(profile):
+    """The rendered bundle as an uncompressed tar, ready for `docker cp -`."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        for name, content in render_config_bundle(profile).items():
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755 if name.endswith('.sh') else 0o644
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def deliver_config_bundle(container_name, profile):
+    """Unpacks the profile's bundle into the container's Hadoop config directory in one copy.
+
+    Works on created and stopped containers too, so the config is in place before
+    any daemon starts.
+    """
+    subprocess.run(["docker", "cp", "-", f"{container_name}:{HADOOP_CONF_DIR}"],
+                   input=config_bundle_tar(profile), stdout=subprocess.DEVNULL,
+                   stderr=subprocess.PIPE, check=True)
+    return profile.digest()
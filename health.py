@@ -0,0 +1,248 @@
+# Health watchdog: probes the daemons of every running container and restarts crashed ones in place
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from shared_cluster import SHARED_CLUSTER_CONTAINER, SHARED_SERVICES, get_tenants
+from utils import (HADOOP_SERVICES, RESTART_READY_TIMEOUT, container_services, get_cpu_grants, get_desired_states,
+                   get_hibernated, start_services, wait_for_services)
+
+HEALTH_FILE = 'health.json'
+HEALTH_INTERVAL = 30
+HEALTH_WORKERS = 8
+# Containers started this recently are still being provisioned or restarted by someone else
+HEALTH_GRACE_SECONDS = RESTART_READY_TIMEOUT + 60
+# A daemon that keeps dying (heap too small for the workload, corrupt metadata) is left down
+# after this many restarts in RESTART_WINDOW_SECONDS, until the container itself is restarted
+MAX_RESTARTS_PER_WINDOW = 3
+RESTART_WINDOW_SECONDS = 3600
+# cgroup v2 and v1 both report the container's OOM kills as "oom_kill <n>"
+OOM_COUNTER_FILES = '/sys/fs/cgroup/memory.events /sys/fs/cgroup/memory/memory.oom_control'
+
+_watchdog_lock = threading.Lock()
+_watchdog_started = False
+
+
+def get_health():
+    """{container name: health record} from the last sweep, {} before the first one."""
+    if not os.path.exists(HEALTH_FILE):
+        return {}
+    try:
+        with open(HEALTH_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _update_health(update):
+    with open(HEALTH_FILE, 'a+') as f:
+        # The watchdog writes records, the portals drop them on delete
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        health = json.loads(raw) if raw.strip() else {}
+        update(health)
+        f.seek(0)
+        f.truncate()
+        json.dump(health, f, indent=4)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return health
+
+
+def forget_health(container_names):
+    """Drops the records of deleted containers."""
+    def drop(health):
+        for name in container_names:
+            health.pop(name, None)
+    _update_health(drop)
+
+
+def _started_at(value):
+    """Epoch seconds of docker's State.StartedAt ("2024-05-01T10:00:00.123456789Z")."""
+    try:
+        return datetime.strptime(value[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def watched_containers():
+    """{container name: (services, started_at)} for every running container with daemons to watch.
+
+    Shared-cluster clients have no daemons of their own (the cluster container is watched
+    instead), and containers whose owner asked for them to be stopped are left alone.
+    """
+    container_ids = subprocess.run(["docker", "ps", "-q"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   text=True).stdout.split()
+    if not container_ids:
+        return {}
+    # One inspect for all of them
+    result = subprocess.run(["docker", "inspect", "-f",
+                             "{{.Name}} {{.State.StartedAt}} {{.HostConfig.NanoCpus}} {{.HostConfig.Memory}}",
+                             *container_ids], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    started, limits = {}, {}
+    for line in result.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 4:
+            started[parts[0].lstrip('/')] = _started_at(parts[1])
+            limits[parts[0].lstrip('/')] = (int(parts[2] or 0) / 1e9, int(parts[3] or 0) // (1024 * 1024))
+
+    desired = get_desired_states()
+    hibernated = get_hibernated()
+    clients = {u for u, t in get_tenants().items() if t.get('queue_state') == 'RUNNING'}
+    grants = get_cpu_grants()
+    watched = {}
+    for name in started:
+        if name == SHARED_CLUSTER_CONTAINER:
+            watched[name] = list(SHARED_SERVICES)
+        elif name.endswith('_container'):
+            username = name[:-len('_container')]
+            if (username in clients or username in hibernated
+                    or desired.get(username, {}).get('state', 'running') != 'running'):
+                continue
+            try:
+                # Small containers run without Kafka and ZooKeeper
+                cpus, ram_mb = limits[name]
+                watched[name] = container_services(grants.get(username, cpus), ram_mb)
+            except ValueError:
+                watched[name] = list(HADOOP_SERVICES)
+    return {name: (services, started[name]) for name, services in watched.items()}
+
+
+def probe_container(container_name, services):
+    """(open ports, OOM kill count) of a container in a single exec; None if it didn't answer."""
+    ports = sorted({p for s in services for p in HADOOP_SERVICES[s]['ports']})
+    result = subprocess.run(
+        ["docker", "exec", container_name, "bash", "-c",
+         f"for p in {' '.join(map(str, ports))}; do (exec 3<>/dev/tcp/127.0.0.1/$p) 2>/dev/null && echo $p; done; "
+         f"cat {OOM_COUNTER_FILES} 2>/dev/null | awk '$1 == \"oom_kill\" {{ print \"oom_kill=\" $2 }}'"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    if result.returncode != 0 and not result.stdout:
+        return None
+    open_ports, oom_kills = set(), 0
+    for token in result.stdout.split():
+        if token.isdigit():
+            open_ports.add(int(token))
+        elif token.startswith('oom_kill=') and token[len('oom_kill='):].isdigit():
+            oom_kills = int(token[len('oom_kill='):])
+    return open_ports, oom_kills
+
+
+def check_container(container_name, services, started_at, previous):
+    """Probes one container, restarts its dead daemons and returns the new health record."""
+    now = time.time()
+    # Restart counts are kept for the container's lifetime; the restart budget and the
+    # OOM baseline (a new cgroup counts from zero) belong to one container start
+    previous = previous or {'restarts': {}}
+    if previous.get('started_at') != started_at:
+        previous = {'started_at': started_at, 'restarts': previous.get('restarts', {}),
+                    'recent_restarts': [], 'oom_kills': None}
+    record = dict(previous, checked_at=now, services=services)
+
+    if now - started_at < HEALTH_GRACE_SECONDS:
+        record.update(status='starting', down=[])
+        return record
+    probe = probe_container(container_name, services)
+    if probe is None:
+        record.update(status='unreachable', down=[])
+        return record
+    open_ports, oom_kills = probe
+    down = [s for s in services if not set(HADOOP_SERVICES[s]['ports']) <= open_ports]
+    # The first sweep after a start only records the baseline
+    oom = previous['oom_kills'] is not None and oom_kills > previous['oom_kills']
+    record.update(oom_kills=oom_kills, down=down)
+    if not down:
+        record['status'] = 'healthy'
+        return record
+
+    recent = [t for t in previous['recent_restarts'] if now - t < RESTART_WINDOW_SECONDS]
+    if len(recent) >= MAX_RESTARTS_PER_WINDOW:
+        record.update(status='failed', recent_restarts=recent)
+        return record
+
+    cause = 'oom' if oom else 'crash'
+    print(f"Watchdog: {container_name} lost {', '.join(down)} ({cause}), restarting")
+    start_services(container_name, down)
+    still_down = wait_for_services(container_name, down)
+    restarts = dict(previous['restarts'])
+    for name in down:
+        restarts[name] = restarts.get(name, 0) + 1
+    record.update(
+        status='degraded' if still_down else 'recovered',
+        down=still_down,
+        restarts=restarts,
+        recent_restarts=recent + [now],
+        last_restart={'at': now, 'services': down, 'cause': cause, 'ok': not still_down},
+    )
+    if still_down:
+        print(f"Watchdog: {container_name} still down after restart: {', '.join(still_down)}")
+    return record
+
+
+def run_health_sweep(workers=HEALTH_WORKERS):
+    """Checks every watched container, at most `workers` at a time. Returns the new records."""
+    watched = watched_containers()
+    previous = get_health()
+
+    def check(item):
+        name, (services, started_at) = item
+        try:
+            return name, check_container(name, services, started_at, previous.get(name))
+        except Exception as e:
+            print(f"Watchdog: check of {name} failed: {e}")
+            return name, dict(previous.get(name) or {}, status='unknown', checked_at=time.time())
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        records = dict(pool.map(check, watched.items()))
+
+    def merge(health):
+        # Stopped containers keep their restart counts, deletes drop them (forget_health)
+        for name, record in health.items():
+            if name not in records:
+                record['status'] = 'not_watched'
+        health.update(records)
+    _update_health(merge)
+    return records
+
+
+def _watchdog_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            run_health_sweep()
+        except Exception as e:
+            print(f"Watchdog sweep failed: {e}")
+
+
+def start_watchdog(interval=HEALTH_INTERVAL):
+    """Starts the background sweep once per process."""
+    global _watchdog_started
+    with _watchdog_lock:
+        if _watchdog_started:
+            return
+        _watchdog_started = True
+    threading.Thread(target=_watchdog_loop, args=(interval,), daemon=True).start()
+
+
+def render_health_metrics():
+    """Daemon restart counters and container health in the Prometheus text format."""
+    health = get_health()
+    lines = ["# HELP pdl_daemon_restarts_total Crashed daemons restarted by the watchdog",
+             "# TYPE pdl_daemon_restarts_total counter"]
+    for name, record in sorted(health.items()):
+        for service, count in sorted(record.get('restarts', {}).items()):
+            lines.append(f'pdl_daemon_restarts_total{{container="{name}",service="{service}"}} {count}')
+    lines += ["# HELP pdl_container_health Containers by watchdog status",
+              "# TYPE pdl_container_health gauge"]
+    by_status = {}
+    for record in health.values():
+        by_status[record.get('status', 'unknown')] = by_status.get(record.get('status', 'unknown'), 0) + 1
+    for status, count in sorted(by_status.items()):
+        lines.append(f'pdl_container_health{{status="{status}"}} {count}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,287 @@
+# Leases for approved super-user requests: scheduled starts, expiry back to the standard
+# limits, reminders and renewal requests
+import fcntl
+import json
+import math
+import os
+import threading
+import time
+
+from shared_cluster import host_footprint
+from utils import (get_all_containers_details, get_available_resources, get_global_limits, hibernate_container,
+                   provision_container, resize_container)
+from usage import retarget_throttle
+from lifecycle_trace import record_event
+
+LEASES_FILE = 'leases.json'
+LEASE_INTERVAL = 60
+# The dashboard starts reminding the user this long before the lease ends
+LEASE_REMINDER_HOURS = 24
+# Ended leases stay visible on the dashboard for a while
+ENDED_LEASE_RETENTION = 7 * 24 * 3600
+LEASE_ACTIONS = ('scale_down', 'stop')
+
+_manager_lock = threading.Lock()
+_manager_started = False
+
+
+def get_leases():
+    """{username: lease}; state is 'scheduled', 'active' or 'ended'."""
+    if not os.path.exists(LEASES_FILE):
+        return {}
+    try:
+        with open(LEASES_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _update_leases(update):
+    with open(LEASES_FILE, 'a+') as f:
+        # The admin portal grants and renews, the user portal's manager starts and ends leases
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        leases = json.loads(raw) if raw.strip() else {}
+        result = update(leases)
+        f.seek(0)
+        f.truncate()
+        json.dump(leases, f, indent=4)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+
+def _format_time(ts):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(ts))
+
+
+def describe_lease(lease, now=None):
+    """The lease with the display fields the templates use."""
+    if not lease:
+        return None
+    now = now or time.time()
+    hours_left = (lease['expires_at'] - now) / 3600
+    return dict(
+        lease,
+        starts=_format_time(lease['starts_at']),
+        expires=_format_time(lease['expires_at']),
+        hours_left=round(max(hours_left, 0), 1),
+        reminder=lease['state'] == 'active' and hours_left <= LEASE_REMINDER_HOURS,
+    )
+
+
+def get_user_lease(username):
+    return describe_lease(get_leases().get(username))
+
+
+def provision_approved(username, req):
+    """Admission check and provisioning for an approved request. Returns (success, message, status)."""
+    lock_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'request.lock')
+    with open(lock_path, 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            # Check if user already has a container (atomic)
+            if any(c['Names'] == f"{username}_container" for c in get_all_containers_details()):
+                record_event('reject', username, reason='exists')
+                return False, f"User '{username}' already has an active container. A user can only have one container at a time.", 400
+            available = get_available_resources()
+            ram_str = req['ram_gb']  # Already in format like "4g"
+            # In shared-cluster mode only the client container is placed on the host
+            cpus_requested, ram_requested = host_footprint(req['cpu'], ram_str.lower().replace("g", ""))
+            memory_requested = req['memory_gb']
+            if cpus_requested > available['cores_available']:
+                record_event('reject', username, reason='cpu')
+                return False, f"Insufficient CPU resources. Requested: {cpus_requested}, Available: {available['cores_available']}", 400
+            if ram_requested > available['ram_available_gb']:
+                record_event('reject', username, reason='ram')
+                return False, f"Insufficient RAM. Requested: {ram_requested}GB, Available: {available['ram_available_gb']}GB", 400
+            if memory_requested > available['host_free_disk_gb']:
+                record_event('reject', username, reason='disk')
+                return False, f"Insufficient disk space. Requested: {memory_requested}GB, Available: {available['host_free_disk_gb']}GB", 400
+            # Approved super user containers always get dedicated cores
+            success, msg = provision_container(username, req['cpu'], req['memory_gb'], req['ram_gb'],
+                                               io_profile=req.get('io_profile', 'standard'), dedicated_cpus=True)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+    if not success:
+        return False, f"Error creating container: {msg}", 500
+    return True, msg, 200
+
+
+def parse_lease_form(starts_at, hours):
+    """Validates an approval's start time (datetime-local, host time zone) and lease hours.
+
+    Returns (starts_at, hours) with None for fields left empty, or raises ValueError. Called
+    before provisioning, so a bad value can't leave a container running without a lease.
+    """
+    if starts_at:
+        for fmt in ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                starts_at = time.mktime(time.strptime(starts_at, fmt))
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"Invalid start time '{starts_at}', expected YYYY-MM-DDTHH:MM")
+    if hours:
+        try:
+            hours = float(hours)
+        except ValueError:
+            raise ValueError(f"Invalid lease length '{hours}'")
+        if not math.isfinite(hours) or hours <= 0:
+            raise ValueError("The lease must last more than 0 hours")
+    return starts_at or None, hours or None
+
+
+def grant_lease(username, req, hours=None, starts_at=None, on_expiry=None):
+    """Records the lease of an approved request; a future starts_at makes it a scheduled one."""
+    limits = get_global_limits()
+    now = time.time()
+    starts_at = max(float(starts_at or now), now)
+    hours = float(hours or limits['lease_default_hours'])
+    lease = {
+        'cpu': req['cpu'],
+        'memory_gb': req['memory_gb'],
+        'ram_gb': req['ram_gb'],
+        'io_profile': req.get('io_profile', 'standard'),
+        'reason': req.get('reason', ''),
+        'state': 'scheduled' if starts_at > now else 'active',
+        'granted_at': now,
+        'starts_at': starts_at,
+        'expires_at': starts_at + hours * 3600,
+        'on_expiry': on_expiry if on_expiry in LEASE_ACTIONS else limits['lease_expiry_action'],
+        'renewal': None,
+        'renewals': 0,
+        'last_error': None,
+    }
+    _update_leases(lambda leases: leases.update({username: lease}))
+    return lease
+
+
+def request_renewal(username, hours, reason):
+    """Files a renewal for the admin; only an active lease can be renewed."""
+    def file(leases):
+        lease = leases.get(username)
+        if not lease or lease['state'] != 'active':
+            return False
+        lease['renewal'] = {'hours': float(hours), 'reason': reason, 'requested_at': time.time()}
+        return True
+    return _update_leases(file)
+
+
+def decide_renewal(username, approve):
+    """Extends the lease by the requested hours, or drops the renewal request."""
+    def decide(leases):
+        lease = leases.get(username)
+        if not lease or not lease.get('renewal'):
+            return False
+        if approve and lease['state'] == 'active':
+            lease['expires_at'] = max(lease['expires_at'], time.time()) + lease['renewal']['hours'] * 3600
+            lease['renewals'] = lease.get('renewals', 0) + 1
+            lease.pop('reminded_at', None)
+        lease['renewal'] = None
+        return True
+    return _update_leases(decide)
+
+
+def end_lease(username):
+    """Ends a lease now: the container goes back to the standard limits (or is stopped)."""
+    def mark(leases):
+        lease = leases.get(username)
+        if lease and lease['state'] != 'ended':
+            lease['expires_at'] = min(lease['expires_at'], time.time())
+            return lease['state']
+        return None
+    state = _update_leases(mark)
+    if state == 'scheduled':
+        # Nothing was provisioned yet
+        _update_leases(lambda leases: leases[username].update(state='ended', ended_at=time.time()))
+    elif state == 'active':
+        _expire(username, get_leases()[username])
+
+
+def forget_leases(usernames):
+    """Drops the leases of deleted containers (a scheduled one has no container yet and stays)."""
+    def drop(leases):
+        for username in usernames:
+            if leases.get(username, {}).get('state') != 'scheduled':
+                leases.pop(username, None)
+    _update_leases(drop)
+
+
+def _start(username, lease):
+    success, msg, _ = provision_approved(username, lease)
+    def record(leases):
+        if username in leases:
+            if success:
+                leases[username].update(state='active', last_error=None)
+            else:
+                # Retried every pass until the window closes (e.g. the user still has a container)
+                leases[username]['last_error'] = msg
+    _update_leases(record)
+    print(f"Lease: {'started' if success else 'could not start'} {username}'s reserved container{'' if success else ': ' + msg}")
+
+
+def _expire(username, lease):
+    limits = get_global_limits()
+    cpus = min(float(lease['cpu']), float(limits['max_cpu']))
+    ram_gb = min(float(str(lease['ram_gb']).lower().rstrip('g')), float(limits['max_ram_gb']))
+    stop = lease['on_expiry'] == 'stop'
+    if stop:
+        # Frees the host now; the next start comes back at the standard size
+        hibernate_container(username)
+    success, msg = resize_container(username, cpus, ram_gb)
+    if success:
+        retarget_throttle(username, cpus)
+
+    def record(leases):
+        if username in leases:
+            leases[username].update(state='ended', ended_at=time.time(), renewal=None,
+                                    last_error=None if success else msg)
+    _update_leases(record)
+    print(f"Lease: {username}'s lease ended, {'stopped and ' if stop else ''}"
+          f"{'scaled down to' if success else 'could not scale down to'} {cpus} CPUs / {ram_gb} GB"
+          f"{'' if success else ': ' + msg}")
+
+
+def run_lease_checks(now=None):
+    """Starts scheduled leases, records reminders and ends expired leases."""
+    now = now or time.time()
+    for username, lease in get_leases().items():
+        if lease['state'] == 'scheduled':
+            if now >= lease['expires_at']:
+                _update_leases(lambda leases: leases[username].update(state='ended', ended_at=now))
+            elif now >= lease['starts_at']:
+                _start(username, lease)
+        elif lease['state'] == 'active':
+            if now >= lease['expires_at']:
+                _expire(username, lease)
+            elif now >= lease['expires_at'] - LEASE_REMINDER_HOURS * 3600 and not lease.get('reminded_at'):
+                _update_leases(lambda leases: leases[username].update(reminded_at=now))
+                print(f"Lease: {username}'s lease ends at {_format_time(lease['expires_at'])}")
+
+    def prune(leases):
+        for username in [u for u, l in leases.items()
+                         if l['state'] == 'ended' and now - l.get('ended_at', now) > ENDED_LEASE_RETENTION]:
+            del leases[username]
+    _update_leases(prune)
+
+
+def _manager_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            run_lease_checks()
+        except Exception as e:
+            print(f"Lease check failed: {e}")
+
+
+def start_lease_manager(interval=LEASE_INTERVAL):
+    """Starts the background lease checks once per process."""
+    global _manager_started
+    with _manager_lock:
+        if _manager_started:
+            return
+        _manager_started = True
+    threading.Thread(target=_manager_loop, args=(interval,), daemon=True).start()
@@ -0,0 +1,85 @@
+# Append-only trace of container lifecycle events (requests, admissions, provisions, state
+# changes, resizes, usage samples) for replaying against other policies in simulator.py
+import json
+import os
+import shutil
+import threading
+import time
+
+import psutil
+
+TRACE_FILE = 'lifecycle.jsonl'
+# One rotated generation is kept next to the live file (lifecycle.jsonl.1)
+TRACE_MAX_BYTES = 64 * 1024 * 1024
+# Usage samples are written this often per running container
+SAMPLE_EVERY_SECONDS = 15 * 60
+
+_rotate_lock = threading.Lock()
+_last_sample = {'at': 0}
+
+
+def record_event(event, username=None, **fields):
+    """Appends one event line: {"t": epoch, "e": event, "u": user, ...fields}. Never raises."""
+    entry = {'t': round(time.time(), 1), 'e': event}
+    if username is not None:
+        entry['u'] = username
+    for key, value in fields.items():
+        if value is not None:
+            entry[key] = round(value, 3) if isinstance(value, float) else value
+    line = json.dumps(entry, separators=(',', ':')) + '\n'
+    try:
+        _rotate_if_needed()
+        # One write of a short line with O_APPEND: lines from both portals never interleave
+        fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Error writing lifecycle trace: {e}")
+
+
+def _rotate_if_needed():
+    try:
+        if os.path.getsize(TRACE_FILE) < TRACE_MAX_BYTES:
+            return
+    except OSError:
+        return
+    with _rotate_lock:
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) >= TRACE_MAX_BYTES:
+            os.replace(TRACE_FILE, TRACE_FILE + '.1')
+
+
+def record_host():
+    """The host's capacity, so a replay knows what the trace ran on."""
+    record_event('host', cores=os.cpu_count(), ram_gb=round(psutil.virtual_memory().total / 1024**3, 1),
+                 disk_gb=round(shutil.disk_usage('.').total / 1024**3, 1))
+
+
+def record_usage_samples(rates, now=None):
+    """Actual CPU/RAM use of every running container, at most once per SAMPLE_EVERY_SECONDS.
+
+    `rates` is usage.current_rates(): {username: {'cpu_used_h', 'ram_used_gbh', ...}} per hour,
+    i.e. cores and GB in use right now.
+    """
+    now = now or time.time()
+    if now - _last_sample['at'] < SAMPLE_EVERY_SECONDS:
+        return
+    _last_sample['at'] = now
+    for username, r in sorted(rates.items()):
+        if r.get('cpu_alloc_h'):
+            record_event('sample', username, cpu=float(r['cpu_used_h']), ram=float(r['ram_used_gbh']))
+
+
+def read_trace(paths):
+    """Events from trace files (rotated ones first), sorted by time. Bad lines are skipped."""
+    events = []
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    events.sort(key=lambda e: e.get('t', 0))
+    return events
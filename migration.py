@@ -0,0 +1,395 @@
+# Export/import of a user's environment (volume, account, container spec) for moving it between hosts
+#
+#   source$ python3 migration.py export alice                 # live, while alice keeps working
+#   target$ python3 migration.py import http://source:7000/exports/<archive> --no-start
+#   source$ python3 migration.py export alice --base <id> --stop   # short final delta
+#   target$ python3 migration.py import http://source:7000/exports/<delta archive>
+import argparse
+import hashlib
+import io
+import json
+import os
+import secrets
+import socket
+import subprocess
+import tarfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+from mounts import USER_DATA_DIR
+from snapshots import BACKUP_DIR, BACKUP_READ_MBPS, CHUNK_SIZE, chunk_digest, compress_chunk, decompress_chunk
+
+EXPORTS_DIR = os.path.join(BACKUP_DIR, 'exports')
+IMPORTS_DIR = os.path.join(BACKUP_DIR, 'imports')
+ARCHIVE_EXT = '.pdlx'
+DOWNLOAD_BLOCK = 1024 * 1024
+DOWNLOAD_RETRIES = 20
+DOWNLOAD_TIMEOUT = 30
+# Archives carry the password hash and the whole volume: they are only served this long
+EXPORT_TTL_SECONDS = 24 * 3600
+
+
+class _HashingWriter:
+    """File wrapper that checksums the tar stream as it is written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+
+
+def _data_extents(fd, size):
+    """(start, end) ranges holding data; holes of a sparse image are skipped without reading."""
+    extents, offset = [], 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError:  # ENXIO: only a hole is left
+            break
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        extents.append((start, min(end, size)))
+        offset = end
+    return extents
+
+
+def container_spec(username):
+    """What provision_container needs to recreate the user's container elsewhere."""
+    from shared_cluster import get_tenants
+    from utils import get_cpu_grants, get_cpuset_assignments, get_desired_states, get_io_overrides, load_users
+
+    image = os.path.join(USER_DATA_DIR, f"{username}.img")
+    result = subprocess.run(["docker", "inspect", f"{username}_container"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    details = json.loads(result.stdout)[0] if result.returncode == 0 and result.stdout.strip() else None
+    tenant = get_tenants().get(username)
+    if tenant:
+        # A shared-cluster client's own limits are the client's, the allocation is its queue
+        cpus, ram_mb = tenant['cpus'], tenant['ram_mb']
+    elif details:
+        cpus = get_cpu_grants().get(username, details['HostConfig'].get('NanoCpus', 0) / 1e9)
+        ram_mb = details['HostConfig'].get('Memory', 0) // (1024 * 1024)
+    else:
+        raise ValueError(f"{username} has no container to take the resource spec from")
+    labels = (details or {}).get('Config', {}).get('Labels') or {}
+    return {
+        'username': username,
+        'cpus': cpus,
+        'ram_gb': max(1, round(ram_mb / 1024)),
+        'disk_gb': max(1, round(os.path.getsize(image) / 1024**3)),
+        'io_profile': get_io_overrides().get(username) or labels.get('pdl.io_profile', 'standard'),
+        'dedicated_cpus': bool(get_cpuset_assignments().get(username, {}).get('dedicated')),
+        'desired_state': get_desired_states().get(username, {}).get('state', 'running'),
+        # Login password hash; the SSH key pair travels on the volume itself
+        'password_hash': load_users().get(username),
+    }
+
+
+def export_environment(username, base_id=None, stop=False, read_mbps=BACKUP_READ_MBPS):
+    """Writes a user's environment to one archive under EXPORTS_DIR and returns its summary.
+
+    The archive holds the container spec, every compressed chunk with data (named by its
+    position, so an import writes it straight to the image) and the image's chunk manifest
+    last; with base_id only chunks that export didn't carry are included, so
+    the final delta after stop=True is small and the container is down only for that.
+    Reads are throttled while the container runs and at full speed once it is stopped.
+    """
+    from utils import set_desired_state
+
+    image = os.path.join(USER_DATA_DIR, f"{username}.img")
+    if not os.path.exists(image):
+        raise ValueError(f"{username} has no disk image")
+    spec = container_spec(username)
+    base_chunks = set()
+    if base_id:
+        with open(os.path.join(EXPORTS_DIR, f"{base_id}.manifest.json")) as f:
+            base_chunks = {d for d in json.load(f)['chunks'] if d}
+    if stop:
+        subprocess.run(["docker", "stop", f"{username}_container"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        set_desired_state(username, 'stopped')
+        read_mbps = 0
+    subprocess.run(["sync", image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    export_id = f"{username}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}"
+    # The random part makes the download URL a capability: only whoever was handed it can fetch
+    archive_name = f"{export_id}-{secrets.token_hex(16)}{ARCHIVE_EXT}"
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    prune_exports()
+    path = os.path.join(EXPORTS_DIR, archive_name)
+    started = time.time()
+    size = os.path.getsize(image)
+    chunks, included = [None] * ((size + CHUNK_SIZE - 1) // CHUNK_SIZE), set()
+    budget = read_mbps * 1024 * 1024 if read_mbps else 0
+    with open(path + '.tmp', 'wb') as raw:
+        writer = _HashingWriter(raw)
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            _add_bytes(tar, 'spec.json', json.dumps(dict(spec, export_id=export_id, base_id=base_id,
+                                                         source_host=socket.gethostname(), size_bytes=size,
+                                                         chunk_size=CHUNK_SIZE)).encode())
+            fd = os.open(image, os.O_RDONLY)
+            try:
+                wanted = sorted({i for start, end in _data_extents(fd, size)
+                                 for i in range(start // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1)})
+                for index in wanted:
+                    t0 = time.time()
+                    data = os.pread(fd, CHUNK_SIZE, index * CHUNK_SIZE)
+                    os.posix_fadvise(fd, index * CHUNK_SIZE, len(data), os.POSIX_FADV_DONTNEED)
+                    if data.count(0) == len(data):
+                        continue
+                    digest = chunk_digest(data)
+                    chunks[index] = digest
+                    if digest not in base_chunks and digest not in included:
+                        payload, ext = compress_chunk(data)
+                        _add_bytes(tar, f"chunks/{index}-{digest}{ext}", payload)
+                        included.add(digest)
+                    if budget:
+                        time.sleep(max(0.0, len(data) / budget - (time.time() - t0)))
+            finally:
+                os.close(fd)
+            manifest = {'export_id': export_id, 'base_id': base_id, 'size_bytes': size,
+                        'chunk_size': CHUNK_SIZE, 'chunks': chunks}
+            # Last member: an import that sees it knows every chunk arrived
+            _add_bytes(tar, 'manifest.json', json.dumps(manifest).encode())
+    os.replace(path + '.tmp', path)
+    with open(os.path.join(EXPORTS_DIR, f"{export_id}.manifest.json"), 'w') as f:
+        json.dump(manifest, f)
+    with open(path + '.sha256', 'w') as f:
+        f.write(f"{writer.sha256.hexdigest()}  {archive_name}\n")
+    summary = {'export_id': export_id, 'archive': archive_name, 'archive_bytes': writer.size,
+               'chunks': len(included), 'base_id': base_id, 'stopped': stop,
+               'elapsed_s': round(time.time() - started, 1)}
+    print(f"Exported {username} to {archive_name}: {len(included)} chunks, "
+          f"{writer.size / 1024**2:.1f} MB in {summary['elapsed_s']}s")
+    return summary
+
+
+def delete_export(archive_name):
+    """Removes an archive and its checksum; the manifest stays as the base of later deltas."""
+    for name in (archive_name, archive_name + '.sha256', archive_name + '.tmp'):
+        try:
+            os.remove(os.path.join(EXPORTS_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def prune_exports(now=None):
+    """Deletes archives older than EXPORT_TTL_SECONDS."""
+    if not os.path.isdir(EXPORTS_DIR):
+        return
+    now = now or time.time()
+    for name in os.listdir(EXPORTS_DIR):
+        if name.endswith(ARCHIVE_EXT) and now - os.path.getmtime(os.path.join(EXPORTS_DIR, name)) > EXPORT_TTL_SECONDS:
+            delete_export(name)
+            print(f"Deleted expired export {name}")
+
+
+def list_exports():
+    """Archives ready for download, newest first."""
+    if not os.path.isdir(EXPORTS_DIR):
+        return []
+    prune_exports()
+    exports = []
+    for name in os.listdir(EXPORTS_DIR):
+        if name.endswith(ARCHIVE_EXT):
+            path = os.path.join(EXPORTS_DIR, name)
+            exports.append({'archive': name, 'export_id': name[:-len(ARCHIVE_EXT)].rsplit('-', 1)[0],
+                            'bytes': os.path.getsize(path), 'created_at': os.path.getmtime(path),
+                            'expires_at': os.path.getmtime(path) + EXPORT_TTL_SECONDS})
+    return sorted(exports, key=lambda e: e['created_at'], reverse=True)
+
+
+# --- Import ---
+def _download(url, dest):
+    """Fetches url into dest, resuming with a Range request after every dropped connection."""
+    partial = dest + '.part'
+    with urllib.request.urlopen(url + '.sha256', timeout=DOWNLOAD_TIMEOUT) as resp:
+        expected = resp.read().decode().split()[0]
+    for attempt in range(DOWNLOAD_RETRIES):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        request = urllib.request.Request(url, headers={'Range': f"bytes={offset}-"} if offset else {})
+        try:
+            with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as resp:
+                if offset and resp.status != 206:
+                    offset = 0  # the server ignored the range, start over
+                with open(partial, 'ab' if offset else 'wb') as f:
+                    while True:
+                        block = resp.read(DOWNLOAD_BLOCK)
+                        if not block:
+                            break
+                        f.write(block)
+            break
+        except OSError as e:
+            print(f"Download of {url} interrupted at {offset} bytes ({e}), resuming")
+            time.sleep(min(30, 2 ** attempt))
+    else:
+        raise RuntimeError(f"Download of {url} failed after {DOWNLOAD_RETRIES} attempts")
+    sha256 = hashlib.sha256()
+    with open(partial, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BLOCK), b''):
+            sha256.update(block)
+    if sha256.hexdigest() != expected:
+        os.remove(partial)
+        raise RuntimeError(f"Checksum mismatch for {url}, the partial download was discarded")
+    os.replace(partial, dest)
+    return dest
+
+
+def _apply_archive(archive, image):
+    """Rebuilds image from an archive, writing each chunk to <image>.import as it is read.
+
+    Chunks repeated within the archive are copied from where they were written; a delta
+    reads the chunks it doesn't carry from the image its base import left behind.
+    Returns (spec, manifest).
+    """
+    spec = manifest = None
+    written = {}  # digest -> index it was written at
+    tmp = image + '.import'
+    with open(tmp, 'w+b') as out, tarfile.open(archive, mode='r|') as tar:
+        for member in tar:
+            data = tar.extractfile(member).read()
+            if member.name == 'spec.json':
+                spec = json.loads(data)
+            elif member.name == 'manifest.json':
+                manifest = json.loads(data)
+            elif member.name.startswith('chunks/'):
+                if spec is None:
+                    raise RuntimeError(f"{archive} has chunks before its spec")
+                index, _, name = member.name[len('chunks/'):].partition('-')
+                digest, ext = os.path.splitext(name)
+                data = decompress_chunk(data, ext)
+                if chunk_digest(data) != digest:
+                    raise RuntimeError(f"chunk {index} of {spec['export_id']} does not match its hash")
+                out.seek(int(index) * spec['chunk_size'])
+                out.write(data)
+                written.setdefault(digest, int(index))
+        if spec is None or manifest is None:
+            raise RuntimeError(f"{archive} is incomplete")
+
+        base_positions = {}
+        if manifest['base_id']:
+            with open(os.path.join(IMPORTS_DIR, f"{manifest['base_id']}.manifest.json")) as f:
+                base = json.load(f)
+            base_positions = {d: i for i, d in enumerate(base['chunks']) if d}
+            if not os.path.exists(image):
+                raise RuntimeError(f"delta {manifest['export_id']} needs the image of {manifest['base_id']}")
+
+        chunk_size = manifest['chunk_size']
+        old = open(image, 'rb') if base_positions else None
+        try:
+            for index, digest in enumerate(manifest['chunks']):
+                if digest is None or written.get(digest) == index:
+                    continue  # a hole, or written straight from the archive
+                if digest in written:
+                    source, position = out, written[digest]
+                elif digest in base_positions:
+                    source, position = old, base_positions[digest]
+                else:
+                    raise RuntimeError(f"chunk {index} of {manifest['export_id']} is in neither the archive nor its base")
+                source.seek(position * chunk_size)
+                data = source.read(chunk_size)
+                if chunk_digest(data) != digest:
+                    raise RuntimeError(f"chunk {index} of {manifest['export_id']} does not match its hash")
+                out.seek(index * chunk_size)
+                out.write(data)
+        finally:
+            if old:
+                old.close()
+        out.truncate(manifest['size_bytes'])
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, image)
+    with open(os.path.join(IMPORTS_DIR, f"{manifest['export_id']}.manifest.json"), 'w') as f:
+        json.dump(manifest, f)
+    return spec, manifest
+
+
+def _delete_remote(url):
+    """Asks the source host to delete an archive once it has been imported."""
+    try:
+        urllib.request.urlopen(urllib.request.Request(url, method='DELETE'), timeout=DOWNLOAD_TIMEOUT).close()
+    except OSError as e:
+        print(f"Could not delete {url} on the source host ({e}), it expires on its own")
+
+
+def import_environment(source, start=True):
+    """Imports an archive (URL or local path) and, with start=True, relaunches the user's
+    container through provision_container. Returns (success, message)."""
+    from utils import USERS_FILE, load_users, provision_container, set_desired_state
+
+    os.makedirs(IMPORTS_DIR, exist_ok=True)
+    if source.startswith(('http://', 'https://')):
+        archive = _download(source, os.path.join(IMPORTS_DIR, os.path.basename(source)))
+    else:
+        archive = source
+
+    with tarfile.open(archive, mode='r|') as tar:
+        spec = json.loads(tar.extractfile(next(iter(tar))).read())
+    username = spec['username']
+    if subprocess.run(["docker", "inspect", f"{username}_container"], stdout=subprocess.DEVNULL,
+                      stderr=subprocess.DEVNULL).returncode == 0:
+        return False, f"{username} already has a container on this host"
+    image = os.path.join(USER_DATA_DIR, f"{username}.img")
+    if os.path.exists(image) and not spec['base_id']:
+        return False, f"{username} already has a disk image on this host"
+    os.makedirs(USER_DATA_DIR, exist_ok=True)
+    try:
+        spec, manifest = _apply_archive(archive, image)
+    finally:
+        if os.path.exists(image + '.import'):
+            os.remove(image + '.import')
+    if archive != source:
+        # Our downloaded copy holds the password hash and the whole volume
+        os.remove(archive)
+        _delete_remote(source)
+
+    users = load_users()
+    if username not in users and spec.get('password_hash'):
+        users[username] = spec['password_hash']
+        with open(USERS_FILE, 'w') as f:
+            json.dump(users, f)
+
+    if not start:
+        print(f"Staged {username}'s volume from {manifest['export_id']}, import the final delta to start it")
+        return True, "Volume staged"
+    success, msg = provision_container(
+        username, str(spec['cpus']), spec['disk_gb'], f"{spec['ram_gb']}g",
+        io_profile=spec['io_profile'], dedicated_cpus=spec['dedicated_cpus'], keep_keys=True)
+    if success and spec.get('desired_state') == 'stopped':
+        subprocess.run(["docker", "stop", f"{username}_container"], stdout=subprocess.DEVNULL)
+        set_desired_state(username, 'stopped')
+    return success, msg
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move a user's environment between hosts.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    exp = sub.add_parser('export', help="write a user's environment to an archive under backups/exports")
+    exp.add_argument('username')
+    exp.add_argument('--base', help="export id of an earlier export, only chunks it lacks are included")
+    exp.add_argument('--stop', action='store_true', help="stop the container first (final delta)")
+    imp = sub.add_parser('import', help="import an archive from a URL or path")
+    imp.add_argument('source')
+    imp.add_argument('--no-start', action='store_true', help="only stage the volume (a delta follows)")
+    args = parser.parse_args()
+    if args.command == 'export':
+        print(json.dumps(export_environment(args.username, base_id=args.base, stop=args.stop), indent=2))
+    else:
+        success, msg = import_environment(args.source, start=not args.no_start)
+        print(msg)
+        raise SystemExit(0 if success else 1)
+
+
+if __name__ == '__main__':
+    main()
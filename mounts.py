@@ -0,0 +1,207 @@
+# Mount and loop-device state for the user disk images, read from /proc and sysfs
+import glob
+import os
+import subprocess
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+USER_DATA_DIR = os.path.join(os.path.realpath(BASE_DIR), 'user_data')
+MOUNTINFO = '/proc/self/mountinfo'
+SYS_BLOCK = '/sys/block'
+# mounts can change behind our back (admin shell, host reboot), so the index is re-read after this
+MOUNT_INDEX_TTL = 5
+UNMOUNT_RETRIES = 3
+REMOUNT_WORKERS = 4
+
+_index_lock = threading.Lock()
+_index = {'volumes': {}, 'loaded_at': 0}
+
+
+def _unescape(field):
+    """mountinfo escapes space, tab, newline and backslash as octal (\\040 etc.)."""
+    if '\\' not in field:
+        return field
+    out, i = [], 0
+    while i < len(field):
+        if field[i] == '\\' and field[i + 1:i + 4].isdigit():
+            out.append(chr(int(field[i + 1:i + 4], 8)))
+            i += 4
+        else:
+            out.append(field[i])
+            i += 1
+    return ''.join(out)
+
+
+def read_mountinfo(path=MOUNTINFO):
+    """Parses mountinfo into dicts with mount_point, source, fstype, options and device (MAJ:MIN)."""
+    mounts = []
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return mounts
+    for line in lines:
+        # "36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw,errors=continue"
+        pre, sep, post = line.partition(' - ')
+        if not sep:
+            continue
+        fields, tail = pre.split(), post.split()
+        if len(fields) < 5 or len(tail) < 2:
+            continue
+        mounts.append({
+            'device': fields[2],
+            'root': _unescape(fields[3]),
+            'mount_point': _unescape(fields[4]),
+            'options': fields[5] if len(fields) > 5 else '',
+            'fstype': tail[0],
+            'source': _unescape(tail[1]),
+        })
+    return mounts
+
+
+def loop_backing_files():
+    """{'/dev/loopN': backing file} for every attached loop device, from sysfs."""
+    loops = {}
+    for backing in glob.glob(os.path.join(SYS_BLOCK, 'loop*', 'loop', 'backing_file')):
+        try:
+            with open(backing) as f:
+                path = f.read().strip()
+        except OSError:
+            continue
+        if path.endswith(' (deleted)'):
+            path = path[:-len(' (deleted)')]
+        loops['/dev/' + backing.split(os.sep)[-3]] = path
+    return loops
+
+
+def loop_devices_for(image_path):
+    """Every loop device backed by image_path (more than one means a leaked attach)."""
+    image_path = os.path.realpath(image_path)
+    return sorted(dev for dev, backing in loop_backing_files().items()
+                  if os.path.realpath(backing) == image_path)
+
+
+def loop_device_for(image_path):
+    """The /dev/loopN backing a disk image, or None if it isn't attached."""
+    devices = loop_devices_for(image_path)
+    return devices[0] if devices else None
+
+
+def refresh_mount_index():
+    """Rebuilds the index of mounted user volumes: {mount point: {source, image, fstype, options}}."""
+    loops = loop_backing_files()
+    volumes = {}
+    prefix = USER_DATA_DIR + os.sep
+    for m in read_mountinfo():
+        if not m['mount_point'].startswith(prefix):
+            continue
+        volumes[m['mount_point']] = {
+            'source': m['source'],
+            'image': loops.get(m['source']),
+            'fstype': m['fstype'],
+            'options': m['options'],
+        }
+    with _index_lock:
+        _index['volumes'] = volumes
+        _index['loaded_at'] = time.time()
+    return dict(volumes)
+
+
+def get_mounted_volumes():
+    """The mounted user volumes, re-read from /proc when the index is older than MOUNT_INDEX_TTL."""
+    with _index_lock:
+        if time.time() - _index['loaded_at'] < MOUNT_INDEX_TTL:
+            return dict(_index['volumes'])
+    return refresh_mount_index()
+
+
+def is_mounted(path):
+    """Exact mount-point match (unlike `mount | grep`, /data/bob doesn't match /data/bobby)."""
+    path = os.path.realpath(path)
+    if path.startswith(USER_DATA_DIR + os.sep):
+        return path in get_mounted_volumes()
+    return any(m['mount_point'] == path for m in read_mountinfo())
+
+
+def mount_image(image_path, mount_point):
+    """Loop-mounts a disk image (no-op when already mounted). Returns True once mounted."""
+    mount_point = os.path.realpath(mount_point)
+    if is_mounted(mount_point):
+        return True
+    os.makedirs(mount_point, exist_ok=True)
+    # Requires sudo usually, but if you run python as root it works.
+    subprocess.run(["sudo", "mount", "-o", "loop", image_path, mount_point], check=True)
+    # Fix permissions so the user can write to it
+    subprocess.run(["sudo", "chmod", "777", mount_point], check=True)
+    refresh_mount_index()
+    return True
+
+
+def detach_loops(image_path):
+    """Detaches loop devices still attached to an image (after unmount, or leaked ones)."""
+    for device in loop_devices_for(image_path):
+        subprocess.run(["sudo", "losetup", "-d", device], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def unmount(mount_point, image_path=None):
+    """Unmounts a user volume and frees its loop device. Returns (success, message).
+
+    No lazy unmount: a busy mount is retried and then reported, so callers never delete
+    the mount point (or the image) while a process still has files open on it.
+    """
+    mount_point = os.path.realpath(mount_point)
+    info = get_mounted_volumes().get(mount_point, {})
+    image_path = image_path or info.get('image')
+    error = ''
+    for attempt in range(UNMOUNT_RETRIES):
+        if not is_mounted(mount_point):
+            break
+        result = subprocess.run(["sudo", "umount", mount_point], stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, text=True)
+        refresh_mount_index()
+        if result.returncode == 0:
+            break
+        error = result.stdout.strip()
+        time.sleep(1)
+    if is_mounted(mount_point):
+        return False, f"{mount_point} is busy: {error}"
+    if image_path:
+        detach_loops(image_path)
+    return True, "Unmounted"
+
+
+def detach_stale_loops():
+    """Detaches loop devices backed by user images that are not mounted anywhere."""
+    mounted_sources = {m['source'] for m in read_mountinfo()}
+    detached = []
+    for device, backing in loop_backing_files().items():
+        if os.path.dirname(os.path.realpath(backing)) == USER_DATA_DIR and device not in mounted_sources:
+            subprocess.run(["sudo", "losetup", "-d", device], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            detached.append(device)
+    return detached
+
+
+def remount_user_volumes(usernames, workers=REMOUNT_WORKERS):
+    """Mounts the given users' disk images in parallel (e.g. after a host reboot).
+
+    Returns {username: error message} for the volumes that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    failures = {}
+
+    def remount(username):
+        image = os.path.join(USER_DATA_DIR, f"{username}.img")
+        if not os.path.exists(image):
+            return username, "no disk image"
+        try:
+            mount_image(image, os.path.join(USER_DATA_DIR, username))
+        except (subprocess.CalledProcessError, OSError) as e:
+            return username, str(e)
+        return username, None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for username, error in pool.map(remount, usernames):
+            if error:
+                failures[username] = error
+    return failures
@@ -0,0 +1,192 @@
+# Shared pip/apt/Maven/Ivy caches, read-only under a per-user overlay in every user container
+import os
+import re
+import shutil
+import subprocess
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_CACHE_DIR = os.path.join(BASE_DIR, 'package_cache')
+
+# Host sub-directory -> mount point in the container. The in-container paths are also
+# baked into the image (pip.conf, mavenrc, spark.jars.ivy) so they work with the cache off.
+CACHE_MOUNTS = {
+    'apt/archives': '/var/cache/apt/archives',
+    'apt/lists': '/var/lib/apt/lists',
+    'pip': '/var/cache/pdl/pip',
+    'maven': '/var/cache/pdl/maven',
+    'ivy': '/var/cache/pdl/ivy',
+}
+
+# Written by the apt hook in Dockerfile.hadoop after every dpkg run, lives on the user volume
+APT_MANIFEST = '/data/.pdl/apt-manual.txt'
+APT_REPLAY_LOG = '/data/.pdl/apt-replay.log'
+# Per-user writable layer over each shared cache, on the user volume so it counts against their disk
+OVERLAY_DIR = '.pdl/cache'
+
+# Names accepted by the refresh job, everything else in a manifest is skipped
+APT_PACKAGE_RE = re.compile(r'^[a-z0-9][a-z0-9.+-]*(:[a-z0-9-]+)?$')
+PIP_REQUIREMENT_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*(\[[A-Za-z0-9,._-]+\])?([<>=!~]=?[A-Za-z0-9.*+!_-]+)?$')
+
+
+def ensure_package_cache():
+    """Creates the shared cache directories, root-owned and only written by refresh_package_cache()."""
+    for sub in CACHE_MOUNTS:
+        path = os.path.join(PACKAGE_CACHE_DIR, sub)
+        os.makedirs(path, exist_ok=True)
+        os.chmod(path, 0o755)
+        if sub.startswith('apt/'):
+            os.makedirs(os.path.join(path, 'partial'), exist_ok=True)
+    return PACKAGE_CACHE_DIR
+
+
+def _volume_name(username, sub):
+    return f"pdl_cache_{username}_{sub.replace('/', '_')}"
+
+
+def package_cache_flags(username, user_data_path):
+    """docker run -v flags mounting the shared caches read-only under a per-user overlay.
+
+    The shared directory is the overlay's lower layer, so nothing a tenant does (sudo included)
+    reaches it; writes, apt lock files and new downloads land in the user's own upper layer.
+    A cache whose overlay volume can't be created is left out rather than mounted shared.
+    """
+    ensure_package_cache()
+    flags = []
+    for sub, target in CACHE_MOUNTS.items():
+        layer = os.path.join(user_data_path, OVERLAY_DIR, sub.replace('/', '_'))
+        upper, work = os.path.join(layer, 'upper'), os.path.join(layer, 'work')
+        os.makedirs(work, exist_ok=True)
+        if not os.path.isdir(upper):
+            os.makedirs(upper)
+            # Becomes the merged directory's mode, the container user writes pip/maven caches
+            os.chmod(upper, 0o1777)
+        name = _volume_name(username, sub)
+        try:
+            subprocess.run(["docker", "volume", "create", "--driver", "local",
+                            "--opt", "type=overlay", "--opt", "device=overlay",
+                            "--opt", f"o=lowerdir={os.path.join(PACKAGE_CACHE_DIR, sub)},upperdir={upper},workdir={work}",
+                            name], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            print(f"Warning: could not create cache overlay {name}, {target} starts empty")
+            continue
+        flags += ["-v", f"{name}:{target}"]
+    return flags
+
+
+def remove_package_cache_volumes(usernames):
+    """Drops the overlay volumes of deleted containers (the upper layers stay on the user volume)."""
+    for username in usernames:
+        for sub in CACHE_MOUNTS:
+            subprocess.run(["docker", "volume", "rm", "-f", _volume_name(username, sub)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+
+def _manifest_packages(user_data_dir):
+    """Union of the users' recorded apt packages, limited to well-formed package names."""
+    packages = set()
+    if not os.path.isdir(user_data_dir):
+        return packages
+    for entry in os.listdir(user_data_dir):
+        manifest = os.path.join(user_data_dir, entry, APT_MANIFEST[len('/data/'):])
+        try:
+            with open(manifest) as f:
+                packages.update(line.strip() for line in f if APT_PACKAGE_RE.match(line.strip()))
+        except OSError:
+            continue
+    return packages
+
+
+def refresh_package_cache(pip_packages=()):
+    """Fills the shared caches from a throwaway container, the only writer they have.
+
+    Downloads (without installing) every apt package in the users' manifests plus the pip
+    requirements the admin listed. Users only choose package names this way, the files
+    themselves come from the image's configured mirrors through apt's signature checks.
+    Returns (success, message).
+    """
+    ensure_package_cache()
+    bad = [p for p in pip_packages if not PIP_REQUIREMENT_RE.match(p)]
+    if bad:
+        return False, f"Invalid pip requirement: {bad[0]}"
+    apt_packages = sorted(_manifest_packages(os.path.join(BASE_DIR, 'user_data')))
+    mounts = []
+    for sub, target in CACHE_MOUNTS.items():
+        mounts += ["-v", f"{os.path.join(PACKAGE_CACHE_DIR, sub)}:{target}"]
+    # Fixed name, so docker itself refuses a second refresh while one is running
+    base = ["docker", "run", "--rm", "--name", "pdl_cache_refresh", "--entrypoint", "bash", *mounts,
+            "hadoop_container", "-c"]
+    # Package names go in as arguments, never into the script text
+    # One unavailable package must not stop the rest, so fall back to fetching them one by one
+    jobs = [("apt-get update || exit 1; "
+             "apt-get install -y --download-only --no-install-recommends \"$@\" || "
+             "for p in \"$@\"; do apt-get install -y --download-only --no-install-recommends \"$p\" || true; done",
+             apt_packages)]
+    if pip_packages:
+        jobs.append(('pip download -q -d "$(mktemp -d)" "$@"', list(pip_packages)))
+    for script, args in jobs:
+        try:
+            subprocess.run(base + [script, "bash", *args], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            return False, (e.stderr or b'').decode(errors='replace').strip()[-500:] or str(e)
+    return True, f"Cached {len(apt_packages)} apt and {len(pip_packages)} pip packages"
+
+
+def replay_apt_manifest(container_name):
+    """Reinstalls the user's manually installed apt packages in the background.
+
+    The manifest survives on /data when a container is deleted and recreated; once
+    refresh_package_cache() has fetched the .debs they are already local, so nothing is downloaded.
+    """
+    script = (
+        f"[ -s {APT_MANIFEST} ] || exit 0; "
+        f"missing=$(comm -23 <(sort -u {APT_MANIFEST}) <(apt-mark showmanual | sort -u)); "
+        f"[ -n \"$missing\" ] || exit 0; "
+        f"(apt-get install -y --no-install-recommends $missing || "
+        f"(apt-get update && apt-get install -y --no-install-recommends $missing)) > {APT_REPLAY_LOG} 2>&1"
+    )
+    subprocess.run(["docker", "exec", "-d", container_name, "bash", "-c", script],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+
+def directory_disk_usage(path, seen=None):
+    """Bytes on disk under path, each inode counted once (hard links, or across calls via seen)."""
+    seen = set() if seen is None else seen
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def get_package_cache_usage():
+    """Bytes on disk per shared cache, a file hard-linked into two caches is counted once."""
+    seen = set()
+    return {sub: directory_disk_usage(os.path.join(PACKAGE_CACHE_DIR, sub), seen) for sub in CACHE_MOUNTS}
+
+
+def purge_package_cache(sub):
+    """Empties one cache directory (contents only, the mount point stays valid)."""
+    if sub not in CACHE_MOUNTS:
+        raise ValueError(f"Unknown package cache: {sub}")
+    path = os.path.join(PACKAGE_CACHE_DIR, sub)
+    if not os.path.isdir(path):
+        return
+    for entry in os.listdir(path):
+        full = os.path.join(path, entry)
+        if os.path.isdir(full) and not os.path.islink(full):
+            shutil.rmtree(full, ignore_errors=True)
+        else:
+            try:
+                os.remove(full)
+            except OSError:
+                pass
+    if sub.startswith('apt/'):
+        os.makedirs(os.path.join(path, 'partial'), exist_ok=True)
@@ -0,0 +1,231 @@
+# CPU rebalancer: moves CPU quota from idle to busy shared-pool containers based on the
+# usage and throttling their cgroups report, without exceeding what was granted in total
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+
+from shared_cluster import get_tenants
+from usage import get_usage_ledger
+from utils import get_all_containers_details, get_container_usage, get_cpuset_assignments, get_global_limits
+
+REBALANCE_FILE = 'rebalance.json'
+REBALANCE_INTERVAL = 30
+# A container is busy when it uses this share of its quota or is throttled this often
+BUSY_USAGE_FRACTION = 0.9
+BUSY_THROTTLED_FRACTION = 0.2
+# Busy containers ask for this much more than they use; idle ones keep this much headroom
+GROWTH_FACTOR = 1.5
+IDLE_HEADROOM = 1.25
+# Smaller changes are not worth a docker update
+MIN_CHANGE_CPUS = 0.1
+QUOTA_STEP = 0.05
+MIN_QUOTA_CPUS = 0.25
+
+# cgroup v2 (systemd and cgroupfs drivers), then v1
+CGROUP_CPU_PATHS = (
+    '/sys/fs/cgroup/system.slice/docker-{id}.scope',
+    '/sys/fs/cgroup/docker/{id}',
+    '/sys/fs/cgroup/cpu,cpuacct/system.slice/docker-{id}.scope',
+    '/sys/fs/cgroup/cpu,cpuacct/docker/{id}',
+)
+
+_rebalancer_lock = threading.Lock()
+_rebalancer_started = False
+
+
+def get_rebalance_state():
+    """{container name: {granted, current, used, throttled, at}} from the last pass."""
+    if not os.path.exists(REBALANCE_FILE):
+        return {}
+    try:
+        with open(REBALANCE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _save_rebalance_state(state):
+    with open(REBALANCE_FILE, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f, indent=4)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_cpu_counters(container_id):
+    """Cumulative CPU time (µs) and CFS period/throttle counts of a container, None without cgroup access."""
+    for template in CGROUP_CPU_PATHS:
+        path = template.format(id=container_id)
+        try:
+            with open(os.path.join(path, 'cpu.stat')) as f:
+                stat = dict(line.split() for line in f if len(line.split()) == 2)
+        except OSError:
+            continue
+        counters = {'nr_periods': int(stat.get('nr_periods', 0)), 'nr_throttled': int(stat.get('nr_throttled', 0))}
+        if 'usage_usec' in stat:
+            counters['usage_usec'] = int(stat['usage_usec'])
+        else:
+            # cgroup v1 keeps the CPU time (ns) in cpuacct
+            try:
+                with open(os.path.join(path, 'cpuacct.usage')) as f:
+                    counters['usage_usec'] = int(f.read()) // 1000
+            except (OSError, ValueError):
+                continue
+        return counters
+    return None
+
+
+def _bounds(granted, pool_size, limits):
+    low = max(MIN_QUOTA_CPUS, granted * limits['rebalance_min_fraction'])
+    high = max(granted, min(granted * limits['rebalance_max_factor'], pool_size))
+    return low, high
+
+
+def plan_quotas(containers, budget):
+    """New --cpus per container from {name: {granted, low, high, used, throttled, current}}.
+
+    Everyone first gets what they use (plus headroom) up to their own grant; the quota
+    that frees up is lent to busy containers in proportion to what they ask for, and
+    whatever nobody asked for goes back towards the grants.
+    """
+    target, plan = {}, {}
+    for name, c in containers.items():
+        busy = c['used'] >= BUSY_USAGE_FRACTION * c['current'] or c['throttled'] >= BUSY_THROTTLED_FRACTION
+        wanted = max(c['current'], c['used']) * GROWTH_FACTOR if busy else c['used'] * IDLE_HEADROOM
+        target[name] = min(max(wanted, c['low']), c['high'])
+        plan[name] = min(target[name], c['granted'])
+
+    spare = budget - sum(plan.values())
+    wants = {name: target[name] - plan[name] for name in plan if target[name] > plan[name]}
+    if spare > 0 and wants:
+        share = min(1.0, spare / sum(wants.values()))
+        for name, want in wants.items():
+            plan[name] += want * share
+        spare -= sum(wants.values()) * share
+    below = {name: c['granted'] - plan[name] for name, c in containers.items() if plan[name] < c['granted']}
+    if spare > 0 and below:
+        share = min(1.0, spare / sum(below.values()))
+        for name, gap in below.items():
+            plan[name] += gap * share
+    return {name: round(round(cpus / QUOTA_STEP) * QUOTA_STEP, 2) for name, cpus in plan.items()}
+
+
+def _set_quota(container_name, cpus, granted):
+    # Shares weigh containers by their grant when the pool's cores are contended
+    result = subprocess.run(["docker", "update", "--cpus", str(cpus), "--cpu-shares", str(int(1024 * granted)),
+                             container_name], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(f"Rebalancer: could not set {container_name} to {cpus} CPUs: {result.stderr.strip()}")
+    return result.returncode == 0
+
+
+def run_rebalance():
+    """One pass: measures, plans and applies. Returns the new state."""
+    limits = get_global_limits()
+    previous = get_rebalance_state()
+    now = time.time()
+    assignments = get_cpuset_assignments()
+    clients = {u for u, t in get_tenants().items() if t.get('queue_state') == 'RUNNING'}
+    throttled = set(get_usage_ledger()['throttled'])
+    stats = None
+
+    state, candidates, left_alone = {}, {}, set()
+    for c in get_all_containers_details():
+        name = c['Names']
+        if not name.endswith('_container'):
+            continue
+        username = name[:-len('_container')]
+        current = round(c['CPUs'], 2)
+        record = dict(previous.get(name) or {})
+        # Provisioning and resizes record the grant, the live quota may be one of our loans
+        record.update(granted=round(c['GrantedCPUs'], 2), current=current)
+        state[name] = record
+        # Dedicated cores are the container's own, clients run their work on the shared cluster
+        # and a quota throttle (usage.py) owns its container's quota until it is released
+        if username in clients or username in throttled or assignments.get(username, {}).get('dedicated'):
+            left_alone.add(name)
+        if c['Status'].lower() != 'running' or name in left_alone or current <= 0:
+            # A restart starts a new cgroup, its counters begin at zero again
+            record = {'granted': record['granted'], 'current': current, 'used': None, 'throttled': None}
+            state[name] = record
+            continue
+
+        counters = read_cpu_counters(c['ID'])
+        used, throttled_ratio = None, 0.0
+        if counters and 'usage_usec' in record and now > record.get('at', now):
+            used = (counters['usage_usec'] - record['usage_usec']) / 1e6 / (now - record['at'])
+            periods = counters['nr_periods'] - record.get('nr_periods', 0)
+            if periods > 0:
+                throttled_ratio = (counters['nr_throttled'] - record.get('nr_throttled', 0)) / periods
+        elif counters is None:
+            # No cgroup access (e.g. rootless docker): docker stats has usage but no throttling
+            if stats is None:
+                stats = get_container_usage()
+            used = stats.get(name, {}).get('cpu_cores')
+        if counters:
+            record.update(counters)
+        record.update(at=now, used=None if used is None else round(max(used, 0.0), 3),
+                      throttled=round(throttled_ratio, 3))
+        if used is not None:
+            candidates[name] = record
+
+    if limits['rebalance_enabled'] and len(candidates) > 1:
+        pool_size = max(1, (os.cpu_count() or 1) - 2 - sum(
+            len(a['cpus']) for a in assignments.values() if a['dedicated']))
+        budget = min(sum(r['granted'] for r in candidates.values()), pool_size)
+        plan = plan_quotas({
+            name: dict(r, low=low, high=high)
+            for name, r in candidates.items()
+            for low, high in [_bounds(r['granted'], pool_size, limits)]
+        }, budget)
+        # Lower quotas first so the total never exceeds the budget in between
+        for name in sorted(plan, key=lambda n: plan[n] - candidates[n]['current']):
+            if abs(plan[name] - candidates[name]['current']) >= MIN_CHANGE_CPUS:
+                if _set_quota(name, plan[name], candidates[name]['granted']):
+                    candidates[name]['current'] = plan[name]
+    elif not limits['rebalance_enabled']:
+        # Switched off: every container we may have lent quota to goes back to its grant
+        for name, record in state.items():
+            if name in left_alone:
+                continue
+            if record['current'] != record['granted'] and _set_quota(name, record['granted'], record['granted']):
+                record['current'] = record['granted']
+
+    _save_rebalance_state(state)
+    return state
+
+
+def _rebalance_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            run_rebalance()
+        except Exception as e:
+            print(f"Rebalance failed: {e}")
+
+
+def start_rebalancer(interval=REBALANCE_INTERVAL):
+    """Starts the background rebalancer once per process."""
+    global _rebalancer_started
+    with _rebalancer_lock:
+        if _rebalancer_started:
+            return
+        _rebalancer_started = True
+    threading.Thread(target=_rebalance_loop, args=(interval,), daemon=True).start()
+
+
+def render_rebalance_metrics():
+    """Granted and current CPU quota per container in the Prometheus text format."""
+    state = get_rebalance_state()
+    lines = ["# HELP pdl_container_cpu_granted CPUs granted to the container (its --cpus before rebalancing)",
+             "# TYPE pdl_container_cpu_granted gauge"]
+    lines += [f'pdl_container_cpu_granted{{container="{n}"}} {r["granted"]}' for n, r in sorted(state.items())]
+    lines += ["# HELP pdl_container_cpu_quota CPU quota currently set by the rebalancer",
+              "# TYPE pdl_container_cpu_quota gauge"]
+    lines += [f'pdl_container_cpu_quota{{container="{n}"}} {r["current"]}' for n, r in sorted(state.items())]
+    return "\n".join(lines) + "\n"
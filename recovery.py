@@ -0,0 +1,142 @@
+# Host-reboot recovery: remount user volumes and bring intended-running containers back
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+
+from mounts import USER_DATA_DIR, detach_stale_loops, remount_user_volumes
+from ssh_gateway import ensure_ssh_gateway, sync_routes
+from utils import get_all_containers_details, get_desired_states, get_hibernated, fast_restart_container
+
+RECOVERY_FILE = 'recovery.json'
+# Each restart already runs its daemons in parallel; this bounds how many containers boot at once
+RECOVERY_WORKERS = 8
+# A run still marked in progress after this long is assumed dead even if its PID is in use
+RECOVERY_TIMEOUT = 2 * 3600
+
+_recovery_lock = threading.Lock()
+
+
+def _recovery_alive(summary):
+    """Whether the process that marked a recovery in progress is still running it."""
+    if time.time() - summary.get('started_at', 0) > RECOVERY_TIMEOUT:
+        return False
+    try:
+        # A PID reused after a reboot or crash belongs to a process started later
+        return psutil.Process(summary['pid']).create_time() <= summary['started_at']
+    except (KeyError, psutil.Error):
+        return False
+
+
+def get_last_recovery():
+    """The summary of the last (or running) recovery, {} if none ran yet.
+
+    A run left 'in_progress' by a portal that crashed or was restarted is reported
+    as 'interrupted', so a new one can be started.
+    """
+    if not os.path.exists(RECOVERY_FILE):
+        return {}
+    try:
+        with open(RECOVERY_FILE, 'r') as f:
+            summary = json.load(f)
+    except Exception:
+        return {}
+    if summary.get('status') == 'in_progress' and not _recovery_alive(summary):
+        summary['status'] = 'interrupted'
+    return summary
+
+
+def _save_recovery(summary):
+    with open(RECOVERY_FILE, 'w') as f:
+        json.dump(summary, f, indent=4)
+
+
+def discover_user_environments():
+    """({username: container details} for every *_container, set of usernames with a disk image)."""
+    containers = {c['Names'][:-len('_container')]: c for c in get_all_containers_details()
+                  if c['Names'].endswith('_container')}
+    images = set()
+    if os.path.isdir(USER_DATA_DIR):
+        images = {f[:-len('.img')] for f in os.listdir(USER_DATA_DIR) if f.endswith('.img')}
+    return containers, images
+
+
+def recover_host(workers=RECOVERY_WORKERS):
+    """Reconciles the host with the desired state after a reboot (or any time an admin asks).
+
+    Leaked loop devices are detached, volumes of every user with a container are
+    remounted, and containers whose desired state is 'running' are fast-restarted
+    with their daemons, at most `workers` at a time. Users without a desired-state
+    record (provisioned before it existed) are treated as running. Hibernated and
+    stopped containers are left alone, and so are containers that are already running.
+    """
+    if not _recovery_lock.acquire(blocking=False):
+        return get_last_recovery()
+    try:
+        started_at = time.time()
+        _save_recovery({'status': 'in_progress', 'started_at': started_at, 'pid': os.getpid()})
+        containers, images = discover_user_environments()
+
+        stale_loops = detach_stale_loops()
+        mount_failures = remount_user_volumes(sorted(set(containers) & images), workers)
+
+        desired = get_desired_states()
+        hibernated = get_hibernated()
+        to_restart, skipped, already_running = [], {}, []
+        for username in sorted(containers):
+            state = desired.get(username, {}).get('state', 'running')
+            if username in hibernated:
+                skipped[username] = 'hibernated'
+            elif state != 'running':
+                skipped[username] = state
+            elif containers[username]['Status'].lower() == 'running':
+                # fast_restart would leave its one-shot skip flag behind for the next real start
+                already_running.append(username)
+            elif username not in mount_failures:
+                to_restart.append(username)
+
+        def restart(username):
+            try:
+                return username, fast_restart_container(username)
+            except Exception as e:
+                return username, (False, str(e))
+
+        restarted, failed = [], {u: f"volume: {e}" for u, e in mount_failures.items()}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for username, (success, msg) in pool.map(restart, to_restart):
+                if success:
+                    restarted.append(username)
+                else:
+                    failed[username] = msg
+        # Addresses change across a reboot, and containers left stopped must not keep a stale route
+        try:
+            ensure_ssh_gateway()
+            sync_routes()
+        except Exception as e:
+            print(f"Could not sync SSH gateway routes: {e}")
+
+        summary = {
+            'status': 'done',
+            'started_at': started_at,
+            'elapsed_s': round(time.time() - started_at, 1),
+            'containers': len(containers),
+            'volumes_mounted': len(set(containers) & images) - len(mount_failures),
+            'stale_loops_detached': stale_loops,
+            'restarted': restarted,
+            'already_running': already_running,
+            'skipped': skipped,
+            'failed': failed,
+            # Disks whose container was deleted, kept for the user but not mounted
+            'unattached_images': sorted(images - set(containers)),
+        }
+        _save_recovery(summary)
+        print(f"Recovery finished in {summary['elapsed_s']}s: {len(restarted)} restarted, "
+              f"{len(already_running)} already running, {len(skipped)} left stopped, {len(failed)} failed")
+        for username, msg in failed.items():
+            print(f"  recovery failed for {username}: {msg}")
+        return summary
+    finally:
+        _recovery_lock.release()
@@ -0,0 +1,330 @@
+# Shared multi-tenant HDFS/YARN/Kafka cluster with lightweight per-user client containers
+import fcntl
+import json
+import math
+import os
+import subprocess
+import threading
+import time
+
+from datasets import dataset_mount_flags
+from hadoop_config import (SHORT_JVM, ConfigProfile, JVM_OVERHEAD, OS_RESERVE_MB, compute_hadoop_sizing,
+                           deliver_config_bundle, docker_env_flags)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARED_CLUSTER_FILE = 'shared_cluster.json'
+SHARED_CLUSTER_CONTAINER = 'pdl_shared_cluster'
+SHARED_CLUSTER_DIR = os.path.join(BASE_DIR, 'shared_cluster')
+SHARED_NETWORK = 'pdl_net'
+# Network alias clients resolve; Hadoop URIs reject the underscore in the container name
+SHARED_CLUSTER_HOST = 'pdl-shared-cluster'
+SHARED_FS = f'hdfs://{SHARED_CLUSTER_HOST}:9000'
+SHARED_SERVICES = ('hdfs', 'yarn', 'zookeeper', 'kafka')
+# Client containers only run sshd, shells and the Spark/MapReduce driver
+CLIENT_MAX_CPUS = 1.0
+# Read by entrypoint.sh on every start, so a client never starts a daemon stack of its own
+CLIENT_MODE_MARKER = '/data/.pdl/client_mode'
+
+_cluster_lock = threading.Lock()
+
+
+# --- Tenant registry ---
+def get_tenants():
+    """{username: {cpus, ram_mb, quota_gb, queue_state}}; queue_state None means HDFS data only."""
+    if not os.path.exists(SHARED_CLUSTER_FILE):
+        return {}
+    try:
+        with open(SHARED_CLUSTER_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _update_tenants(update):
+    """Applies update(tenants) under a file lock and returns the new registry."""
+    with open(SHARED_CLUSTER_FILE, 'a+') as f:
+        # Both portals provision and delete
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        tenants = json.loads(raw) if raw.strip() else {}
+        update(tenants)
+        f.seek(0)
+        f.truncate()
+        json.dump(tenants, f, indent=4)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return tenants
+
+
+def is_shared_client(username):
+    """True while the user's container is a client of the shared cluster."""
+    return get_tenants().get(username, {}).get('queue_state') == 'RUNNING'
+
+
+# --- Cluster state and sizing ---
+def _cluster_exec(script, check=False):
+    return subprocess.run(["docker", "exec", SHARED_CLUSTER_CONTAINER, "bash", "-c", SHORT_JVM + script],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=check)
+
+
+def get_cluster_state():
+    """The shared cluster container's status ('running', 'exited', ...) or None if it doesn't exist."""
+    result = subprocess.run(["docker", "inspect", "-f", "{{.State.Status}}", SHARED_CLUSTER_CONTAINER],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return (result.stdout.strip() or None) if result.returncode == 0 else None
+
+
+def get_cluster_limits():
+    """(cpus, ram_mb) of the running cluster container, or the configured size before it exists.
+
+    Queue shares are computed against what the cluster actually has; a new size from
+    the settings page only applies when the cluster container is recreated.
+    """
+    from utils import get_global_limits
+    result = subprocess.run(
+        ["docker", "inspect", "-f", "{{.HostConfig.NanoCpus}} {{.HostConfig.Memory}}", SHARED_CLUSTER_CONTAINER],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    values = result.stdout.split()
+    if result.returncode == 0 and len(values) == 2 and all(v.isdigit() and int(v) for v in values):
+        return int(values[0]) / 1e9, int(values[1]) // (1024 * 1024)
+    limits = get_global_limits()
+    return float(limits['shared_cluster_cpus']), int(float(limits['shared_cluster_ram_gb']) * 1024)
+
+
+def compute_queues(tenants, cluster_cpus, cluster_ram_mb):
+    """Capacity-scheduler queues from the users' CPU/RAM allocations.
+
+    A user's share is the dominant one of their CPUs and RAM against what the cluster's
+    NodeManager offers. Their allocation is the queue's maximum capacity; the guaranteed
+    capacity is the same share, scaled down evenly when allocations oversubscribe the cluster.
+    """
+    sizing = compute_hadoop_sizing(cluster_cpus, cluster_ram_mb, services=SHARED_SERVICES)
+    yarn_mb = sizing['yarn']['yarn.nodemanager.resource.memory-mb']
+    vcores = sizing['yarn']['yarn.nodemanager.resource.cpu-vcores']
+    # Hundredths of a percent, so the capacities add up to exactly 100
+    shares = {}
+    for name, t in sorted(tenants.items()):
+        if t.get('queue_state') in ('RUNNING', 'STOPPED'):
+            share = max(float(t['cpus']) / vcores, int(t['ram_mb']) / yarn_mb)
+            shares[name] = max(1, min(10000, int(share * 10000)))
+    running = sum(s for n, s in shares.items() if tenants[n]['queue_state'] == 'RUNNING')
+    scale = min(1.0, 10000 / running) if running else 1.0
+    queues = []
+    for name, share in shares.items():
+        state = tenants[name]['queue_state']
+        capacity = int(share * scale) if state == 'RUNNING' else 0
+        queues.append((name, f"{capacity / 100:.2f}", f"{share / 100:.2f}", state, name))
+    return tuple(queues)
+
+
+def shared_cluster_profile(tenants=None):
+    """ConfigProfile of the shared cluster: every daemon, bound for clients, with the tenants' queues."""
+    cpus, ram_mb = get_cluster_limits()
+    tenants = get_tenants() if tenants is None else tenants
+    return ConfigProfile.for_limits(cpus, ram_mb, services=SHARED_SERVICES, default_fs=SHARED_FS, extra=(
+        # Clients reach the daemons over pdl_net, the readiness probes over loopback
+        ('hdfs-site.xml', 'dfs.namenode.rpc-bind-host', '0.0.0.0'),
+        ('hdfs-site.xml', 'dfs.namenode.http-bind-host', '0.0.0.0'),
+        ('yarn-site.xml', 'yarn.resourcemanager.hostname', SHARED_CLUSTER_HOST),
+        ('yarn-site.xml', 'yarn.resourcemanager.bind-host', '0.0.0.0'),
+        ('yarn-site.xml', 'yarn.nodemanager.bind-host', '0.0.0.0'),
+        ('yarn-site.xml', 'yarn.acl.enable', 'true'),
+        ('yarn-site.xml', 'yarn.admin.acl', 'root'),
+    ), queues=compute_queues(tenants, cpus, ram_mb))
+
+
+def client_profile(cpus, ram_mb):
+    """ConfigProfile of a client container: no daemons, Spark/MapReduce sized for the user's queue."""
+    return ConfigProfile.for_limits(cpus, ram_mb, services=(), default_fs=SHARED_FS, extra=(
+        ('yarn-site.xml', 'yarn.resourcemanager.hostname', SHARED_CLUSTER_HOST),
+    ))
+
+
+def client_container_limits(cpus, ram_mb):
+    """(cpus, ram_mb) of the client container itself: the driver JVM plus the OS reserve."""
+    driver_mb = compute_hadoop_sizing(cpus, ram_mb, services=())['driver_mb']
+    client_mb = math.ceil((driver_mb * JVM_OVERHEAD + OS_RESERVE_MB) / 256) * 256
+    return min(float(cpus), CLIENT_MAX_CPUS), min(int(ram_mb), client_mb)
+
+
+def host_footprint(cpus, ram_gb):
+    """(cpus, ram GB) a new container commits on the host, for the admission checks."""
+    from utils import get_global_limits
+    if not get_global_limits()['shared_cluster_enabled']:
+        return float(cpus), float(ram_gb)
+    client_cpus, client_mb = client_container_limits(cpus, int(float(ram_gb) * 1024))
+    return client_cpus, client_mb / 1024
+
+
+def client_docker_flags():
+    """docker run flags putting a client on the cluster network, with Kafka/ZooKeeper addresses."""
+    return ["--network", SHARED_NETWORK, "--label", "pdl.mode=client",
+            "-e", f"PDL_KAFKA_BOOTSTRAP={SHARED_CLUSTER_HOST}:9092",
+            "-e", f"PDL_ZOOKEEPER_CONNECT={SHARED_CLUSTER_HOST}:2181"]
+
+
+def container_ip(details):
+    """A container's address from its docker inspect details: the default bridge, else pdl_net
+    (the shared cluster and its clients are only attached there), None when it has none."""
+    settings = details.get('NetworkSettings') or {}
+    networks = settings.get('Networks') or {}
+    for name in ('bridge', SHARED_NETWORK):
+        if (networks.get(name) or {}).get('IPAddress'):
+            return networks[name]['IPAddress']
+    return settings.get('IPAddress') or None
+
+
+# --- Cluster lifecycle ---
+def ensure_network():
+    if subprocess.run(["docker", "network", "inspect", SHARED_NETWORK],
+                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+        subprocess.run(["docker", "network", "create", SHARED_NETWORK],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+
+def ensure_shared_cluster():
+    """Creates or starts the shared cluster and waits until HDFS is out of safe mode.
+
+    Safe to call concurrently (provisioning, recovery workers): one caller does the
+    work, the others wait for it. Raises RuntimeError if the services don't come up.
+    """
+    from utils import (HADOOP_SERVICES, get_running_services, prepare_hdfs_volume, probe_service_ports,
+                       start_services, wait_for_services)
+    with _cluster_lock:
+        state = get_cluster_state()
+        ports = {p for s in SHARED_SERVICES for p in HADOOP_SERVICES[s]['ports']}
+        if state == 'running' and ports <= probe_service_ports(SHARED_CLUSTER_CONTAINER, ports):
+            return False
+        ensure_network()
+        os.makedirs(SHARED_CLUSTER_DIR, exist_ok=True)
+        if state != 'running':
+            # Same one-shot flag as user containers: the daemons start below, after the config
+            open(os.path.join(SHARED_CLUSTER_DIR, '.skip_service_start'), 'w').close()
+        profile = shared_cluster_profile()
+        if state is None:
+            print(f"Creating shared cluster ({profile.cpus:g} CPUs, {profile.ram_mb} MB)...")
+            sizing = compute_hadoop_sizing(profile.cpus, profile.ram_mb, services=SHARED_SERVICES)
+            subprocess.run([
+                "docker", "run", "-d",
+                "--name", SHARED_CLUSTER_CONTAINER,
+                "--hostname", SHARED_CLUSTER_HOST,
+                "--network", SHARED_NETWORK,
+                "--network-alias", SHARED_CLUSTER_HOST,
+                "--cpus", str(profile.cpus),
+                "--memory", f"{profile.ram_mb}m",
+                "--label", "pdl.mode=shared_cluster",
+                *docker_env_flags(sizing),
+                # YARN containers run here, so jobs read the dataset catalog from this mount
+                *dataset_mount_flags(),
+                "-v", f"{SHARED_CLUSTER_DIR}:/data",
+                "hadoop_container"
+            ], check=True)
+        elif state != 'running':
+            subprocess.run(["docker", "start", SHARED_CLUSTER_CONTAINER], stdout=subprocess.DEVNULL, check=True)
+
+        deliver_config_bundle(SHARED_CLUSTER_CONTAINER, profile)
+        prepare_hdfs_volume(SHARED_CLUSTER_CONTAINER)
+        deadline = time.time() + 10
+        while 22 not in probe_service_ports(SHARED_CLUSTER_CONTAINER, [22]) and time.time() < deadline:
+            time.sleep(0.2)
+        running = get_running_services(SHARED_CLUSTER_CONTAINER)
+        start_services(SHARED_CLUSTER_CONTAINER, [s for s in HADOOP_SERVICES if s in SHARED_SERVICES and s not in running])
+        not_ready = wait_for_services(SHARED_CLUSTER_CONTAINER, list(SHARED_SERVICES))
+        if not_ready:
+            raise RuntimeError(f"Shared cluster services failed to start: {', '.join(not_ready)}")
+        # MapReduce stages job files under /tmp, every tenant needs to write there
+        _cluster_exec("hdfs dfsadmin -safemode wait > /dev/null && hdfs dfs -mkdir -p /tmp /user && "
+                      "hdfs dfs -chmod 1777 /tmp", check=True)
+        return True
+
+
+def apply_queues(tenants=None):
+    """Re-renders the cluster config with the current tenants and reloads the scheduler queues."""
+    deliver_config_bundle(SHARED_CLUSTER_CONTAINER, shared_cluster_profile(tenants))
+    result = _cluster_exec("yarn rmadmin -refreshQueues")
+    if result.returncode != 0:
+        print(f"Queue refresh failed: {result.stdout.strip()}")
+    return result.returncode == 0
+
+
+# --- Tenants ---
+def register_tenant(username, cpus, ram_mb, quota_gb):
+    """Gives a user their HDFS home with a space quota and a queue sized from their allocation."""
+    ensure_shared_cluster()
+    tenants = _update_tenants(lambda t: t.update({username: {
+        'cpus': float(cpus), 'ram_mb': int(ram_mb), 'quota_gb': int(float(quota_gb)),
+        'queue_state': 'RUNNING', 'updated_at': time.time()}}))
+    # The space quota counts replicated bytes; the cluster keeps one replica
+    _cluster_exec(f"hdfs dfs -mkdir -p /user/{username} && hdfs dfs -chown {username}:{username} /user/{username} && "
+                  f"hdfs dfsadmin -setSpaceQuota {int(float(quota_gb))}g /user/{username}", check=True)
+    if not apply_queues(tenants):
+        raise RuntimeError(f"Could not create the YARN queue for {username}")
+
+
+def resize_tenant(username, cpus, ram_mb):
+    """Resizes a tenant's queue, e.g. when their lease ends. False if the scheduler refused it."""
+    def resize(tenants):
+        if username in tenants:
+            tenants[username].update({'cpus': float(cpus), 'ram_mb': int(ram_mb), 'updated_at': time.time()})
+    return apply_queues(_update_tenants(resize))
+
+
+def release_tenants(usernames):
+    """Removes the users' queues (their HDFS homes stay, like a deleted container's volume).
+
+    The capacity scheduler only deletes stopped queues: they are stopped first, and
+    if one still drains running applications it stays stopped until the next release.
+    """
+    usernames = [u for u in usernames if u in get_tenants()]
+    if not usernames:
+        return
+
+    def stop(t):
+        for name in usernames:
+            if name in t:
+                t[name]['queue_state'] = 'STOPPED'
+
+    def drop(t):
+        for tenant in t.values():
+            if tenant.get('queue_state') == 'STOPPED':
+                tenant['queue_state'] = None
+
+    if get_cluster_state() != 'running':
+        # No applications to drain; the queues are rendered from the registry on the next start
+        _update_tenants(lambda t: (stop(t), drop(t)))
+        return
+    apply_queues(_update_tenants(stop))
+    tenants = {name: dict(t) for name, t in get_tenants().items()}
+    drop(tenants)
+    if apply_queues(tenants):
+        _update_tenants(drop)
+    else:
+        # Still draining: keep them stopped (with no guaranteed capacity) in the live config
+        apply_queues()
+
+
+def delete_tenant_data(username):
+    """Deletes a user's HDFS home and forgets them (the shared-mode half of deleting their disk)."""
+    if username not in get_tenants():
+        return
+    release_tenants([username])
+    if get_cluster_state() == 'running':
+        _cluster_exec(f"hdfs dfs -rm -r -f -skipTrash /user/{username}")
+    _update_tenants(lambda t: t.pop(username, None))
+
+
+def get_cluster_overview():
+    """Status, services and per-tenant queue capacity for the admin page."""
+    from utils import get_running_services
+    state = get_cluster_state()
+    cpus, ram_mb = get_cluster_limits()
+    tenants = get_tenants()
+    queues = {q[0]: {'capacity': q[1], 'max_capacity': q[2]} for q in compute_queues(tenants, cpus, ram_mb)}
+    return {
+        'state': state or 'not created',
+        'services': get_running_services(SHARED_CLUSTER_CONTAINER) if state == 'running' else [],
+        'cpus': cpus,
+        'ram_gb': round(ram_mb / 1024, 1),
+        'tenants': {name: {**t, **queues.get(name, {})} for name, t in sorted(tenants.items())},
+    }
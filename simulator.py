@@ -0,0 +1,468 @@
+# Capacity planning: replays a recorded lifecycle trace (lifecycle_trace.py) against admission,
+# overcommit and idle-reclaim policies and reports acceptance, waiting time and utilization
+#
+#   python3 simulator.py                                          # today's policy on lifecycle.jsonl
+#   python3 simulator.py --admission headroom:cores=4,ram=16 --compare
+#   python3 simulator.py --overcommit factor:cpu=1.5 --reclaim idle:minutes=120 --max-wait-minutes 30 --compare
+#   python3 simulator.py --plugin my_policies --admission mine:limit=3   # policies registered by a module
+import argparse
+import heapq
+import importlib
+import itertools
+import json
+import os
+import statistics
+
+from lifecycle_trace import TRACE_FILE, read_trace
+
+POLICIES = {'admission': {}, 'overcommit': {}, 'reclaim': {}}
+# What the portals do today: get_available_resources' headroom, no overcommit, no reclaim
+DEFAULT_POLICIES = {'admission': 'headroom', 'overcommit': 'none', 'reclaim': 'none'}
+# Requests the live host turned away have no recorded run time; without a single finished
+# session to take the median from they run this long
+FALLBACK_SESSION_HOURS = 24
+REJECT_REASONS = ('capacity', 'cpu', 'ram', 'disk')
+
+
+def register_policy(kind, name):
+    """Class decorator adding a policy under `name`; plugin modules use it too."""
+    def register(cls):
+        POLICIES[kind][name] = cls
+        cls.name = name
+        return cls
+    return register
+
+
+class Policy:
+    """Base for policies: PARAMS holds the defaults, a spec like "name:key=val,..." overrides them."""
+    PARAMS = {}
+
+    def __init__(self, **params):
+        unknown = set(params) - set(self.PARAMS)
+        if unknown:
+            raise ValueError(f"{self.name} has no parameter {', '.join(sorted(unknown))}")
+        for key, default in self.PARAMS.items():
+            setattr(self, key, type(default)(params.get(key, default)))
+
+    def describe(self):
+        params = ','.join(f"{key}={getattr(self, key)}" for key in self.PARAMS)
+        return f"{self.name}:{params}" if params else self.name
+
+
+def make_policy(kind, spec):
+    name, _, params = spec.partition(':')
+    if name not in POLICIES[kind]:
+        raise ValueError(f"Unknown {kind} policy '{name}' (known: {', '.join(sorted(POLICIES[kind]))})")
+    pairs = [p.split('=', 1) for p in params.split(',') if p]
+    if any(len(p) != 2 for p in pairs):
+        raise ValueError(f"Bad {kind} policy spec '{spec}', expected name:key=value,...")
+    return POLICIES[kind][name](**dict(pairs))
+
+
+@register_policy('admission', 'headroom')
+class HeadroomAdmission(Policy):
+    """get_available_resources: the host minus a fixed amount kept for the OS and daemons."""
+    PARAMS = {'cores': 2.0, 'ram': 10.0, 'disk': 50.0}
+
+    def capacity(self, host):
+        return {'cpu': host['cores'] - self.cores, 'ram': host['ram_gb'] - self.ram, 'disk': host['disk_gb'] - self.disk}
+
+    def admits(self, request, allocated, host, factors):
+        capacity = self.capacity(host)
+        return (allocated['cpu'] + request['cpu'] <= capacity['cpu'] * factors['cpu']
+                and allocated['ram'] + request['ram'] <= capacity['ram'] * factors['ram']
+                and allocated['disk'] + request['disk'] <= capacity['disk'])
+
+
+@register_policy('admission', 'fraction')
+class FractionAdmission(HeadroomAdmission):
+    """Keeps a share of the host free instead of fixed amounts."""
+    PARAMS = {'cpu': 0.9, 'ram': 0.85, 'disk': 0.9}
+
+    def capacity(self, host):
+        return {'cpu': host['cores'] * self.cpu, 'ram': host['ram_gb'] * self.ram, 'disk': host['disk_gb'] * self.disk}
+
+
+@register_policy('overcommit', 'none')
+class NoOvercommit(Policy):
+    """Allocations count against the host one to one."""
+
+    def factors(self):
+        return {'cpu': 1.0, 'ram': 1.0}
+
+
+@register_policy('overcommit', 'factor')
+class FactorOvercommit(Policy):
+    """Admits up to `cpu`/`ram` times what the admission policy leaves for containers."""
+    PARAMS = {'cpu': 2.0, 'ram': 1.0}
+
+    def factors(self):
+        return {'cpu': self.cpu, 'ram': self.ram}
+
+
+@register_policy('reclaim', 'none')
+class NoReclaim(Policy):
+    """Containers hold their allocation until they are stopped."""
+
+    def on_sample(self, key, cpu, now):
+        return None
+
+
+@register_policy('reclaim', 'idle')
+class IdleReclaim(Policy):
+    """Hibernates containers using less than `cpu` cores for `minutes`; they wake when busy again."""
+    PARAMS = {'minutes': 60.0, 'cpu': 0.05}
+
+    def __init__(self, **params):
+        super().__init__(**params)
+        self._idle_since = {}
+
+    def on_sample(self, key, cpu, now):
+        if cpu >= self.cpu:
+            self._idle_since.pop(key, None)
+            return 'wake'
+        since = self._idle_since.setdefault(key, now)
+        return 'reclaim' if now - since >= self.minutes * 60 else None
+
+
+def build_sessions(events):
+    """Sessions from the trace: what each user asked for and, relative to its provisioning, what
+    their container did after (start, stop, resize, usage samples, delete) and when their disk
+    was deleted, which can be long after the container.
+
+    Returns (sessions, host, skipped); skipped counts requests no capacity policy decides on.
+    """
+    host, sessions, pending, live, latest = None, [], {}, {}, {}
+    skipped = {'quota': 0, 'denied': 0, 'failed': 0}
+    for e in events:
+        kind, username, t = e.get('e'), e.get('u'), e.get('t', 0)
+        if kind == 'host':
+            host = {'cores': e['cores'], 'ram_gb': e['ram_gb'], 'disk_gb': e['disk_gb']}
+        elif kind == 'request':
+            pending[username] = {'user': username, 'kind': e.get('kind', 'standard'), 'arrival': t,
+                                 'cpu': e['cpu'], 'ram': e['ram'], 'disk': e['disk'], 'steps': []}
+        elif kind == 'deny':
+            if pending.pop(username, None):
+                skipped['denied'] += 1
+        elif kind == 'reject':
+            session = pending.pop(username, None)
+            if session and e.get('reason') in REJECT_REASONS:
+                # Demand the host turned away: replayed, with the median run time
+                if session['kind'] == 'special':
+                    session['arrival'] = t
+                session['observed'] = False
+                sessions.append(session)
+            elif session and e.get('reason') == 'quota':
+                skipped['quota'] += 1
+        elif kind == 'provision':
+            session = pending.pop(username, None)
+            if not e.get('ok'):
+                skipped['failed'] += 1
+                continue
+            session = session or {'user': username, 'kind': 'standard', 'arrival': t}
+            if session['kind'] == 'special':
+                # The admin's delay is not the policy's: approved requests arrive when provisioned
+                session['arrival'] = t
+            session.update(cpu=e['cpu'], ram=e['ram'], disk=e['disk'], start=t, steps=[], observed=True)
+            live[username] = latest[username] = session
+            sessions.append(session)
+        elif kind == 'disk_delete':
+            # The disk outlives the container until /delete_disk, like get_available_resources counts it
+            session = latest.pop(username, None)
+            if session:
+                session['steps'].append((t - session['start'], 'disk_delete', None))
+        elif username in live:
+            session = live[username]
+            offset = t - session['start']
+            if kind == 'state':
+                if e.get('s') == 'deleted':
+                    session['steps'].append((offset, 'end', None))
+                    del live[username]
+                else:
+                    session['steps'].append((offset, 'run' if e.get('s') == 'running' else 'stop', None))
+            elif kind in ('resize', 'sample'):
+                session['steps'].append((offset, kind, {'cpu': e['cpu'], 'ram': e['ram']}))
+
+    durations = [offset for s in sessions if s.get('observed')
+                 for offset, action, _ in s['steps'] if action == 'end']
+    median = statistics.median(durations) if durations else FALLBACK_SESSION_HOURS * 3600
+    for session in sessions:
+        if not session.get('observed'):
+            # Turned-away demand has no disk history either: its disk goes with the container
+            session['steps'] = [(median, 'end', None), (median, 'disk_delete', None)]
+    sessions.sort(key=lambda s: s['arrival'])
+    return sessions, host, skipped
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def simulate(sessions, host, admission, overcommit, reclaim, start, end, max_wait=0, backfill=False):
+    """Event-driven replay of the sessions between start and end under the given policies.
+
+    Requests that don't fit wait up to max_wait seconds (in arrival order, or any that fits with
+    backfill). Restarts of a stopped or reclaimed container are not admission-checked, like
+    fast_restart; the time the host spends over its size is reported instead. A user's disk is
+    held from their first admission until its disk_delete, a new container reuses it.
+    """
+    factors = overcommit.factors()
+    allocated = {'cpu': 0.0, 'ram': 0.0, 'disk': 0.0}
+    used = {'cpu': 0.0, 'ram': 0.0}
+    state = [{'held': False, 'running': False, 'reclaimed_at': None, 'sample': None,
+              'cpu': s['cpu'], 'ram': s['ram']} for s in sessions]
+    totals = dict.fromkeys(('cpu_alloc', 'ram_alloc', 'cpu_used', 'ram_used', 'cpu_over', 'ram_over',
+                            'reclaimed_cpu', 'reclaimed_ram'), 0.0)
+    peaks = {'cpu': 0.0, 'ram': 0.0, 'disk': 0.0}
+    disks = {}  # username -> GB held
+    waits, queue, outcome = [], [], {'rejected': 0, 'abandoned': 0}
+    heap, order = [], itertools.count()
+    clock = {'t': start}
+
+    def push(t, action, index, data=None):
+        heapq.heappush(heap, (t, next(order), action, index, data))
+
+    def advance(t):
+        dt = max(t - clock['t'], 0)
+        totals['cpu_alloc'] += allocated['cpu'] * dt
+        totals['ram_alloc'] += allocated['ram'] * dt
+        totals['cpu_used'] += used['cpu'] * dt
+        totals['ram_used'] += used['ram'] * dt
+        if allocated['cpu'] > host['cores']:
+            totals['cpu_over'] += dt
+        if allocated['ram'] > host['ram_gb']:
+            totals['ram_over'] += dt
+        clock['t'] = max(t, clock['t'])
+
+    def hold(index, held):
+        st = state[index]
+        if st['held'] == held:
+            return
+        sign = 1 if held else -1
+        st['held'] = held
+        allocated['cpu'] += sign * st['cpu']
+        allocated['ram'] += sign * st['ram']
+        if st['sample']:
+            used['cpu'] += sign * st['sample']['cpu']
+            used['ram'] += sign * st['sample']['ram']
+        peaks['cpu'] = max(peaks['cpu'], allocated['cpu'])
+        peaks['ram'] = max(peaks['ram'], allocated['ram'])
+
+    def settle_reclaim(index, t):
+        st = state[index]
+        if st['reclaimed_at'] is not None:
+            totals['reclaimed_cpu'] += st['cpu'] * (t - st['reclaimed_at'])
+            totals['reclaimed_ram'] += st['ram'] * (t - st['reclaimed_at'])
+            st['reclaimed_at'] = None
+
+    def demand(index):
+        session = sessions[index]
+        return dict(session, disk=0) if session['user'] in disks else session
+
+    def admit(index, t):
+        session = sessions[index]
+        waits.append(t - session['arrival'])
+        if session['user'] not in disks:
+            disks[session['user']] = session['disk']
+            allocated['disk'] += session['disk']
+            peaks['disk'] = max(peaks['disk'], allocated['disk'])
+        state[index]['running'] = True
+        hold(index, True)
+        for offset, action, data in session['steps']:
+            if t + offset <= end:
+                push(t + offset, action, index, data)
+
+    def drain(t):
+        for index in list(queue):
+            if admission.admits(demand(index), allocated, host, factors):
+                queue.remove(index)
+                admit(index, t)
+            elif not backfill:
+                break
+
+    for index, session in enumerate(sessions):
+        if start <= session['arrival'] <= end:
+            push(session['arrival'], 'arrive', index)
+
+    while heap:
+        t, _, action, index, data = heapq.heappop(heap)
+        advance(t)
+        st = state[index]
+        if action == 'arrive':
+            if (not queue or backfill) and admission.admits(demand(index), allocated, host, factors):
+                admit(index, t)
+            elif max_wait > 0:
+                queue.append(index)
+                push(t + max_wait, 'give_up', index)
+            else:
+                outcome['rejected'] += 1
+        elif action == 'give_up':
+            if index in queue:
+                queue.remove(index)
+                outcome['abandoned'] += 1
+        elif action == 'run':
+            settle_reclaim(index, t)
+            st['running'] = True
+            hold(index, True)
+        elif action == 'stop':
+            settle_reclaim(index, t)
+            st['running'] = False
+            hold(index, False)
+            drain(t)
+        elif action == 'resize':
+            held = st['held']
+            hold(index, False)
+            st['cpu'], st['ram'] = data['cpu'], data['ram']
+            hold(index, held)
+            drain(t)
+        elif action == 'sample':
+            held = st['held']
+            hold(index, False)
+            st['sample'] = data
+            hold(index, held)
+            decision = reclaim.on_sample(index, data['cpu'], t) if st['running'] else None
+            if decision == 'reclaim' and st['held']:
+                hold(index, False)
+                st['reclaimed_at'] = t
+                drain(t)
+            elif decision == 'wake' and st['reclaimed_at'] is not None:
+                settle_reclaim(index, t)
+                hold(index, True)
+        elif action == 'end':
+            settle_reclaim(index, t)
+            st['running'] = False
+            hold(index, False)
+            drain(t)
+        elif action == 'disk_delete':
+            allocated['disk'] -= disks.pop(sessions[index]['user'], 0)
+            drain(t)
+
+    advance(end)
+    for index in range(len(sessions)):
+        settle_reclaim(index, end)
+    hours = max(end - start, 1) / 3600
+    replayed = len(waits) + outcome['rejected'] + outcome['abandoned'] + len(queue)
+    return {
+        'policies': {'admission': admission.describe(), 'overcommit': overcommit.describe(),
+                     'reclaim': reclaim.describe(), 'max_wait_minutes': max_wait / 60, 'backfill': backfill},
+        'host': host,
+        'hours': round(hours, 1),
+        'requests': replayed,
+        'admitted': len(waits),
+        'rejected': outcome['rejected'],
+        'abandoned': outcome['abandoned'],
+        'still_waiting': len(queue),
+        'acceptance_rate': round(len(waits) / replayed, 3) if replayed else None,
+        'wait_mean_minutes': round(statistics.mean(waits) / 60, 1) if waits else None,
+        'wait_p50_minutes': round(_percentile(waits, 50) / 60, 1) if waits else None,
+        'wait_p95_minutes': round(_percentile(waits, 95) / 60, 1) if waits else None,
+        'cpu_allocated_pct': round(totals['cpu_alloc'] / 3600 / hours / host['cores'] * 100, 1),
+        'ram_allocated_pct': round(totals['ram_alloc'] / 3600 / hours / host['ram_gb'] * 100, 1),
+        # Only containers with usage samples count here
+        'cpu_used_pct': round(totals['cpu_used'] / 3600 / hours / host['cores'] * 100, 1),
+        'ram_used_pct': round(totals['ram_used'] / 3600 / hours / host['ram_gb'] * 100, 1),
+        'peak_allocated_cpus': round(peaks['cpu'], 2),
+        'peak_allocated_ram_gb': round(peaks['ram'], 1),
+        'peak_allocated_disk_gb': round(peaks['disk'], 1),
+        'cpu_over_host_hours': round(totals['cpu_over'] / 3600, 2),
+        'ram_over_host_hours': round(totals['ram_over'] / 3600, 2),
+        'reclaimed_cpu_hours': round(totals['reclaimed_cpu'] / 3600, 1),
+        'reclaimed_ram_gb_hours': round(totals['reclaimed_ram'] / 3600, 1),
+    }
+
+
+REPORT_ROWS = [
+    ('requests replayed', 'requests'), ('admitted', 'admitted'), ('rejected', 'rejected'),
+    ('gave up waiting', 'abandoned'), ('still waiting at end', 'still_waiting'),
+    ('acceptance rate', 'acceptance_rate'), ('wait mean (min)', 'wait_mean_minutes'),
+    ('wait p50 (min)', 'wait_p50_minutes'), ('wait p95 (min)', 'wait_p95_minutes'),
+    ('CPU allocated %', 'cpu_allocated_pct'), ('RAM allocated %', 'ram_allocated_pct'),
+    ('CPU used %', 'cpu_used_pct'), ('RAM used %', 'ram_used_pct'),
+    ('peak CPUs', 'peak_allocated_cpus'), ('peak RAM GB', 'peak_allocated_ram_gb'),
+    ('peak disk GB', 'peak_allocated_disk_gb'), ('hours CPU > host', 'cpu_over_host_hours'),
+    ('hours RAM > host', 'ram_over_host_hours'), ('reclaimed CPU-h', 'reclaimed_cpu_hours'),
+    ('reclaimed RAM GB-h', 'reclaimed_ram_gb_hours'),
+]
+
+
+def print_report(results, skipped, baseline=None):
+    host = results['host']
+    print(f"host: {host['cores']} cores, {host['ram_gb']} GB RAM, {host['disk_gb']} GB disk; "
+          f"{results['hours']} hours replayed")
+    print(f"not replayed: {skipped['quota']} over quota, {skipped['denied']} denied by the admin, "
+          f"{skipped['failed']} failed provisioning")
+    runs = [('baseline', baseline), ('candidate', results)] if baseline else [('policy', results)]
+    for label, run in runs:
+        p = run['policies']
+        print(f"{label}: admission {p['admission']}, overcommit {p['overcommit']}, reclaim {p['reclaim']}, "
+              f"max wait {p['max_wait_minutes']:g} min{', backfill' if p['backfill'] else ''}")
+    print()
+    print(f"{'':<22}" + ''.join(f"{label:>12}" for label, _ in runs))
+    for label, key in REPORT_ROWS:
+        print(f"{label:<22}" + ''.join(f"{'-' if run[key] is None else run[key]:>12}" for _, run in runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a lifecycle trace against capacity policies.")
+    parser.add_argument('--trace', nargs='+', help=f"trace files (default: {TRACE_FILE}.1 and {TRACE_FILE})")
+    parser.add_argument('--admission', default=DEFAULT_POLICIES['admission'], help="admission policy spec")
+    parser.add_argument('--overcommit', default=DEFAULT_POLICIES['overcommit'], help="overcommit policy spec")
+    parser.add_argument('--reclaim', default=DEFAULT_POLICIES['reclaim'], help="idle-reclaim policy spec")
+    parser.add_argument('--max-wait-minutes', type=float, default=0,
+                        help="how long a request that doesn't fit waits for capacity (0: rejected, as today)")
+    parser.add_argument('--backfill', action='store_true', help="admit later requests that fit past a waiting one")
+    parser.add_argument('--compare', action='store_true', help="also replay today's policy and show both")
+    parser.add_argument('--plugin', action='append', default=[],
+                        help="module to import first, registering more policies with register_policy")
+    parser.add_argument('--host-cores', type=float, help="replay on a host of this size instead of the recorded one")
+    parser.add_argument('--host-ram-gb', type=float)
+    parser.add_argument('--host-disk-gb', type=float)
+    parser.add_argument('--list', action='store_true', help="list the registered policies and their parameters")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    for module in args.plugin:
+        importlib.import_module(module)
+    if args.list:
+        for kind, policies in POLICIES.items():
+            for name, cls in sorted(policies.items()):
+                params = ', '.join(f"{k}={v}" for k, v in cls.PARAMS.items())
+                print(f"{kind:<11}{name:<10}{params:<32}{(cls.__doc__ or '').strip()}")
+        return
+
+    paths = args.trace or [p for p in (TRACE_FILE + '.1', TRACE_FILE) if os.path.exists(p)]
+    if not paths:
+        parser.error(f"no trace found; the portals write {TRACE_FILE} in their working directory")
+    events = read_trace(paths)
+    if not events:
+        parser.error(f"no events in {', '.join(paths)}")
+    sessions, host, skipped = build_sessions(events)
+    host = dict(host or {})
+    for key, value in (('cores', args.host_cores), ('ram_gb', args.host_ram_gb), ('disk_gb', args.host_disk_gb)):
+        if value is not None:
+            host[key] = value
+    if set(host) != {'cores', 'ram_gb', 'disk_gb'}:
+        parser.error("the trace has no host record; give --host-cores, --host-ram-gb and --host-disk-gb")
+    start, end = events[0]['t'], events[-1]['t']
+    max_wait = args.max_wait_minutes * 60
+
+    try:
+        candidate = [make_policy(kind, getattr(args, kind)) for kind in ('admission', 'overcommit', 'reclaim')]
+    except ValueError as e:
+        parser.error(str(e))
+    results = simulate(sessions, host, *candidate, start, end, max_wait, args.backfill)
+    baseline = None
+    if args.compare:
+        current = [make_policy(kind, DEFAULT_POLICIES[kind]) for kind in ('admission', 'overcommit', 'reclaim')]
+        baseline = simulate(sessions, host, *current, start, end)
+    print_report(results, skipped, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'candidate': results, 'baseline': baseline, 'skipped': skipped}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,505 @@
+# Incremental, deduplicated and compressed snapshots of the user disk images
+import fcntl
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from mounts import USER_DATA_DIR, is_mounted
+from package_cache import directory_disk_usage
+
+try:
+    import zstandard
+except ImportError:  # chunks are written with zlib instead, restores of .zst chunks need the package
+    zstandard = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKUP_DIR = os.path.join(os.path.realpath(BASE_DIR), 'backups')
+CHUNKS_DIR = os.path.join(BACKUP_DIR, 'chunks')
+MANIFESTS_DIR = os.path.join(BACKUP_DIR, 'manifests')
+# Images renamed here by a delete are snapshotted once more, then removed
+PENDING_DIR = os.path.join(BACKUP_DIR, 'pending')
+# Point-in-time reflink copies, read at leisure and removed after the snapshot
+STAGING_DIR = os.path.join(BACKUP_DIR, 'staging')
+RESTORES_DIR = os.path.join(BACKUP_DIR, 'restores')
+JOBS_FILE = os.path.join(BACKUP_DIR, 'jobs.json')
+LOCK_FILE = os.path.join(BACKUP_DIR, '.lock')
+
+CHUNK_SIZE = 4 * 1024 * 1024
+ZSTD_LEVEL = 3
+# Reads are paced to this rate and dropped from the page cache, so running containers
+# keep their disk bandwidth and cached data
+BACKUP_READ_MBPS = 40
+SNAPSHOT_INTERVAL = 24 * 3600
+SCHEDULER_CHECK_INTERVAL = 600
+# Retention per user: the newest KEEP_LAST, plus the newest of each of the last KEEP_DAILY
+# days and KEEP_WEEKLY weeks. Snapshots of deleted disks are kept DELETED_RETENTION_DAYS.
+KEEP_LAST = 3
+KEEP_DAILY = 7
+KEEP_WEEKLY = 4
+DELETED_RETENTION_DAYS = 30
+JOB_HISTORY = 20
+
+_ZERO_CHUNK = bytes(CHUNK_SIZE)
+_local_lock = threading.Lock()
+_pending_lock = threading.Lock()
+_scheduler_lock = threading.Lock()
+_scheduler_started = False
+
+
+class _BackupLock:
+    """One backup job at a time, across threads and both portal processes."""
+
+    def __enter__(self):
+        _local_lock.acquire()
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        self.f = open(LOCK_FILE, 'a+')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        _local_lock.release()
+
+
+def _chunk_path(digest):
+    return os.path.join(CHUNKS_DIR, digest[:2], digest)
+
+
+def _stored_chunk(digest):
+    """Path of an existing chunk in either codec, None if it isn't stored yet."""
+    for ext in ('.zst', '.zz'):
+        path = _chunk_path(digest) + ext
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def compress_chunk(data):
+    """(payload, extension naming the codec) of one chunk."""
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), '.zst'
+    return zlib.compress(data, 6), '.zz'
+
+
+def decompress_chunk(payload, ext):
+    if ext == '.zz':
+        return zlib.decompress(payload)
+    if zstandard is None:
+        raise RuntimeError("chunk is zstd-compressed, install the zstandard package to read it")
+    return zstandard.ZstdDecompressor().decompress(payload, max_output_size=CHUNK_SIZE)
+
+
+def _decompress(path):
+    with open(path, 'rb') as f:
+        return decompress_chunk(f.read(), os.path.splitext(path)[1])
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# --- Manifests ---
+def list_snapshots(username=None):
+    """{username: [manifest summaries, oldest first]} (chunk lists left out)."""
+    result = {}
+    if not os.path.isdir(MANIFESTS_DIR):
+        return result
+    for user in sorted(os.listdir(MANIFESTS_DIR)):
+        if username and user != username:
+            continue
+        snaps = []
+        for name in sorted(os.listdir(os.path.join(MANIFESTS_DIR, user))):
+            if name.endswith('.json'):
+                manifest = load_manifest(user, name[:-len('.json')])
+                if manifest:
+                    snaps.append({k: v for k, v in manifest.items() if k != 'chunks'})
+        if snaps:
+            result[user] = snaps
+    return result
+
+
+def load_manifest(username, snapshot_id):
+    try:
+        with open(os.path.join(MANIFESTS_DIR, username, f"{snapshot_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _latest_manifest(username):
+    snaps = list_snapshots(username).get(username)
+    return load_manifest(username, snaps[-1]['id']) if snaps else None
+
+
+def _record_job(job):
+    try:
+        with open(JOBS_FILE, 'r') as f:
+            jobs = json.load(f)
+    except (OSError, ValueError):
+        jobs = []
+    jobs = ([job] + jobs)[:JOB_HISTORY]
+    _write_atomic(JOBS_FILE, json.dumps(jobs, indent=4).encode())
+
+
+def get_jobs():
+    """The last JOB_HISTORY snapshot, restore and pruning results, newest first."""
+    try:
+        with open(JOBS_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+# --- Snapshot ---
+def _point_in_time_copy(username, image, mount_point):
+    """A reflink clone of the image (instant on XFS/btrfs), None where reflinks aren't supported.
+
+    A mounted filesystem is frozen for the clone, which flushes it and holds its writers
+    for the few milliseconds the clone takes, so the copy is clean rather than merely
+    crash-consistent. Without fsfreeze it is synced instead and ext4 replays its journal.
+    """
+    frozen = False
+    if mount_point:
+        frozen = subprocess.run(["fsfreeze", "-f", mount_point],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+        if not frozen:
+            subprocess.run(["sync", "-f", mount_point], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        subprocess.run(["sync", image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.makedirs(STAGING_DIR, exist_ok=True)
+        clone = os.path.join(STAGING_DIR, f"{username}.img")
+        result = subprocess.run(["cp", "--reflink=always", image, clone],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        if frozen:
+            subprocess.run(["fsfreeze", "-u", mount_point], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        if os.path.exists(clone):
+            os.remove(clone)
+        return None
+    return clone
+
+
+def _container_state(username):
+    """'<running> <started at>' of the user's container, empty when it doesn't exist."""
+    result = subprocess.run(["docker", "inspect", "-f", "{{.State.Running}} {{.State.StartedAt}}",
+                             f"{username}_container"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return result.stdout.strip()
+
+
+def _low_io_priority():
+    """Lowest best-effort I/O priority for the calling thread (honoured by BFQ/CFQ). Not the
+    idle class: under steady container I/O that would starve the backup indefinitely."""
+    subprocess.run(["ionice", "-c", "2", "-n", "7", "-p", str(threading.get_native_id())],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def create_snapshot(username, image=None, reason='scheduled', read_mbps=BACKUP_READ_MBPS):
+    """Backs up a user's disk image and returns the new manifest (None if nothing changed).
+
+    The image is read in CHUNK_SIZE chunks at most read_mbps. Only chunks whose hash
+    differs from the previous snapshot's are compressed, and each distinct content is
+    stored once across all users. All-zero chunks are not stored.
+
+    Without reflinks a mounted image is only read while its container is stopped; with
+    the container running the snapshot is put off (None, and a failed job unless scheduled).
+    """
+    image = image or os.path.join(USER_DATA_DIR, f"{username}.img")
+    with _BackupLock():
+        st = os.stat(image)
+        previous = _latest_manifest(username)
+        if (reason == 'scheduled' and previous and previous['size_bytes'] == st.st_size
+                and previous['mtime_ns'] == st.st_mtime_ns):
+            return None
+
+        started = time.time()
+        _low_io_priority()
+        mount_point = os.path.join(USER_DATA_DIR, username)
+        mount_point = mount_point if is_mounted(mount_point) else None
+        clone = _point_in_time_copy(username, image, mount_point)
+        live = clone is None and mount_point is not None
+        state = _container_state(username) if live else ''
+        if state.startswith('true'):
+            return _defer_snapshot(username, reason)
+        prev_chunks = previous['chunks'] if previous else []
+        chunks, changed, new_chunks, new_bytes = [], 0, 0, 0
+        budget = read_mbps * 1024 * 1024 if read_mbps else 0
+        try:
+            fd = os.open(clone or image, os.O_RDONLY)
+            try:
+                offset = 0
+                while offset < st.st_size:
+                    t0 = time.time()
+                    data = os.pread(fd, CHUNK_SIZE, offset)
+                    if not data:
+                        break
+                    # Backup reads must not push the containers' data out of the page cache
+                    os.posix_fadvise(fd, offset, len(data), os.POSIX_FADV_DONTNEED)
+                    if data == _ZERO_CHUNK[:len(data)]:
+                        digest = None
+                    else:
+                        digest = chunk_digest(data)
+                    index = len(chunks)
+                    if index >= len(prev_chunks) or prev_chunks[index] != digest:
+                        changed += 1
+                        if digest and not _stored_chunk(digest):
+                            payload, ext = compress_chunk(data)
+                            _write_atomic(_chunk_path(digest) + ext, payload)
+                            new_chunks += 1
+                            new_bytes += len(payload)
+                    chunks.append(digest)
+                    offset += len(data)
+                    if budget:
+                        time.sleep(max(0.0, len(data) / budget - (time.time() - t0)))
+            finally:
+                os.close(fd)
+        finally:
+            if clone:
+                os.remove(clone)
+        # Started while we read: what we have mixes before and after, keep the chunks but not the manifest
+        if live and _container_state(username) != state:
+            return _defer_snapshot(username, reason)
+
+        created = time.time()
+        manifest = {
+            'id': datetime.fromtimestamp(created, timezone.utc).strftime('%Y%m%dT%H%M%S%fZ'),
+            'username': username,
+            'created_at': created,
+            'reason': reason,
+            'size_bytes': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'chunk_size': CHUNK_SIZE,
+            'point_in_time': clone is not None,
+            'changed_chunks': changed,
+            'new_chunks': new_chunks,
+            'new_stored_bytes': new_bytes,
+            'elapsed_s': round(created - started, 1),
+            'chunks': chunks,
+        }
+        _write_atomic(os.path.join(MANIFESTS_DIR, username, f"{manifest['id']}.json"), json.dumps(manifest).encode())
+    print(f"Snapshot {username}/{manifest['id']}: {changed} of {len(chunks)} chunks changed, "
+          f"{new_chunks} new ({new_bytes / 1024**2:.1f} MB stored) in {manifest['elapsed_s']}s")
+    _record_job({'kind': 'snapshot', 'username': username, 'id': manifest['id'], 'reason': reason,
+                 'at': created, 'ok': True})
+    return manifest
+
+
+def _defer_snapshot(username, reason):
+    message = f"{username}_container is running and the filesystem has no reflinks, snapshot after it stops"
+    print(f"Snapshot of {username} put off: {message}")
+    if reason != 'scheduled':
+        # The scheduler retries every check interval, only one-off requests are reported
+        _record_job({'kind': 'snapshot', 'username': username, 'reason': reason, 'at': time.time(),
+                     'ok': False, 'error': message})
+    return None
+
+
+# --- Restore ---
+def restore_snapshot(username, snapshot_id, target=None):
+    """Rebuilds an image from a snapshot into a new file and returns its path.
+
+    Restores into user_data/<name>.img when the user has no disk (their next container
+    picks it up), otherwise next to the backups, never over an existing image.
+    """
+    manifest = load_manifest(username, snapshot_id)
+    if manifest is None:
+        raise ValueError(f"No snapshot {snapshot_id} for {username}")
+    if target is None:
+        target = os.path.join(USER_DATA_DIR, f"{username}.img")
+        if os.path.exists(target):
+            target = os.path.join(RESTORES_DIR, f"{username}-{snapshot_id}.img")
+    if os.path.exists(target):
+        raise ValueError(f"{target} already exists")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = f"{target}.partial"
+    try:
+        with open(tmp, 'wb') as f:
+            for index, digest in enumerate(manifest['chunks']):
+                if digest is None:
+                    continue  # left as a hole
+                path = _stored_chunk(digest)
+                if path is None:
+                    raise RuntimeError(f"chunk {digest} of {snapshot_id} is missing")
+                data = _decompress(path)
+                if chunk_digest(data) != digest:
+                    raise RuntimeError(f"chunk {digest} of {snapshot_id} is corrupt")
+                f.seek(index * manifest['chunk_size'])
+                f.write(data)
+            f.truncate(manifest['size_bytes'])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, target)
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        _record_job({'kind': 'restore', 'username': username, 'id': snapshot_id, 'at': time.time(),
+                     'ok': False, 'error': str(e)})
+        raise
+    _record_job({'kind': 'restore', 'username': username, 'id': snapshot_id, 'at': time.time(),
+                 'ok': True, 'target': target})
+    return target
+
+
+# --- Deletes ---
+def retain_before_delete(username, image):
+    """Moves a disk image that is about to be deleted aside for a last snapshot.
+
+    Same filesystem, so the rename is instant and the delete request doesn't wait;
+    the snapshot runs in the background and removes the file afterwards.
+    """
+    if not os.path.exists(image):
+        return
+    os.makedirs(PENDING_DIR, exist_ok=True)
+    os.replace(image, os.path.join(PENDING_DIR, f"{username}.{int(time.time())}.img"))
+    threading.Thread(target=snapshot_pending, daemon=True).start()
+
+
+def snapshot_pending():
+    """Takes the last snapshot of every deleted image waiting in PENDING_DIR, then removes it."""
+    if not os.path.isdir(PENDING_DIR) or not _pending_lock.acquire(blocking=False):
+        return
+    try:
+        for name in sorted(os.listdir(PENDING_DIR)):
+            match = re.fullmatch(r'(.+)\.(\d+)\.img', name)
+            path = os.path.join(PENDING_DIR, name)
+            if not match:
+                continue
+            try:
+                create_snapshot(match.group(1), image=path, reason='pre-delete')
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # the other portal got to it first
+            except Exception as e:
+                print(f"Pre-delete snapshot of {name} failed, keeping the image: {e}")
+    finally:
+        _pending_lock.release()
+
+
+# --- Retention ---
+def _kept(snaps, now):
+    """Ids of one user's snapshots that the retention policy keeps."""
+    newest_first = sorted(snaps, key=lambda s: s['created_at'], reverse=True)
+    keep = {s['id'] for s in newest_first[:KEEP_LAST]}
+    days, weeks = set(), set()
+    for s in newest_first:
+        day = datetime.fromtimestamp(s['created_at'], timezone.utc).date()
+        age_days = (now - s['created_at']) / 86400
+        if age_days < KEEP_DAILY and day not in days:
+            days.add(day)
+            keep.add(s['id'])
+        week = day.isocalendar()[:2]
+        if age_days < KEEP_WEEKLY * 7 and week not in weeks:
+            weeks.add(week)
+            keep.add(s['id'])
+    return keep
+
+
+def prune_snapshots(now=None):
+    """Applies the retention policy and deletes chunks no manifest references any more."""
+    now = now or time.time()
+    with _BackupLock():
+        removed = 0
+        for username, snaps in list_snapshots().items():
+            image_exists = os.path.exists(os.path.join(USER_DATA_DIR, f"{username}.img"))
+            if image_exists or now - snaps[-1]['created_at'] < DELETED_RETENTION_DAYS * 86400:
+                keep = _kept(snaps, now)
+            else:
+                keep = set()
+            for s in snaps:
+                if s['id'] not in keep:
+                    os.remove(os.path.join(MANIFESTS_DIR, username, f"{s['id']}.json"))
+                    removed += 1
+            if not keep:
+                os.rmdir(os.path.join(MANIFESTS_DIR, username))
+
+        referenced = set()
+        for username, snaps in list_snapshots().items():
+            for s in snaps:
+                referenced.update(d for d in load_manifest(username, s['id'])['chunks'] if d)
+        freed_chunks = freed_bytes = 0
+        for root, _, files in os.walk(CHUNKS_DIR):
+            for name in files:
+                if name.split('.')[0] not in referenced:
+                    path = os.path.join(root, name)
+                    freed_bytes += os.path.getsize(path)
+                    os.remove(path)
+                    freed_chunks += 1
+    if removed or freed_chunks:
+        print(f"Pruned {removed} snapshots, freed {freed_chunks} chunks ({freed_bytes / 1024**2:.1f} MB)")
+        _record_job({'kind': 'prune', 'at': now, 'ok': True, 'snapshots': removed,
+                     'freed_bytes': freed_bytes})
+    return removed, freed_bytes
+
+
+def get_backup_disk_usage():
+    """Bytes the backup directory occupies on the host disk: chunk store, images waiting for
+    their pre-delete snapshot, staging clones, restores and migration archives."""
+    return directory_disk_usage(BACKUP_DIR) if os.path.isdir(BACKUP_DIR) else 0
+
+
+def get_backup_usage():
+    """Logical size of every snapshot vs the bytes the chunk store actually holds."""
+    logical = 0
+    for snaps in list_snapshots().values():
+        logical += sum(s['size_bytes'] for s in snaps)
+    stored = 0
+    for root, _, files in os.walk(CHUNKS_DIR):
+        stored += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return {'logical_bytes': logical, 'stored_bytes': stored,
+            'ratio': round(logical / stored, 1) if stored else None}
+
+
+# --- Scheduler ---
+def run_due_snapshots(interval=SNAPSHOT_INTERVAL):
+    """Snapshots every image whose last snapshot is older than interval, one at a time."""
+    snapshot_pending()
+    if not os.path.isdir(USER_DATA_DIR):
+        return
+    latest = {u: snaps[-1]['created_at'] for u, snaps in list_snapshots().items()}
+    for name in sorted(os.listdir(USER_DATA_DIR)):
+        if not name.endswith('.img'):
+            continue
+        username = name[:-len('.img')]
+        if time.time() - latest.get(username, 0) < interval:
+            continue
+        try:
+            create_snapshot(username)
+        except Exception as e:
+            print(f"Snapshot of {username} failed: {e}")
+            _record_job({'kind': 'snapshot', 'username': username, 'at': time.time(), 'ok': False,
+                         'error': str(e)})
+    prune_snapshots()
+
+
+def _scheduler_loop(check_interval):
+    while True:
+        try:
+            run_due_snapshots()
+        except Exception as e:
+            print(f"Backup scheduler run failed: {e}")
+        time.sleep(check_interval)
+
+
+def start_backup_scheduler(check_interval=SCHEDULER_CHECK_INTERVAL):
+    """Starts the background snapshot thread once per process."""
+    global _scheduler_started
+    with _scheduler_lock:
+        if _scheduler_started:
+            return
+        _scheduler_started = True
+    threading.Thread(target=_scheduler_loop, args=(check_interval,), daemon=True).start()
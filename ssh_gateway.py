@@ -0,0 +1,246 @@
+# Single SSH entry point that routes each login by username to the user's container
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+
+from shared_cluster import SHARED_NETWORK, container_ip, ensure_network
+
+SSH_GATEWAY_CONTAINER = 'pdl_ssh_gateway'
+SSH_GATEWAY_PORT = 2222
+ROUTES_FILE = 'ssh_routes.json'
+# Host side of the gateway's /etc/pdl: sshd config, host key, routing table, per-user keys.
+# Next to the other state files in the working directory, absolute for the bind mount.
+GATEWAY_DIR = os.path.abspath('ssh_gateway')
+GATEWAY_MOUNT = '/etc/pdl'
+# Route keys stay root-owned on the host; each gateway account reads its own copy from here,
+# inside the container, so no host account ever shares a uid with a key's owner
+ROUTE_KEYS_COPY = '/var/lib/pdl/route_keys'
+# Idle gateway->container connections stay open this long for the next session to reuse
+MUX_PERSIST_SECONDS = 600
+
+SSHD_CONFIG = f"""# Generated by the resource manager, changes are overwritten
+Port 22
+HostKey {GATEWAY_MOUNT}/host_keys/ssh_host_ed25519_key
+PubkeyAuthentication yes
+PasswordAuthentication no
+KbdInteractiveAuthentication no
+PermitRootLogin no
+AuthorizedKeysFile {GATEWAY_MOUNT}/authorized_keys/%u
+# Sessions are relayed by the forced command, nothing terminates on the gateway itself
+AllowTcpForwarding no
+AllowAgentForwarding no
+X11Forwarding no
+PermitTunnel no
+PermitUserEnvironment no
+# sftp/scp requests reach the forced command as SSH_ORIGINAL_COMMAND
+Subsystem sftp /usr/lib/openssh/sftp-server
+MaxStartups 100:30:400
+ClientAliveInterval 60
+"""
+
+# Forced command of every gateway key: looks the user up in the routing table and relays
+# the session over a multiplexed connection authenticated with the user's route key
+ROUTE_SCRIPT = f"""#!/bin/sh
+user="$1"
+target=$(awk -v u="$user" '$1 == u {{ print $2 }}' {GATEWAY_MOUNT}/routes)
+if [ -z "$target" ]; then
+    echo "No running environment for $user. Start it from the dashboard." >&2
+    exit 1
+fi
+mux="/tmp/pdl-mux-$user"
+mkdir -p -m 700 "$mux"
+set -- -i {ROUTE_KEYS_COPY}/$user -o ControlMaster=auto -o "ControlPath=$mux/%C" \\
+    -o ControlPersist={MUX_PERSIST_SECONDS} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null \\
+    -o LogLevel=ERROR -o ConnectTimeout=10
+if [ -z "$SSH_ORIGINAL_COMMAND" ]; then
+    exec ssh -tt "$@" "$user@$target"
+elif [ -t 0 ]; then
+    exec ssh -tt "$@" "$user@$target" "$SSH_ORIGINAL_COMMAND"
+else
+    exec ssh -T "$@" "$user@$target" "$SSH_ORIGINAL_COMMAND"
+fi
+"""
+
+_gateway_lock = threading.Lock()
+
+
+def _write_file(path, content, mode=0o644):
+    """Atomic replace, so sshd and the route script never read a half-written file."""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.chmod(tmp, mode)
+    os.replace(tmp, path)
+
+
+def ensure_gateway_files():
+    """Creates the gateway's config directory: sshd_config, route script and a persistent host key."""
+    for sub in ('', 'host_keys', 'authorized_keys', 'route_keys'):
+        os.makedirs(os.path.join(GATEWAY_DIR, sub), mode=0o755, exist_ok=True)
+    # Private keys for the second hop, root only on the host (earlier versions chowned them to
+    # the gateway accounts, whose uids can belong to someone else on the host)
+    route_keys = os.path.join(GATEWAY_DIR, 'route_keys')
+    os.chmod(route_keys, 0o700)
+    for name in os.listdir(route_keys):
+        os.chown(os.path.join(route_keys, name), os.getuid(), os.getgid())
+    host_key = os.path.join(GATEWAY_DIR, 'host_keys', 'ssh_host_ed25519_key')
+    if not os.path.exists(host_key):
+        # Kept on the host so users' known_hosts stays valid when the gateway is recreated
+        subprocess.run(["ssh-keygen", "-t", "ed25519", "-f", host_key, "-q", "-N", ""], check=True)
+    _write_file(os.path.join(GATEWAY_DIR, 'sshd_config'), SSHD_CONFIG)
+    _write_file(os.path.join(GATEWAY_DIR, 'pdl-route'), ROUTE_SCRIPT, 0o755)
+    routes = os.path.join(GATEWAY_DIR, 'routes')
+    if not os.path.exists(routes):
+        _write_file(routes, '')
+
+
+def _gateway_exec(script):
+    return subprocess.run(["docker", "exec", SSH_GATEWAY_CONTAINER, "bash", "-c", script],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+def ensure_ssh_gateway():
+    """Creates or starts the gateway container and re-syncs its routing table."""
+    with _gateway_lock:
+        result = subprocess.run(["docker", "inspect", "-f", "{{.State.Status}}", SSH_GATEWAY_CONTAINER],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        state = result.stdout.strip() if result.returncode == 0 else None
+        if state == 'running':
+            return
+        ensure_gateway_files()
+        ensure_network()
+        if state is None:
+            print(f"Creating SSH gateway on port {SSH_GATEWAY_PORT}...")
+            subprocess.run([
+                "docker", "run", "-d",
+                "--name", SSH_GATEWAY_CONTAINER,
+                "--restart", "unless-stopped",
+                "-p", f"{SSH_GATEWAY_PORT}:22",
+                "--label", "pdl.mode=ssh_gateway",
+                "-v", f"{GATEWAY_DIR}:{GATEWAY_MOUNT}",
+                "--entrypoint", "bash",
+                "hadoop_container",
+                "-c", f"mkdir -p /run/sshd && exec /usr/sbin/sshd -D -e -f {GATEWAY_MOUNT}/sshd_config"
+            ], stdout=subprocess.DEVNULL, check=True)
+            # Full-stack containers sit on the default bridge, shared cluster clients on pdl_net
+            subprocess.run(["docker", "network", "connect", SHARED_NETWORK, SSH_GATEWAY_CONTAINER],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        else:
+            subprocess.run(["docker", "start", SSH_GATEWAY_CONTAINER], stdout=subprocess.DEVNULL, check=True)
+    sync_routes()
+
+
+# --- Routing table ---
+def get_routes():
+    """{username: {'ip': container address, 'updated_at': ...}}."""
+    if not os.path.exists(ROUTES_FILE):
+        return {}
+    try:
+        with open(ROUTES_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _update_routes(update):
+    """Applies update(routes) under a file lock and re-renders the gateway's routing table."""
+    os.makedirs(GATEWAY_DIR, exist_ok=True)
+    with open(ROUTES_FILE, 'a+') as f:
+        # Both portals and the recovery workers change routes
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        routes = json.loads(raw) if raw.strip() else {}
+        update(routes)
+        f.seek(0)
+        f.truncate()
+        json.dump(routes, f, indent=4)
+        _write_file(os.path.join(GATEWAY_DIR, 'routes'),
+                    ''.join(f"{u} {r['ip']}\n" for u, r in sorted(routes.items()) if r.get('ip')))
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return routes
+
+
+def _inspect(container_names):
+    result = subprocess.run(["docker", "inspect", *container_names],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        return json.loads(result.stdout or '[]')
+    except ValueError:
+        return []
+
+
+def add_route(username, public_key):
+    """Lets the user's key in at the gateway and returns the route public key for their container.
+
+    The route key is what the gateway uses for the second hop; only the user's own
+    gateway account can read its copy, and only their container trusts it.
+    """
+    ensure_ssh_gateway()
+    route_key = os.path.join(GATEWAY_DIR, 'route_keys', username)
+    if os.path.exists(route_key):
+        os.remove(route_key)
+    if os.path.exists(route_key + '.pub'):
+        os.remove(route_key + '.pub')
+    subprocess.run(["ssh-keygen", "-t", "ed25519", "-f", route_key, "-q", "-N", "", "-C", f"pdl-gateway-{username}"],
+                   check=True)
+    _write_file(os.path.join(GATEWAY_DIR, 'authorized_keys', username),
+                f'restrict,pty,command="{GATEWAY_MOUNT}/pdl-route {username}" {public_key.strip()}\n')
+    _ensure_accounts([username])
+    with open(route_key + '.pub', 'r') as f:
+        return f.read().strip()
+
+
+def _ensure_accounts(usernames):
+    """Gateway accounts and the copies of their route keys they own, all in one exec."""
+    if not usernames:
+        return
+    # sshd needs a local account per login name; '*' (not '!') so key logins aren't treated as locked.
+    # The copy lives in the container's own filesystem, the bind-mounted original stays root's.
+    _gateway_exec(f"mkdir -p -m 711 {ROUTE_KEYS_COPY}; for u in {' '.join(usernames)}; do "
+                  f"id -u $u > /dev/null 2>&1 || useradd -M -d /tmp -s /bin/sh -p '*' $u; "
+                  f"install -o $u -m 600 {GATEWAY_MOUNT}/route_keys/$u {ROUTE_KEYS_COPY}/$u; done")
+
+
+def update_route(username):
+    """Points the user's route at their container's current address (it changes across restarts)."""
+    details = _inspect([f"{username}_container"])
+    ip = container_ip(details[0]) if details and details[0]['State']['Status'] == 'running' else None
+    _update_routes(lambda r: r.update({username: {'ip': ip, 'updated_at': time.time()}}))
+    return ip
+
+
+def remove_routes(usernames):
+    """Drops the users' routes and gateway keys (their containers were deleted)."""
+    for username in usernames:
+        for path in (os.path.join(GATEWAY_DIR, 'authorized_keys', username),
+                     os.path.join(GATEWAY_DIR, 'route_keys', username),
+                     os.path.join(GATEWAY_DIR, 'route_keys', username + '.pub')):
+            if os.path.exists(path):
+                os.remove(path)
+    if usernames:
+        _gateway_exec(f"cd {ROUTE_KEYS_COPY} 2>/dev/null && rm -f {' '.join(usernames)}")
+
+    def drop(routes):
+        for username in usernames:
+            routes.pop(username, None)
+    _update_routes(drop)
+
+
+def sync_routes():
+    """Rebuilds every route from the containers' current addresses in one inspect call
+    (gateway start, host recovery) and recreates missing gateway accounts."""
+    routed = set(get_routes())
+    details = _inspect([f"{u}_container" for u in sorted(routed)]) if routed else []
+    addresses = {d['Name'].lstrip('/')[:-len('_container')]: container_ip(d) if d['State']['Status'] == 'running' else None
+                 for d in details}
+
+    def refresh(routes):
+        for username in routes:
+            routes[username] = {'ip': addresses.get(username), 'updated_at': time.time()}
+    _update_routes(refresh)
+    _ensure_accounts([u for u in sorted(routed) if os.path.exists(os.path.join(GATEWAY_DIR, 'route_keys', u))])
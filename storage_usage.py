@@ -0,0 +1,134 @@
+# Real used/free space of user volumes (statvfs) and per-user HDFS usage, cached
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from hadoop_config import SHORT_JVM
+from mounts import USER_DATA_DIR, is_mounted
+from shared_cluster import SHARED_CLUSTER_CONTAINER, container_ip, is_shared_client
+
+# statvfs is a syscall, HDFS needs a round trip to the container's NameNode
+VOLUME_USAGE_TTL = 30
+HDFS_USAGE_TTL = 300
+SCAN_WORKERS = 8
+NAMENODE_HTTP_PORT = 9870
+# Volumes using less than this share of their size are flagged as downsize candidates
+UNDERUSED_PCT = 5
+
+_cache_lock = threading.Lock()
+_cache = {'volume': {}, 'hdfs': {}}  # kind -> {username: (measured_at, value)}
+_refreshing = set()
+
+
+def _cached(kind, username, max_age, measure, background=False):
+    """Cached measurement; with background=True a stale entry is returned (None if there is
+    none yet) while a thread re-measures, so page loads never wait on a slow scan."""
+    with _cache_lock:
+        entry = _cache[kind].get(username)
+        if entry and time.time() - entry[0] < max_age:
+            return entry[1]
+        if background:
+            if (kind, username) not in _refreshing:
+                _refreshing.add((kind, username))
+                threading.Thread(target=_refresh, args=(kind, username, measure), daemon=True).start()
+            return entry[1] if entry else None
+    return _refresh(kind, username, measure)
+
+
+def _refresh(kind, username, measure):
+    try:
+        value = measure(username)
+    except Exception as e:
+        print(f"Storage scan ({kind}) failed for {username}: {e}")
+        value = None
+    with _cache_lock:
+        _cache[kind][username] = (time.time(), value)
+        _refreshing.discard((kind, username))
+    return value
+
+
+def _measure_volume(username):
+    mount_point = os.path.join(USER_DATA_DIR, username)
+    if not is_mounted(mount_point):
+        return None
+    st = os.statvfs(mount_point)
+    total = st.f_blocks * st.f_frsize
+    free = st.f_bavail * st.f_frsize
+    # ext4 reserves blocks for root, so used + free is a little less than total
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    return {
+        'total_bytes': total,
+        'used_bytes': used,
+        'free_bytes': free,
+        'used_pct': round(used / total * 100, 1) if total else 0.0,
+    }
+
+
+def _hdfs_usage_webhdfs(container_name, username):
+    result = subprocess.run(["docker", "inspect", container_name],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    details = json.loads(result.stdout) if result.returncode == 0 and result.stdout.strip() else []
+    ip = container_ip(details[0]) if details else None
+    if not ip:
+        return None
+    # The NameNode runs as root, so root is the HDFS superuser and can sum any user's tree
+    url = (f"http://{ip}:{NAMENODE_HTTP_PORT}/webhdfs/v1/user/{username}"
+           f"?op=GETCONTENTSUMMARY&user.name=root")
+    with urllib.request.urlopen(url, timeout=5) as resp:
+        summary = json.load(resp)['ContentSummary']
+    return {'length_bytes': summary['length'], 'consumed_bytes': summary['spaceConsumed']}
+
+
+def _hdfs_usage_cli(container_name, username):
+    result = subprocess.run(["docker", "exec", container_name, "bash", "-c", f"{SHORT_JVM}hdfs dfs -du -s /user/{username}"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    # "<length> <space consumed with replication> /user/name"
+    parts = result.stdout.split()
+    if result.returncode != 0 or len(parts) < 2 or not parts[0].isdigit():
+        return None
+    return {'length_bytes': int(parts[0]), 'consumed_bytes': int(parts[1])}
+
+
+def _measure_hdfs(username):
+    # Shared-cluster users' HDFS homes live on the cluster's NameNode
+    container_name = SHARED_CLUSTER_CONTAINER if is_shared_client(username) else f"{username}_container"
+    state = subprocess.run(["docker", "inspect", "-f", "{{.State.Status}}", container_name],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    if state != 'running':
+        return None
+    try:
+        # WebHDFS avoids starting a JVM in the container for every scan
+        return _hdfs_usage_webhdfs(container_name, username)
+    except Exception:
+        return _hdfs_usage_cli(container_name, username)
+
+
+def get_volume_usage(username, max_age=VOLUME_USAGE_TTL):
+    """{total,used,free}_bytes and used_pct of the user's mounted filesystem, None if not mounted."""
+    return _cached('volume', username, max_age, _measure_volume)
+
+
+def get_hdfs_usage(username, max_age=HDFS_USAGE_TTL, background=True):
+    """{length,consumed}_bytes under /user/<name>, None when the container isn't running
+    (or, in the background mode, before the first scan finished)."""
+    return _cached('hdfs', username, max_age, _measure_hdfs, background)
+
+
+def get_storage_usage(username, refresh=False):
+    """Volume and HDFS usage for one user (the dashboard view). refresh=True waits for fresh numbers."""
+    volume = get_volume_usage(username, 0 if refresh else VOLUME_USAGE_TTL)
+    return {
+        'volume': volume,
+        'hdfs': get_hdfs_usage(username, 0 if refresh else HDFS_USAGE_TTL, background=not refresh),
+        'underused': bool(volume and volume['used_pct'] < UNDERUSED_PCT),
+    }
+
+
+def get_all_storage_usage(usernames, refresh=False, workers=SCAN_WORKERS):
+    """{username: get_storage_usage()} scanned in parallel (the admin storage view)."""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(zip(usernames, pool.map(lambda u: get_storage_usage(u, refresh), usernames)))
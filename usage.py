@@ -0,0 +1,323 @@
+# Usage accounting: integrates each user's allocated and actual CPU/RAM/disk over time and
+# enforces rolling CPU-hour and RAM GB-hour quotas
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+
+from lifecycle_trace import record_usage_samples
+from shared_cluster import get_tenants
+from utils import get_all_containers_details, get_container_usage, get_cpu_grants, get_global_limits, hibernate_container
+
+USAGE_FILE = 'usage.json'
+USAGE_INTERVAL = 60
+USER_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_data')
+# Quotas are a rolling window over hourly buckets; older buckets are kept a while for reports
+QUOTA_WINDOW_HOURS = 7 * 24
+LEDGER_RETENTION_HOURS = 35 * 24
+# A gap longer than this (portal down, host asleep) is not charged to anyone
+MAX_SAMPLE_GAP = 2 * USAGE_INTERVAL
+# Throttled containers keep a sliver of CPU so an SSH session still works
+THROTTLE_CPUS = 0.25
+# Throttles are lifted once usage falls back below this share of the quota
+RELEASE_FRACTION = 0.9
+WARN_FRACTION = 0.8
+LEDGER_FIELDS = ('cpu_alloc_h', 'cpu_used_h', 'ram_alloc_gbh', 'ram_used_gbh', 'disk_alloc_gbh', 'disk_used_gbh')
+
+_accounting_lock = threading.Lock()
+_accounting_started = False
+
+
+def get_usage_ledger():
+    """{'users': {username: {hour: {field: value}}}, 'throttled': {...}, 'stopped': {...}, 'last_sample': ts}."""
+    ledger = {'users': {}, 'throttled': {}, 'stopped': {}, 'last_sample': None}
+    if not os.path.exists(USAGE_FILE):
+        return ledger
+    try:
+        with open(USAGE_FILE, 'r') as f:
+            ledger.update(json.load(f))
+    except Exception:
+        pass
+    return ledger
+
+
+def _update_ledger(update):
+    with open(USAGE_FILE, 'a+') as f:
+        # The sampler adds buckets, the portals read totals and drop deleted users
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        ledger = {'users': {}, 'throttled': {}, 'stopped': {}, 'last_sample': None}
+        if raw.strip():
+            ledger.update(json.loads(raw))
+        result = update(ledger)
+        f.seek(0)
+        f.truncate()
+        json.dump(ledger, f)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+
+def current_rates():
+    """{username: {field: rate per hour}} from one inspect, one stats call and the image sizes.
+
+    Allocation is what the container reserves (NanoCpus, Memory); a shared-cluster client is
+    charged its queue's allocation instead, since its jobs run on the cluster's NodeManager.
+    """
+    rates = {}
+
+    def rate(username):
+        return rates.setdefault(username, dict.fromkeys(LEDGER_FIELDS, 0.0))
+
+    tenants = {u: t for u, t in get_tenants().items() if t.get('queue_state') == 'RUNNING'}
+    stats = get_container_usage()
+    for c in get_all_containers_details():
+        name = c['Names']
+        if c['Status'].lower() != 'running' or not name.endswith('_container'):
+            continue
+        username = name[:-len('_container')]
+        r = rate(username)
+        if username in tenants:
+            r['cpu_alloc_h'] = float(tenants[username]['cpus'])
+            r['ram_alloc_gbh'] = int(tenants[username]['ram_mb']) / 1024
+        else:
+            r['cpu_alloc_h'] = c['CPUs']
+            r['ram_alloc_gbh'] = c['MemoryMB'] / 1024
+        used = stats.get(name, {})
+        r['cpu_used_h'] = used.get('cpu_cores', 0.0)
+        r['ram_used_gbh'] = used.get('memory_bytes', 0) / (1024**3)
+
+    # Disk is held whether or not the container runs
+    if os.path.exists(USER_DATA_DIR):
+        for f in os.listdir(USER_DATA_DIR):
+            if f.endswith('.img'):
+                st = os.stat(os.path.join(USER_DATA_DIR, f))
+                r = rate(f[:-len('.img')])
+                r['disk_alloc_gbh'] = st.st_size / (1024**3)
+                r['disk_used_gbh'] = st.st_blocks * 512 / (1024**3)
+    return rates
+
+
+def sample_usage(now=None):
+    """Charges every user for the time since the previous sample at the current rates."""
+    now = now or time.time()
+    rates = current_rates()
+    record_usage_samples(rates, now)
+
+    def charge(ledger):
+        last = ledger.get('last_sample')
+        ledger['last_sample'] = now
+        if last is None or now <= last:
+            return 0.0
+        hours = min(now - last, MAX_SAMPLE_GAP) / 3600
+        bucket = str(int(now // 3600))
+        for username, r in rates.items():
+            buckets = ledger['users'].setdefault(username, {})
+            b = buckets.setdefault(bucket, dict.fromkeys(LEDGER_FIELDS, 0.0))
+            for field in LEDGER_FIELDS:
+                b[field] = b.get(field, 0.0) + r[field] * hours
+        oldest = int(now // 3600) - LEDGER_RETENTION_HOURS
+        for username in list(ledger['users']):
+            buckets = ledger['users'][username]
+            for hour in [h for h in buckets if int(h) < oldest]:
+                del buckets[hour]
+            if not buckets:
+                del ledger['users'][username]
+        return hours
+    return _update_ledger(charge)
+
+
+def _sum_buckets(buckets, since_hour):
+    totals = dict.fromkeys(LEDGER_FIELDS, 0.0)
+    for hour, b in buckets.items():
+        if int(hour) >= since_hour:
+            for field in LEDGER_FIELDS:
+                totals[field] += b.get(field, 0.0)
+    return totals
+
+
+def get_quotas():
+    """Rolling-window quotas from the global settings; 0 means unlimited."""
+    limits = get_global_limits()
+    return {
+        'cpu_hours': float(limits.get('quota_cpu_hours_week') or 0),
+        'ram_gb_hours': float(limits.get('quota_ram_gb_hours_week') or 0),
+        'action': limits.get('quota_action', 'throttle'),
+    }
+
+
+def _quota_fraction(totals, quotas):
+    """Highest share of a quota used in the window (0 when no quota is set)."""
+    fractions = [0.0]
+    if quotas['cpu_hours']:
+        fractions.append(totals['cpu_alloc_h'] / quotas['cpu_hours'])
+    if quotas['ram_gb_hours']:
+        fractions.append(totals['ram_alloc_gbh'] / quotas['ram_gb_hours'])
+    return max(fractions)
+
+
+def get_user_usage(username, ledger=None, quotas=None):
+    """Window and retained totals of one user, with their quota state."""
+    ledger = ledger or get_usage_ledger()
+    quotas = quotas or get_quotas()
+    buckets = ledger['users'].get(username, {})
+    now_hour = int(time.time() // 3600)
+    window = _sum_buckets(buckets, now_hour - QUOTA_WINDOW_HOURS + 1)
+    fraction = _quota_fraction(window, quotas)
+    return {
+        'window': window,
+        'total': _sum_buckets(buckets, 0),
+        'quotas': quotas,
+        'fraction': fraction,
+        'warning': fraction >= WARN_FRACTION,
+        'over_quota': fraction >= 1,
+        'throttled': username in ledger['throttled'],
+        'stopped': username in ledger['stopped'],
+    }
+
+
+def get_all_usage():
+    """{username: get_user_usage()} for everyone in the ledger."""
+    ledger = get_usage_ledger()
+    quotas = get_quotas()
+    return {u: get_user_usage(u, ledger, quotas) for u in sorted(ledger['users'])}
+
+
+def check_quota(username):
+    """(allowed, message) for starting or creating a container."""
+    usage = get_user_usage(username)
+    if usage['over_quota']:
+        return False, (f"Weekly quota used up ({usage['window']['cpu_alloc_h']:.1f} CPU-hours, "
+                       f"{usage['window']['ram_alloc_gbh']:.1f} RAM GB-hours in the last 7 days). "
+                       "Try again once older usage leaves the window.")
+    return True, ""
+
+
+def _set_cpus(container_name, cpus):
+    result = subprocess.run(["docker", "update", "--cpus", str(cpus), container_name],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(f"Usage: could not set {container_name} to {cpus} CPUs: {result.stderr.strip()}")
+    return result.returncode == 0
+
+
+def enforce_quotas():
+    """Throttles or stops users over quota and lifts throttles once they are back under."""
+    ledger = get_usage_ledger()
+    quotas = get_quotas()
+    running = {c['Names'][:-len('_container')]: c for c in get_all_containers_details()
+               if c['Status'].lower() == 'running' and c['Names'].endswith('_container')}
+    throttled, stopped, released = {}, {}, []
+
+    # A reset user has no buckets left but may still be throttled
+    for username in set(ledger['users']) | set(ledger['throttled']):
+        fraction = _quota_fraction(get_user_usage(username, ledger, quotas)['window'], quotas)
+        if username in ledger['throttled'] and fraction < RELEASE_FRACTION:
+            original = get_cpu_grants().get(username, ledger['throttled'][username]['cpus'])
+            if username not in running or _set_cpus(f"{username}_container", original):
+                released.append(username)
+                print(f"Usage: {username} back under quota, restored {original} CPUs")
+            continue
+        if fraction < 1 or username not in running or username in ledger['throttled']:
+            continue
+        if quotas['action'] == 'stop':
+            success, _ = hibernate_container(username)
+            if success:
+                stopped[username] = time.time()
+                print(f"Usage: {username} over quota, hibernated")
+        elif running[username]['CPUs'] > THROTTLE_CPUS:
+            if _set_cpus(f"{username}_container", THROTTLE_CPUS):
+                # Restored on release: the grant, not a quota the rebalancer had lent them
+                throttled[username] = {'cpus': running[username]['GrantedCPUs'], 'at': time.time()}
+                print(f"Usage: {username} over quota, throttled to {THROTTLE_CPUS} CPUs")
+
+    def record(ledger):
+        for username in released:
+            ledger['throttled'].pop(username, None)
+        ledger['throttled'].update(throttled)
+        ledger['stopped'].update(stopped)
+        # A stop is only reported until the user is back under quota
+        for username in list(ledger['stopped']):
+            if _quota_fraction(get_user_usage(username, ledger, quotas)['window'], quotas) < RELEASE_FRACTION:
+                del ledger['stopped'][username]
+    _update_ledger(record)
+
+
+def retarget_throttle(username, cpus):
+    """After a resize: a throttled user stays throttled and gets `cpus` back when released."""
+    def retarget(ledger):
+        if username not in ledger['throttled']:
+            return False
+        ledger['throttled'][username]['cpus'] = float(cpus)
+        return True
+    if _update_ledger(retarget):
+        _set_cpus(f"{username}_container", THROTTLE_CPUS)
+
+
+def forget_usage(usernames):
+    """Clears throttle records of deleted containers; their ledger stays until it ages out."""
+    def drop(ledger):
+        for username in usernames:
+            ledger['throttled'].pop(username, None)
+            ledger['stopped'].pop(username, None)
+    _update_ledger(drop)
+
+
+def reset_usage(username):
+    """Forgives a user's recorded usage; the next pass lifts their throttle."""
+    def drop(ledger):
+        ledger['users'].pop(username, None)
+        ledger['stopped'].pop(username, None)
+    _update_ledger(drop)
+
+
+def _accounting_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            sample_usage()
+            enforce_quotas()
+        except Exception as e:
+            print(f"Usage accounting failed: {e}")
+
+
+def start_usage_accounting(interval=USAGE_INTERVAL):
+    """Starts the background sampler once per process."""
+    global _accounting_started
+    with _accounting_lock:
+        if _accounting_started:
+            return
+        _accounting_started = True
+    # Start the clock now so the first interval is charged
+    try:
+        sample_usage()
+    except Exception as e:
+        print(f"Usage accounting failed: {e}")
+    threading.Thread(target=_accounting_loop, args=(interval,), daemon=True).start()
+
+
+def render_usage_metrics():
+    """Per-user consumption over the retained ledger in the Prometheus text format."""
+    usage = get_all_usage()
+    lines = []
+    for field, help_text in [
+        ('cpu_alloc_h', 'CPU-hours reserved by the user\'s containers'),
+        ('cpu_used_h', 'CPU-hours actually used by the user\'s containers'),
+        ('ram_alloc_gbh', 'RAM GB-hours reserved by the user\'s containers'),
+        ('ram_used_gbh', 'RAM GB-hours actually used by the user\'s containers'),
+        ('disk_alloc_gbh', 'Disk GB-hours of the user\'s image'),
+    ]:
+        name = f"pdl_user_{field}"
+        lines.append(f"# HELP {name} {help_text} over the retained ledger")
+        # Not a counter: buckets older than the retention age out
+        lines.append(f"# TYPE {name} gauge")
+        for username, u in usage.items():
+            lines.append(f'{name}{{user="{username}"}} {u["total"][field]:.4f}')
+    lines += ["# HELP pdl_user_quota_fraction Share of the weekly quota used in the rolling window",
+              "# TYPE pdl_user_quota_fraction gauge"]
+    for username, u in usage.items():
+        lines.append(f'pdl_user_quota_fraction{{user="{username}"}} {u["fraction"]:.4f}')
+    return "\n".join(lines) + "\n"
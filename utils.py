@@ -4,11 +4,33 @@ import subprocess
 import json
 import psutil
 import time
-import random
 import shutil
+import threading
+import fcntl
+import re
 
+from hadoop_config import SHORT_JVM, ConfigProfile, compute_hadoop_sizing, deliver_config_bundle, docker_env_flags
+from package_cache import package_cache_flags, remove_package_cache_volumes, replay_apt_manifest
+from datasets import dataset_mount_flags
+from mounts import loop_device_for, unmount
+from snapshots import get_backup_disk_usage
+from shared_cluster import (CLIENT_MODE_MARKER, client_container_limits, client_docker_flags, client_profile,
+                            ensure_shared_cluster, get_tenants, is_shared_client, register_tenant, release_tenants,
+                            resize_tenant)
+from ssh_gateway import add_route, remove_routes, update_route
+from lifecycle_trace import record_event
+
+USERS_FILE = 'users.json'
 REQUESTS_FILE = 'requests.json'
 SETTINGS_FILE = 'settings.json'
+METRICS_FILE = 'metrics.json'
+HIBERNATE_FILE = 'hibernate.json'
+IO_OVERRIDES_FILE = 'io_profiles.json'
+CPUSET_FILE = 'cpusets.json'
+DESIRED_STATE_FILE = 'desired_state.json'
+
+# How long a /metrics scrape may reuse the last snapshot before asking Docker again
+METRICS_CACHE_TTL = 15
 
 # For server status and resource display
 def parse_memory_to_mb(mem):
@@ -32,10 +54,17 @@ def get_available_resources():
                 ["docker", "inspect"] + container_ids
             ).decode('utf-8')
             container_details = json.loads(inspect_output)
+            grants = get_cpu_grants()
             for details in container_details:
-                nano_cpus = details['HostConfig']['NanoCpus']
-                if nano_cpus > 0:
-                    allocated_cpus += nano_cpus / 1_000_000_000
+                name = details['Name'].lstrip('/')
+                # The grant, not the live quota the rebalancer or a quota throttle may have changed
+                cpus = grants.get(name[:-len('_container')], details['HostConfig']['NanoCpus'] / 1_000_000_000)
+                labels = details['Config'].get('Labels') or {}
+                if labels.get('pdl.cpu_pinning') == 'dedicated' and details['HostConfig'].get('CpusetCpus'):
+                    # Pinned containers hold whole cores, not just their --cpus quota
+                    allocated_cpus += max(len(parse_cpu_list(details['HostConfig']['CpusetCpus'])), cpus)
+                elif cpus > 0:
+                    allocated_cpus += cpus
                 memory_bytes = details['HostConfig']['Memory']
                 if memory_bytes > 0:
                     allocated_ram_gb += memory_bytes / (1024 * 1024 * 1024)
@@ -57,6 +86,9 @@ def get_available_resources():
                 # os.path.getsize returns the logical max size (e.g., 5GB)
                 # not the physical usage on disk.
                 total_allocated_gb += os.path.getsize(path)
+    # Snapshot chunks, deleted images awaiting their last snapshot and migration archives
+    # take host disk too
+    total_allocated_gb += get_backup_disk_usage()
     
     total_allocated_gb /= (1024**3)
     host_free_disk_gb = host_total_disk_gb - total_allocated_gb
@@ -89,9 +121,12 @@ def get_all_containers_details():
         ).decode('utf-8')
         
         all_details = json.loads(inspect_output)
+        io_overrides = get_io_overrides()
+        grants = get_cpu_grants()
 
         # Process each container's details into a clean format
         for details in all_details:
+            name = details['Name'].lstrip('/')
             # Helper to format port bindings cleanly
             ports = details.get('NetworkSettings', {}).get('Ports', {})
             port_mappings = []
@@ -108,7 +143,10 @@ def get_all_containers_details():
                 'FullStatus': f"{details['State']['Status'].capitalize()} ({details['State']['ExitCode']})" if details['State']['Status'] != 'running' else 'Running',
                 'Ports': ', '.join(port_mappings) or 'N/A',
                 'CPUs': details['HostConfig'].get('NanoCpus', 0) / 1_000_000_000,
-                'MemoryMB': details['HostConfig'].get('Memory', 0) / (1024 * 1024)
+                'GrantedCPUs': grants.get(name[:-len('_container')], details['HostConfig'].get('NanoCpus', 0) / 1_000_000_000),
+                'MemoryMB': details['HostConfig'].get('Memory', 0) / (1024 * 1024),
+                'CpuSet': details['HostConfig'].get('CpusetCpus') or '',
+                'IOProfile': io_overrides.get(name[:-len('_container')]) or (details['Config'].get('Labels') or {}).get('pdl.io_profile', 'N/A')
             })
 
     except Exception as e:
@@ -117,25 +155,251 @@ def get_all_containers_details():
 
     return containers
     
-def extract_host_port(port_str):
-    if '->' not in port_str:
-        return None
-    
-    left = port_str.split('->')[0]   # before "->"
-    parts = left.split(':')
-    
-    # host port is always the last part
-    host_part = parts[-1].strip()
+# For Metrics Exporter - provisioning counters shared by app.py and admin.py
+def record_provision_result(success):
+    """Increments the provisioning success/failure counters in METRICS_FILE."""
+    key = 'provision_success_total' if success else 'provision_failure_total'
+    try:
+        with open(METRICS_FILE, 'a+') as f:
+            # Both portals provision, so guard the read-modify-write with a file lock
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            raw = f.read()
+            counters = json.loads(raw) if raw.strip() else {}
+            counters[key] = counters.get(key, 0) + 1
+            f.seek(0)
+            f.truncate()
+            json.dump(counters, f)
+            # Flush before unlocking: the buffered dump would otherwise land after the next writer's
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except Exception as e:
+        print(f"Error recording provision result: {e}")
 
-    return int(host_part)
+# Whether each user's container should be running, so host recovery knows what to bring back
+def set_desired_state(username, state):
+    """Records 'running' or 'stopped' for a user's container; None forgets the user."""
+    try:
+        with open(DESIRED_STATE_FILE, 'a+') as f:
+            # Both portals and the parallel recovery workers write here
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            raw = f.read()
+            desired = json.loads(raw) if raw.strip() else {}
+            if state is None:
+                desired.pop(username, None)
+            else:
+                desired[username] = {'state': state, 'updated_at': time.time()}
+            f.seek(0)
+            f.truncate()
+            json.dump(desired, f)
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except Exception as e:
+        print(f"Error recording desired state for {username}: {e}")
+    # Every start, stop and delete passes through here
+    record_event('state', username, s=state or 'deleted')
 
+def load_users():
+    """{username: password hash}; shared by both portals and migration imports."""
+    if not os.path.exists(USERS_FILE):
+        return {}
+    try:
+        with open(USERS_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return {}
+
+def get_desired_states():
+    if not os.path.exists(DESIRED_STATE_FILE): return {}
+    try:
+        with open(DESIRED_STATE_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def get_provision_counters():
+    counters = {'provision_success_total': 0, 'provision_failure_total': 0}
+    if os.path.exists(METRICS_FILE):
+        try:
+            with open(METRICS_FILE, 'r') as f:
+                counters.update(json.load(f))
+        except Exception:
+            pass
+    return counters
+
+def parse_size_to_bytes(size_str):
+    """Converts docker stats sizes like '1.5GiB' or '300kB' into bytes."""
+    units = {
+        'b': 1, 'kb': 1000, 'mb': 1000**2, 'gb': 1000**3, 'tb': 1000**4,
+        'kib': 1024, 'mib': 1024**2, 'gib': 1024**3, 'tib': 1024**4
+    }
+    match = re.match(r'^\s*([\d.]+)\s*([a-zA-Z]*)\s*$', size_str)
+    if not match:
+        return 0
+    number, unit = match.groups()
+    return float(number) * units.get(unit.lower() or 'b', 1)
+
+def get_container_usage():
+    """Returns actual CPU (cores) and RAM (bytes) used per running container name."""
+    usage = {}
+    try:
+        output = subprocess.check_output(
+            ["docker", "stats", "--no-stream", "--format", "{{json .}}"]
+        ).decode('utf-8')
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            stats = json.loads(line)
+            # CPUPerc is relative to one core, e.g. "150.00%" means 1.5 cores
+            cpu_cores = float(stats.get('CPUPerc', '0%').rstrip('%') or 0) / 100
+            mem_used = parse_size_to_bytes(stats.get('MemUsage', '0B').split('/')[0])
+            usage[stats['Name']] = {'cpu_cores': cpu_cores, 'memory_bytes': mem_used}
+    except Exception as e:
+        print(f"Error reading container stats: {e}")
+    return usage
+
+_metrics_cache = {'timestamp': 0, 'snapshot': None}
+_metrics_lock = threading.Lock()
+
+def collect_metrics_snapshot():
+    """Gathers host capacity and tenancy figures with one inspect and one stats call."""
+    host_cores = os.cpu_count()
+    host_ram_gb = psutil.virtual_memory().total / (1024**3)
+    total, used, free = shutil.disk_usage(".")
+
+    allocated_cpus = 0
+    allocated_ram_gb = 0
+    states = {}
+    for c in get_all_containers_details():
+        state = c['Status'].lower()
+        states[state] = states.get(state, 0) + 1
+        if state == 'running':
+            allocated_cpus += c['GrantedCPUs']
+            allocated_ram_gb += c['MemoryMB'] / 1024
+
+    used_cpus = 0
+    used_ram_gb = 0
+    for stats in get_container_usage().values():
+        used_cpus += stats['cpu_cores']
+        used_ram_gb += stats['memory_bytes'] / (1024**3)
+
+    # Allocated disk is the logical size of each image, used disk is the blocks actually written
+    allocated_disk_gb = 0
+    used_disk_gb = 0
+    user_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_data')
+    if os.path.exists(user_data_dir):
+        for f in os.listdir(user_data_dir):
+            if f.endswith('.img'):
+                st = os.stat(os.path.join(user_data_dir, f))
+                allocated_disk_gb += st.st_size / (1024**3)
+                used_disk_gb += st.st_blocks * 512 / (1024**3)
+
+    counters = get_provision_counters()
+    return {
+        'host_cpu_cores': host_cores,
+        'host_ram_gb': host_ram_gb,
+        'host_disk_gb': total / (1024**3),
+        'host_disk_free_gb': free / (1024**3),
+        # Same headroom as get_available_resources()
+        'schedulable_cpu_cores': host_cores - 2,
+        'schedulable_ram_gb': host_ram_gb - 10,
+        'schedulable_disk_gb': total / (1024**3) - 50,
+        'allocated_cpu_cores': allocated_cpus,
+        'allocated_ram_gb': allocated_ram_gb,
+        'allocated_disk_gb': allocated_disk_gb,
+        'used_cpu_cores': used_cpus,
+        'used_ram_gb': used_ram_gb,
+        'used_disk_gb': used_disk_gb,
+        'containers_by_state': states,
+        'pending_requests': len(get_all_requests()),
+        'provision_success_total': counters['provision_success_total'],
+        'provision_failure_total': counters['provision_failure_total'],
+        'timestamp': time.time()
+    }
+
+def get_metrics_snapshot(max_age=METRICS_CACHE_TTL):
+    """Returns the cached metrics snapshot, refreshing it at most once per max_age seconds."""
+    with _metrics_lock:
+        if _metrics_cache['snapshot'] is None or time.time() - _metrics_cache['timestamp'] > max_age:
+            _metrics_cache['snapshot'] = collect_metrics_snapshot()
+            _metrics_cache['timestamp'] = time.time()
+        return _metrics_cache['snapshot']
+
+def render_prometheus_metrics():
+    """Formats the metrics snapshot in the Prometheus text exposition format."""
+    snap = get_metrics_snapshot()
+    gauges = [
+        ('pdl_host_cpu_cores', 'Total CPU cores on the host', snap['host_cpu_cores']),
+        ('pdl_host_ram_gb', 'Total RAM on the host in GB', snap['host_ram_gb']),
+        ('pdl_host_disk_gb', 'Total disk on the host in GB', snap['host_disk_gb']),
+        ('pdl_host_disk_free_gb', 'Free disk on the host filesystem in GB', snap['host_disk_free_gb']),
+        ('pdl_schedulable_cpu_cores', 'CPU cores available to containers after headroom', snap['schedulable_cpu_cores']),
+        ('pdl_schedulable_ram_gb', 'RAM available to containers after headroom in GB', snap['schedulable_ram_gb']),
+        ('pdl_schedulable_disk_gb', 'Disk available to user images after headroom in GB', snap['schedulable_disk_gb']),
+        ('pdl_allocated_cpu_cores', 'CPU cores reserved by running containers', snap['allocated_cpu_cores']),
+        ('pdl_allocated_ram_gb', 'RAM reserved by running containers in GB', snap['allocated_ram_gb']),
+        ('pdl_allocated_disk_gb', 'Logical size of all user disk images in GB', snap['allocated_disk_gb']),
+        ('pdl_used_cpu_cores', 'CPU cores actually used by running containers', snap['used_cpu_cores']),
+        ('pdl_used_ram_gb', 'RAM actually used by running containers in GB', snap['used_ram_gb']),
+        ('pdl_used_disk_gb', 'Blocks actually written to user disk images in GB', snap['used_disk_gb']),
+        ('pdl_pending_requests', 'Super user requests waiting for approval', snap['pending_requests']),
+    ]
+    lines = []
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    lines.append("# HELP pdl_containers Containers by Docker state")
+    lines.append("# TYPE pdl_containers gauge")
+    for state, count in sorted(snap['containers_by_state'].items()):
+        lines.append(f'pdl_containers{{state="{state}"}} {count}')
+
+    for name, help_text in [
+        ('provision_success_total', 'Containers provisioned successfully'),
+        ('provision_failure_total', 'Container provisioning attempts that failed'),
+    ]:
+        lines.append(f"# HELP pdl_{name} {help_text}")
+        lines.append(f"# TYPE pdl_{name} counter")
+        lines.append(f"pdl_{name} {snap[name]}")
+
+    lines.append("# HELP pdl_metrics_snapshot_timestamp_seconds When the cached snapshot was taken")
+    lines.append("# TYPE pdl_metrics_snapshot_timestamp_seconds gauge")
+    lines.append(f"pdl_metrics_snapshot_timestamp_seconds {snap['timestamp']}")
+    return "\n".join(lines) + "\n"
+
+
+# I/O governance profiles. Rates are MB/s, IOPS and Mbit/s; 0 means unlimited.
+DEFAULT_IO_PROFILES = {
+    'standard': {'read_mbps': 100, 'write_mbps': 50, 'read_iops': 2000, 'write_iops': 1000, 'net_mbit': 200},
+    'high': {'read_mbps': 400, 'write_mbps': 200, 'read_iops': 8000, 'write_iops': 4000, 'net_mbit': 1000},
+}
+IO_LIMIT_FIELDS = ['read_mbps', 'write_mbps', 'read_iops', 'write_iops', 'net_mbit']
 
 def get_global_limits():
     """Reads the global resource limits set by the admin."""
     defaults = {
         'max_cpu': 2.0,       # Default limit if file missing
         'max_memory_gb': 8, # Default 4GB
-        'max_ram_gb': 4 
+        'max_ram_gb': 4,
+        'io_profiles': DEFAULT_IO_PROFILES,
+        'pin_threshold_cpus': 4,  # Containers with at least this many CPUs get dedicated cores
+        'package_cache_enabled': True,  # Mount the shared pip/apt/maven/ivy caches
+        'shared_cluster_enabled': False,  # New containers are clients of one shared HDFS/YARN cluster
+        'shared_cluster_cpus': 8,
+        'shared_cluster_ram_gb': 32,
+        # Rolling 7-day budgets of allocated CPU-hours and RAM GB-hours per user, 0 = unlimited
+        'quota_cpu_hours_week': 0,
+        'quota_ram_gb_hours_week': 0,
+        'quota_action': 'throttle',  # or 'stop' (hibernate) once a user is over quota
+        # Approved super-user containers are leased; at expiry they drop to the standard limits
+        'lease_default_hours': 168,
+        'lease_expiry_action': 'scale_down',  # or 'stop' (hibernate, then scale down)
+        # Lend the CPU quota of idle shared-pool containers to busy ones, within these bounds of their grant
+        'rebalance_enabled': False,
+        'rebalance_min_fraction': 0.5,
+        'rebalance_max_factor': 2.0
     }
     
     if not os.path.exists(SETTINGS_FILE):
@@ -143,23 +407,300 @@ def get_global_limits():
         
     try:
         with open(SETTINGS_FILE, 'r') as f:
-            return json.load(f)
+            # Settings saved by older versions lack the newer keys, fill them from defaults
+            limits = dict(defaults)
+            limits.update(json.load(f))
+            return limits
     except:
         return defaults
 
-def save_global_limits(cpu, mem_gb, ram_gb):
+def save_global_limits(cpu, mem_gb, ram_gb, io_profiles=None, pin_threshold_cpus=None, package_cache_enabled=None,
+                       shared_cluster_enabled=None, shared_cluster_cpus=None, shared_cluster_ram_gb=None,
+                       quota_cpu_hours_week=None, quota_ram_gb_hours_week=None, quota_action=None,
+                       lease_default_hours=None, lease_expiry_action=None, rebalance_enabled=None,
+                       rebalance_min_fraction=None, rebalance_max_factor=None):
     """Saves the limits to the JSON file."""
-    data = {
+    data = get_global_limits()
+    data.update({
         'max_cpu': float(cpu),
         'max_memory_gb': int(mem_gb),
         'max_ram_gb' : int(ram_gb)
-    }
+    })
+    if io_profiles is not None:
+        data['io_profiles'] = io_profiles
+    if pin_threshold_cpus is not None:
+        data['pin_threshold_cpus'] = float(pin_threshold_cpus)
+    if package_cache_enabled is not None:
+        data['package_cache_enabled'] = bool(package_cache_enabled)
+    if shared_cluster_enabled is not None:
+        data['shared_cluster_enabled'] = bool(shared_cluster_enabled)
+    if shared_cluster_cpus:
+        data['shared_cluster_cpus'] = float(shared_cluster_cpus)
+    if shared_cluster_ram_gb:
+        data['shared_cluster_ram_gb'] = int(shared_cluster_ram_gb)
+    if quota_cpu_hours_week is not None:
+        data['quota_cpu_hours_week'] = float(quota_cpu_hours_week or 0)
+    if quota_ram_gb_hours_week is not None:
+        data['quota_ram_gb_hours_week'] = float(quota_ram_gb_hours_week or 0)
+    if quota_action in ('throttle', 'stop'):
+        data['quota_action'] = quota_action
+    if lease_default_hours:
+        data['lease_default_hours'] = float(lease_default_hours)
+    if lease_expiry_action in ('scale_down', 'stop'):
+        data['lease_expiry_action'] = lease_expiry_action
+    if rebalance_enabled is not None:
+        data['rebalance_enabled'] = bool(rebalance_enabled)
+    if rebalance_min_fraction:
+        data['rebalance_min_fraction'] = min(float(rebalance_min_fraction), 1.0)
+    if rebalance_max_factor:
+        data['rebalance_max_factor'] = max(float(rebalance_max_factor), 1.0)
     with open(SETTINGS_FILE, 'w') as f:
         json.dump(data, f)
 
+def get_io_profile(name):
+    """Returns the named I/O profile from the global settings (falls back to 'standard')."""
+    profiles = get_global_limits()['io_profiles']
+    return profiles.get(name) or profiles.get('standard') or DEFAULT_IO_PROFILES['standard']
+
+def get_block_device_for_path(path):
+    """Returns the whole-disk device node holding `path` (blkio limits reject partitions)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    dev_id = f"{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+    sys_dir = os.path.realpath(f"/sys/dev/block/{dev_id}")
+    if os.path.exists(os.path.join(sys_dir, 'partition')):
+        # Partition -> parent disk
+        with open(os.path.join(os.path.dirname(sys_dir), 'dev')) as f:
+            dev_id = f.read().strip()
+    node = f"/dev/block/{dev_id}"
+    return node if os.path.exists(node) else None
 
-def generate_user_keys(username):
-    """Generates an SSH key pair for the user."""
+def build_io_flags(profile, devices):
+    """docker run flags that throttle block I/O on each device according to the profile."""
+    flags = []
+    for device in devices:
+        if profile.get('read_mbps'):
+            flags += ["--device-read-bps", f"{device}:{int(profile['read_mbps'])}mb"]
+        if profile.get('write_mbps'):
+            flags += ["--device-write-bps", f"{device}:{int(profile['write_mbps'])}mb"]
+        if profile.get('read_iops'):
+            flags += ["--device-read-iops", f"{device}:{int(profile['read_iops'])}"]
+        if profile.get('write_iops'):
+            flags += ["--device-write-iops", f"{device}:{int(profile['write_iops'])}"]
+    return flags
+
+def get_throttled_devices(username):
+    """Devices a user's container does I/O on: their loop-mounted image and the host disk."""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    devices = []
+    loop = loop_device_for(os.path.join(base_dir, 'user_data', f"{username}.img"))
+    if loop:
+        devices.append(loop)
+    # The container's writable layer (apt installs, /tmp, Spark spill) lives on the host disk
+    host_disk = get_block_device_for_path(base_dir)
+    if host_disk and host_disk not in devices:
+        devices.append(host_disk)
+    return devices
+
+def find_container_cgroup(container_id, controller=None):
+    """Locates a container's cgroup directory for cgroup v2 or the given v1 controller."""
+    candidates = []
+    if os.path.exists('/sys/fs/cgroup/cgroup.controllers'):
+        roots = ['/sys/fs/cgroup']
+    else:
+        roots = [f'/sys/fs/cgroup/{controller}']
+    for root in roots:
+        candidates += [
+            os.path.join(root, 'system.slice', f'docker-{container_id}.scope'),   # systemd driver
+            os.path.join(root, 'docker', container_id),                          # cgroupfs driver
+        ]
+    for path in candidates:
+        if os.path.isdir(path):
+            return path
+    return None
+
+def set_network_limit(container_name, net_mbit):
+    """Shapes the container's egress bandwidth with tc inside its network namespace."""
+    pid = subprocess.run(["docker", "inspect", "-f", "{{.State.Pid}}", container_name],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    if not pid or pid == '0':
+        return False
+    netns = ["nsenter", "-t", pid, "-n"]
+    if net_mbit:
+        cmd = netns + ["tc", "qdisc", "replace", "dev", "eth0", "root", "tbf",
+                       "rate", f"{int(net_mbit)}mbit", "burst", "256kb", "latency", "400ms"]
+    else:
+        cmd = netns + ["tc", "qdisc", "del", "dev", "eth0", "root"]
+    return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+def apply_io_profile(username, profile_name, remember=True):
+    """Changes a running container's disk and network limits in place (no restart)."""
+    container_name = f"{username}_container"
+    profile = get_io_profile(profile_name)
+    container_id = subprocess.run(["docker", "inspect", "-f", "{{.Id}}", container_name],
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    if not container_id:
+        return False, "Container not found"
+
+    # docker update cannot change device throttles, so write the cgroup files directly
+    cgroup_v2 = os.path.exists('/sys/fs/cgroup/cgroup.controllers')
+    cgroup = find_container_cgroup(container_id, 'blkio')
+    if cgroup is None:
+        return False, "Container cgroup not found"
+    mb = 1024 * 1024
+    try:
+        for device in get_throttled_devices(username):
+            st = os.stat(device)
+            dev_id = f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}"
+            if cgroup_v2:
+                limits = {
+                    'rbps': int(profile['read_mbps'] * mb) if profile.get('read_mbps') else 'max',
+                    'wbps': int(profile['write_mbps'] * mb) if profile.get('write_mbps') else 'max',
+                    'riops': int(profile['read_iops']) if profile.get('read_iops') else 'max',
+                    'wiops': int(profile['write_iops']) if profile.get('write_iops') else 'max',
+                }
+                with open(os.path.join(cgroup, 'io.max'), 'w') as f:
+                    f.write(f"{dev_id} " + " ".join(f"{k}={v}" for k, v in limits.items()))
+            else:
+                # v1 takes one "<dev> <value>" line per file, 0 removes the limit
+                for filename, value in [
+                    ('blkio.throttle.read_bps_device', int(profile.get('read_mbps', 0) * mb)),
+                    ('blkio.throttle.write_bps_device', int(profile.get('write_mbps', 0) * mb)),
+                    ('blkio.throttle.read_iops_device', int(profile.get('read_iops', 0))),
+                    ('blkio.throttle.write_iops_device', int(profile.get('write_iops', 0))),
+                ]:
+                    with open(os.path.join(cgroup, filename), 'w') as f:
+                        f.write(f"{dev_id} {value}")
+    except OSError as e:
+        return False, f"Failed to update I/O limits: {e}"
+
+    if not set_network_limit(container_name, profile.get('net_mbit', 0)):
+        print(f"Warning: could not apply network limit to {container_name} (needs nsenter and tc on the host)")
+
+    if remember:
+        # Labels are immutable, so remember live changes next to the other state files
+        overrides = get_io_overrides()
+        overrides[username] = profile_name
+        with open(IO_OVERRIDES_FILE, 'w') as f:
+            json.dump(overrides, f)
+    return True, f"Applied I/O profile '{profile_name}'"
+
+def reapply_io_profile(username):
+    """Restores the limits a start loses: the tc qdisc lived in the old network namespace and
+    a live profile change in the old cgroup. The docker run device limits survive on their own."""
+    container_name = f"{username}_container"
+    profile_name = get_io_overrides().get(username)
+    if profile_name:
+        # The docker run flags still hold the label's profile, a live change has to be redone
+        success, msg = apply_io_profile(username, profile_name, remember=False)
+        if success:
+            return
+        print(f"Warning: could not re-apply I/O profile '{profile_name}' to {container_name}: {msg}")
+    else:
+        result = subprocess.run(["docker", "inspect", container_name], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        if result.returncode != 0 or not result.stdout.strip():
+            return
+        labels = json.loads(result.stdout)[0]['Config'].get('Labels') or {}
+        profile_name = labels.get('pdl.io_profile', 'standard')
+    net_mbit = get_io_profile(profile_name).get('net_mbit')
+    if net_mbit and not set_network_limit(container_name, net_mbit):
+        print(f"Warning: could not apply network limit to {container_name} (needs nsenter and tc on the host)")
+
+# --- Disk resize ---
+# Headroom kept above the filesystem's used space when shrinking (ext4 metadata, journal)
+SHRINK_HEADROOM = 1.1
+SHRINK_MIN_FREE_MB = 256
+
+def get_user_disk_paths(username):
+    """(mount folder, image file) of a user's persistent disk."""
+    user_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'user_data')
+    return os.path.join(user_data_dir, username), os.path.join(user_data_dir, f"{username}.img")
+
+def resize_user_disk(username, new_size_gb):
+    """Grows or shrinks a user's disk image in place. Returns (success, message).
+
+    Growing works while the container runs: the image is extended, the loop device
+    re-reads its size and resize2fs grows the mounted ext4 online. ext4 can only shrink
+    offline, so shrinking needs the container stopped and the image unmounted.
+    Callers hold the admission lock (request.lock), like provisioning.
+    """
+    from app import setup_user_disk
+    user_folder, disk_image = get_user_disk_paths(username)
+    if not os.path.exists(disk_image):
+        return False, f"{username} has no disk image"
+    new_bytes = int(float(new_size_gb) * 1024**3)
+    current_bytes = os.path.getsize(disk_image)
+    if new_bytes == current_bytes:
+        return True, "Disk already has the requested size"
+
+    if new_bytes > current_bytes:
+        delta_gb = (new_bytes - current_bytes) / (1024**3)
+        free_gb = get_available_resources()['host_free_disk_gb']
+        if delta_gb > free_gb:
+            return False, f"Insufficient disk space. Requested: +{delta_gb:.1f}GB, Available: {free_gb:.1f}GB"
+        # Allocate the new blocks up front like the dd-created original, fall back to sparse
+        if subprocess.run(["fallocate", "-l", str(new_bytes), disk_image], stderr=subprocess.DEVNULL).returncode != 0:
+            subprocess.run(["truncate", "-s", str(new_bytes), disk_image], check=True)
+        loop_device = loop_device_for(disk_image)
+        if loop_device:
+            subprocess.run(["sudo", "losetup", "-c", loop_device], check=True)
+            result = subprocess.run(["sudo", "resize2fs", loop_device], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        else:
+            subprocess.run(["e2fsck", "-f", "-p", disk_image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            result = subprocess.run(["resize2fs", disk_image], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0:
+            return False, f"Image extended but the filesystem could not grow: {result.stdout.strip()}"
+        print(f"Grew {username}'s disk to {new_size_gb}GB")
+        return True, f"Disk grown to {new_size_gb}GB"
+
+    # --- Shrink (offline) ---
+    state = subprocess.run(["docker", "inspect", "-f", "{{.State.Status}}", f"{username}_container"],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if state.returncode == 0 and state.stdout.strip() in ('running', 'paused', 'restarting'):
+        return False, "Stop the container before shrinking its disk"
+    loop_device = loop_device_for(disk_image)
+    if loop_device:
+        st = os.statvfs(user_folder)
+        used_bytes = (st.f_blocks - st.f_bfree) * st.f_frsize
+        if used_bytes * SHRINK_HEADROOM + SHRINK_MIN_FREE_MB * 1024**2 > new_bytes:
+            return False, f"{used_bytes / 1024**3:.1f}GB in use, cannot shrink to {new_size_gb}GB"
+        unmounted, msg = unmount(user_folder, disk_image)
+        if not unmounted:
+            return False, f"Could not unmount the disk: {msg}"
+    try:
+        # e2fsck exit codes 0-3 mean clean or corrected; resize2fs refuses a dirty fs
+        if subprocess.run(["e2fsck", "-f", "-y", disk_image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode >= 4:
+            return False, "Filesystem check failed, disk left at its current size"
+        result = subprocess.run(["resize2fs", disk_image, f"{new_bytes // 1024**2}M"],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if result.returncode != 0:
+            return False, f"Filesystem cannot shrink to {new_size_gb}GB: {result.stdout.strip()}"
+        subprocess.run(["truncate", "-s", str(new_bytes), disk_image], check=True)
+    finally:
+        setup_user_disk(username)
+    print(f"Shrank {username}'s disk to {new_size_gb}GB")
+    return True, f"Disk shrunk to {new_size_gb}GB"
+
+def get_io_overrides():
+    if not os.path.exists(IO_OVERRIDES_FILE): return {}
+    try:
+        with open(IO_OVERRIDES_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def forget_io_override(username):
+    overrides = get_io_overrides()
+    if username in overrides:
+        del overrides[username]
+        with open(IO_OVERRIDES_FILE, 'w') as f:
+            json.dump(overrides, f)
+
+
+def generate_user_keys(username, keep_existing=False):
+    """Generates an SSH key pair for the user (keep_existing reuses a pair already on the volume)."""
     base_dir = os.path.dirname(os.path.abspath(__file__))
     # Save keys inside the user's persistent data folder
     key_dir = os.path.join(base_dir, 'user_data', username)
@@ -168,6 +709,10 @@ def generate_user_keys(username):
     private_key_path = os.path.join(key_dir, f"{username}_key.pem")
     public_key_path = os.path.join(key_dir, f"{username}_key.pem.pub")
 
+    if keep_existing and os.path.exists(private_key_path) and os.path.exists(public_key_path):
+        with open(public_key_path, 'r') as f:
+            return private_key_path, f.read().strip()
+
     # If key already exists, delete it to ensure a fresh key for the new container
     if os.path.exists(private_key_path):
         os.remove(private_key_path)
@@ -191,7 +736,7 @@ def generate_user_keys(username):
         
     return private_key_path, public_key_str
 
-def save_resource_request(username, cpus, mem_gb, ram_gb, reason):
+def save_resource_request(username, cpus, mem_gb, ram_gb, reason, io_profile='standard'):
     """Saves a pending request to JSON."""
     if os.path.exists(REQUESTS_FILE):
         with open(REQUESTS_FILE, 'r') as f:
@@ -204,25 +749,269 @@ def save_resource_request(username, cpus, mem_gb, ram_gb, reason):
         'memory_gb': int(float(mem_gb)),
         'ram_gb': ram_gb,
         'reason': reason,
+        'io_profile': io_profile,
         'timestamp': time.time()
     }
     
     with open(REQUESTS_FILE, 'w') as f:
         json.dump(requests, f)
 
+def request_key(username, request_type=None):
+    """requests.json key: resource requests keep the bare username, other types get a suffix."""
+    return f"{username}:{request_type}" if request_type else username
+
+def parse_disk_size_gb(value):
+    """Returns a requested disk size in GB as a positive int, or None if it isn't one."""
+    try:
+        size_gb = int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return size_gb if size_gb > 0 else None
+
+def save_disk_resize_request(username, new_size_gb, reason):
+    """Saves a pending disk resize request next to any pending resource request of the user."""
+    requests = get_all_requests()
+    requests[request_key(username, 'disk_resize')] = {
+        'type': 'disk_resize',
+        'username': username,
+        'memory_gb': int(float(new_size_gb)),
+        'reason': reason,
+        'timestamp': time.time()
+    }
+    with open(REQUESTS_FILE, 'w') as f:
+        json.dump(requests, f)
+
 def get_all_requests():
     if not os.path.exists(REQUESTS_FILE): return {}
     with open(REQUESTS_FILE, 'r') as f:
         return json.load(f)
 
-def delete_request(username):
+def delete_request(username, request_type=None):
     requests = get_all_requests()
-    if username in requests:
-        del requests[username]
+    key = request_key(username, request_type)
+    if key in requests:
+        del requests[key]
         with open(REQUESTS_FILE, 'w') as f:
             json.dump(requests, f)
 
-def provision_container(username, cpus, mem_gb, ram_gb):
+# --- CPU Pinning / NUMA Placement ---
+def parse_cpu_list(cpu_list):
+    """Parses kernel/docker CPU lists like '0-3,8,10-11' into a sorted list of ints."""
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def format_cpu_list(cpus):
+    """Formats a list of CPU ids as a compact range list ('0-3,8')."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(f"{a}-{b}" if a != b else f"{a}" for a, b in ranges)
+
+def get_numa_topology():
+    """Returns {node_id: [cpu ids]} from sysfs, or a single node holding every CPU."""
+    topology = {}
+    node_dir = '/sys/devices/system/node'
+    if os.path.isdir(node_dir):
+        for entry in os.listdir(node_dir):
+            if entry.startswith('node') and entry[4:].isdigit():
+                try:
+                    with open(os.path.join(node_dir, entry, 'cpulist')) as f:
+                        cpus = parse_cpu_list(f.read())
+                except OSError:
+                    continue
+                if cpus:
+                    topology[int(entry[4:])] = cpus
+    if not topology:
+        topology = {0: list(range(os.cpu_count()))}
+    return topology
+
+def get_cpuset_assignments():
+    if not os.path.exists(CPUSET_FILE): return {}
+    with open(CPUSET_FILE, 'r') as f:
+        # Admission reads this, it must never see a file halfway through a rewrite
+        fcntl.flock(f, fcntl.LOCK_SH)
+        raw = f.read()
+    try:
+        return json.loads(raw) if raw.strip() else {}
+    except ValueError:
+        return {}
+
+def _update_cpuset_assignments(update):
+    with open(CPUSET_FILE, 'a+') as f:
+        # Both portals place, resize and release containers, some of it outside request.lock
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        assignments = json.loads(raw) if raw.strip() else {}
+        result = update(assignments)
+        f.seek(0)
+        f.truncate()
+        json.dump(assignments, f)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+def get_shared_cpu_pool(assignments=None):
+    """CPUs not dedicated to any container."""
+    if assignments is None:
+        assignments = get_cpuset_assignments()
+    dedicated = {cpu for a in assignments.values() if a['dedicated'] for cpu in a['cpus']}
+    all_cpus = [cpu for cpus in get_numa_topology().values() for cpu in cpus]
+    return [cpu for cpu in sorted(all_cpus) if cpu not in dedicated]
+
+def _drop_stale_assignments(assignments, existing):
+    for user in [user for user in assignments if f"{user}_container" not in existing]:
+        del assignments[user]
+
+def reconcile_cpuset_assignments():
+    """Drops assignments whose container no longer exists and returns the rest."""
+    existing = {c['Names'] for c in get_all_containers_details()}
+    def drop(assignments):
+        _drop_stale_assignments(assignments, existing)
+        return dict(assignments)
+    return _update_cpuset_assignments(drop)
+
+def _pick_dedicated_cpus(count, assignments):
+    """Chooses `count` free cores, on a single NUMA node when possible (best fit)."""
+    dedicated = {cpu for a in assignments.values() if a['dedicated'] for cpu in a['cpus']}
+    free_by_node = {
+        node: [cpu for cpu in cpus if cpu not in dedicated]
+        for node, cpus in get_numa_topology().items()
+    }
+    # Always leave two cores (the host headroom used by get_available_resources) unpinned
+    if sum(len(cpus) for cpus in free_by_node.values()) - count < 2:
+        return None, None
+    fitting = [node for node, cpus in free_by_node.items() if len(cpus) >= count]
+    if fitting:
+        node = min(fitting, key=lambda n: len(free_by_node[n]))
+        return free_by_node[node][:count], [node]
+    # Too big for one node: spread over the emptiest nodes first
+    chosen, nodes = [], []
+    for node in sorted(free_by_node, key=lambda n: -len(free_by_node[n])):
+        take = free_by_node[node][:count - len(chosen)]
+        if take:
+            chosen += take
+            nodes.append(node)
+        if len(chosen) == count:
+            break
+    return chosen, sorted(nodes)
+
+def _update_shared_containers(assignments):
+    """Re-pins every shared-pool container after the pool changed."""
+    pool = format_cpu_list(get_shared_cpu_pool(assignments))
+    for user, a in assignments.items():
+        if not a['dedicated']:
+            subprocess.run(["docker", "update", "--cpuset-cpus", pool, f"{user}_container"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+def allocate_cpuset(username, cpus, dedicated):
+    """Reserves CPUs for a new container and returns the docker run flags for them.
+
+    Dedicated containers get whole cores (and their NUMA node's memory) to themselves;
+    everyone else shares the remaining cores. Falls back to the shared pool when not
+    enough free cores are left for a dedicated placement.
+    """
+    import math
+    existing = {c['Names'] for c in get_all_containers_details()}
+    topology = get_numa_topology()
+
+    def place(assignments):
+        # Picking the cores and recording them is one step, two placements can't pick the same core
+        _drop_stale_assignments(assignments, existing)
+        assignments.pop(username, None)
+        if dedicated:
+            chosen, nodes = _pick_dedicated_cpus(math.ceil(float(cpus)), assignments)
+            if chosen:
+                assignments[username] = {'cpus': chosen, 'mems': nodes, 'dedicated': True}
+                return assignments[username], dict(assignments)
+            print(f"Not enough free cores to pin {username}, using the shared pool")
+        assignments[username] = {'cpus': get_shared_cpu_pool(assignments), 'mems': sorted(topology), 'dedicated': False}
+        return assignments[username], dict(assignments)
+
+    placed, assignments = _update_cpuset_assignments(place)
+    if placed['dedicated']:
+        # The pool shrank, move shared containers off the newly dedicated cores
+        _update_shared_containers(assignments)
+        flags = ["--cpuset-cpus", format_cpu_list(placed['cpus']), "--label", "pdl.cpu_pinning=dedicated"]
+        if len(topology) > 1:
+            flags += ["--cpuset-mems", format_cpu_list(placed['mems'])]
+        return flags
+    return ["--cpuset-cpus", format_cpu_list(placed['cpus']), "--label", "pdl.cpu_pinning=shared"]
+
+def get_cpu_grants(assignments=None):
+    """{username: CPUs granted}, the --cpus a container was provisioned or resized to.
+
+    The live quota can differ (rebalancer loans, a quota throttle), so allocation, sizing
+    and anything restoring a quota read the grant instead.
+    """
+    if assignments is None:
+        assignments = get_cpuset_assignments()
+    return {user: a['granted'] for user, a in assignments.items() if a.get('granted') is not None}
+
+def set_cpu_grant(username, cpus):
+    """Records a container's grant next to its cpuset, False when it has no assignment."""
+    def grant(assignments):
+        if username not in assignments:
+            return False
+        assignments[username]['granted'] = float(cpus)
+        return True
+    return _update_cpuset_assignments(grant)
+
+def release_cpuset(username):
+    """Returns a container's cores to the shared pool."""
+    released = _update_cpuset_assignments(lambda assignments: assignments.pop(username, None))
+    if released and released['dedicated']:
+        _update_shared_containers(get_cpuset_assignments())
+
+def shrink_cpuset(username, cpus):
+    """Keeps only as many of a pinned container's dedicated cores as `cpus` needs.
+
+    The rest go back to the shared pool. Returns the docker update flags for the
+    container ([] when it isn't pinned or already fits).
+    """
+    import math
+    def shrink(assignments):
+        assignment = assignments.get(username)
+        if not assignment or not assignment['dedicated']:
+            return None
+        keep = assignment['cpus'][:max(1, math.ceil(float(cpus)))]
+        if keep == assignment['cpus']:
+            return None
+        assignment['cpus'] = keep
+        return keep
+    keep = _update_cpuset_assignments(shrink)
+    if not keep:
+        return []
+    _update_shared_containers(get_cpuset_assignments())
+    return ["--cpuset-cpus", format_cpu_list(keep)]
+
+def prepare_hdfs_volume(container_name):
+    """Volume layout, plus the first-time NameNode format when the volume has no metadata yet."""
+    result = subprocess.run(["docker", "exec", container_name, "bash", "-c",
+        "mkdir -p /data/home /data/hdfs/namenode /data/hdfs/datanode && chmod -R 777 /data && chmod -R 755 /data/hdfs && "
+        "if [ ! -f /data/hdfs/namenode/current/VERSION ]; then "
+        "rm -rf /data/hdfs/datanode/current && (echo 'Y' | hdfs namenode -format > /dev/null 2>&1) && echo formatted; fi"],
+        stdout=subprocess.PIPE, text=True, check=True)
+    return "formatted" in result.stdout
+
+def provision_container(username, cpus, mem_gb, ram_gb, io_profile='standard', dedicated_cpus=None, keep_keys=False):
+    # Refuse sizes the daemons can't fit in before anything is created
+    if not get_global_limits()['shared_cluster_enabled']:
+        try:
+            container_services(cpus, int(ram_gb.lower().replace("g", "")) * 1024)
+        except ValueError as e:
+            return False, str(e)
     # --- 2. Data Persistence Setup ---
     # We create a folder on the HOST machine for this user
     try:
@@ -230,194 +1019,76 @@ def provision_container(username, cpus, mem_gb, ram_gb):
         # This creates a 5GB limit for this user
         user_data_path = setup_user_disk(username, size_gb=mem_gb) 
 
-        private_key_path, pubkey_str = generate_user_keys(username)
-
-        ssh_port = random.randint(2000, 3000)
-        containers = get_all_containers_details()
-        used_ports = {
-            extract_host_port(p)
-            for c in containers 
-            for p in c['Ports'].split(',') 
-            if p != 'N/A'}
-            
-        attempts = 0
-        while ssh_port in used_ports:
-            ssh_port += 1
-            if ssh_port > 3000: # Wrap around
-                ssh_port = 2000
-            attempts += 1
-            if attempts > 1000: # We checked every port from 2000-3000
-                return "Error: No SSH ports available on server!", 500
+        # A migrated volume brings the user's key along, their private key keeps working
+        private_key_path, pubkey_str = generate_user_keys(username, keep_existing=keep_keys)
+        # Logins go through the SSH gateway (ssh_gateway.py), so no host port is published per container
 
 
         container_name = f"{username}_container"
+        profile = get_io_profile(io_profile)
+        limits = get_global_limits()
+        if dedicated_cpus is None:
+            dedicated_cpus = float(cpus) >= float(limits['pin_threshold_cpus'])
+        cpuset_flags = allocate_cpuset(username, cpus, dedicated_cpus)
+        ram_mb = int(ram_gb.lower().replace("g", "")) * 1024
+        # Shared mode: the allocation becomes a YARN queue and the container only runs the client side
+        shared = bool(limits['shared_cluster_enabled'])
+        if shared:
+            ensure_shared_cluster()
+            config_profile = client_profile(cpus, ram_mb)
+            run_cpus, run_ram_mb = client_container_limits(cpus, ram_mb)
+            run_cpus, run_ram = str(run_cpus), f"{run_ram_mb}m"
+        else:
+            config_profile = ConfigProfile.for_limits(cpus, ram_mb, services=container_services(cpus, ram_mb))
+            run_cpus, run_ram = cpus, ram_gb
+        set_cpu_grant(username, run_cpus)
+        sizing = compute_hadoop_sizing(cpus, ram_mb, services=config_profile.services)
+        # Daemons start once the rendered config is in place, not from entrypoint.sh
+        open(os.path.join(user_data_path, '.skip_service_start'), 'w').close()
 
         cmd = [
             "docker", "run", "-d",
             "--name", container_name,
-            "--cpus", cpus,
-            "--memory", ram_gb,         #ram
-            "-p", f"{ssh_port}:22",
+            "--cpus", run_cpus,
+            "--memory", run_ram,         #ram
+            "--label", f"pdl.io_profile={io_profile}",
+            *build_io_flags(profile, get_throttled_devices(username)),
+            *cpuset_flags,
+            *docker_env_flags(sizing),
+            *(package_cache_flags(username, user_data_path) if limits['package_cache_enabled'] else []),
+            *dataset_mount_flags(),
+            *(client_docker_flags() if shared else []),
            
             "-v", f"{user_data_path}:/data", 
             "hadoop_container" 
         ]
         subprocess.run(cmd, check=True)
+        if profile.get('net_mbit') and not set_network_limit(container_name, profile['net_mbit']):
+            print(f"Warning: could not apply network limit to {container_name} (needs nsenter and tc on the host)")
+        forget_io_override(username)
         
-        # Create subdirectories in the mounted volume for user home and HDFS data
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", f"mkdir -p /data/home /data/hdfs"], check=True)
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", f"chmod -R 777 /data"], check=True)
-
-        ram_gb = int(ram_gb.lower().replace("g", ""))
-        ram_mb = ram_gb * 1024
-
-        subprocess.run([
-            "docker", "exec", container_name,
-            "bash", "-c",
-            f"""
-            sed -i '/<name>yarn.nodemanager.resource.memory-mb<\\/name>/,/<\\/property>/d' \
-            $HADOOP_HOME/etc/hadoop/yarn-site.xml
-
-            sed -i '/<configuration>/a \
-            <property>\\
-            <name>yarn.nodemanager.resource.memory-mb</name>\\
-            <value>{ram_mb}</value>\\
-            </property>' \
-            $HADOOP_HOME/etc/hadoop/yarn-site.xml
-            """
-        ], check=True)
-
-        subprocess.run(
-            ["docker", "exec", container_name, "bash", "-c", "start-dfs.sh"],
-            check=True
-        )
+        # Config is rendered on the host (cached per profile) and copied in before any daemon starts
+        deliver_config_bundle(container_name, config_profile)
 
-        print("Waiting for HDFS to be ready...")
-        hdfs_ready = False
-        for i in range(10):  # Try 10 times (approx 50 seconds)
-            try:
-                # We try to list the root directory. If this succeeds, HDFS is up.
-                subprocess.run(
-                    ["docker", "exec", container_name, "hdfs", "dfs", "-ls", "/"], 
-                    check=True, 
-                    stdout=subprocess.DEVNULL, 
-                    stderr=subprocess.DEVNULL
-                )
-                hdfs_ready = True
-                print("HDFS is ready!")
-                break
-            except subprocess.CalledProcessError:
-                print(f"HDFS not ready yet (Attempt {i+1}/10)...")
-                time.sleep(5)
-
-        if not hdfs_ready:
-            # Depending on your preference, you might want to cleanup and fail here
-            print("WARNING: HDFS setup timed out. User may need to start it manually.")
-        
-        # IMPORTANT: Reconfigure HDFS to use mounted volume for persistence
-        print("Reconfiguring HDFS to use persistent storage...")
-        
-        # Stop HDFS services
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", "stop-dfs.sh"], check=False)
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", "stop-yarn.sh"], check=False)
-        time.sleep(3)
-        
-        # Create persistent HDFS directories
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", "mkdir -p /data/hdfs/namenode /data/hdfs/datanode && chmod -R 777 /data/hdfs"], check=True)
-        
-        # Backup original hdfs-site.xml and replace with new one pointing to persistent storage
-        hdfs_config = """<?xml version="1.0" encoding="UTF-8"?>
-<?xml-stylesheet type="text/xsl" href="configuration.xsl"?>
-<configuration>
-  <property>
-    <name>dfs.namenode.name.dir</name>
-    <value>/data/hdfs/namenode</value>
-  </property>
-  <property>
-    <name>dfs.datanode.data.dir</name>
-    <value>/data/hdfs/datanode</value>
-  </property>
-  <property>
-    <name>dfs.replication</name>
-    <value>1</value>
-  </property>
-</configuration>
-"""
-        
-        # Write config to temp file with unique name (avoid conflicts with multiple containers)
-        hdfs_config_path = f"/tmp/hdfs-site-{container_name}.xml"
-        try:
-            # Remove old file if it exists
-            if os.path.exists(hdfs_config_path):
-                os.remove(hdfs_config_path)
-        except:
-            pass
-        
-        with open(hdfs_config_path, 'w') as f:
-            f.write(hdfs_config)
-        subprocess.run(["docker", "cp", hdfs_config_path, f"{container_name}:/tmp/hdfs-site-new.xml"], check=True)
-        
-        # Clean up temp file
-        try:
-            os.remove(hdfs_config_path)
-        except:
-            pass
-        
-        # Replace the old hdfs-site.xml with the new one
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", 
-            "cp /tmp/hdfs-site-new.xml $HADOOP_HOME/etc/hadoop/hdfs-site.xml"], check=True)
-        
-        # Check if this is a fresh HDFS setup (no existing NameNode data)
-        # If there's existing NameNode data, don't reformat - just use it
-        namenode_check = subprocess.run(
-            ["docker", "exec", container_name, "bash", "-c", 
-             "test -f /data/hdfs/namenode/current/VERSION && echo 'exists' || echo 'notfound'"],
-            capture_output=True, text=True, check=True
-        )
-        is_fresh_hdfs = "notfound" in namenode_check.stdout
-        
-        if is_fresh_hdfs:
-            # FIRST TIME: Clear DataNode storage and format NameNode
-            print("Formatting HDFS NameNode (first-time setup)...")
-            subprocess.run(["docker", "exec", container_name, "bash", "-c", 
-                "rm -rf /data/hdfs/datanode/current"], check=True)
-            subprocess.run(["docker", "exec", container_name, "bash", "-c", 
-                "echo 'Y' | hdfs namenode -format"], check=False)
+        print("Preparing persistent storage...")
+        if shared:
+            # Persistent marker: entrypoint.sh never starts daemons in a client, whoever restarts it
+            subprocess.run(["docker", "exec", container_name, "bash", "-c",
+                f"mkdir -p /data/home $(dirname {CLIENT_MODE_MARKER}) && chmod 777 /data /data/home && touch {CLIENT_MODE_MARKER}"],
+                check=True)
+        elif prepare_hdfs_volume(container_name):
+            print("Formatted HDFS NameNode (first-time setup)")
         else:
-            # REUSING EXISTING DATA: Don't reformat, just use existing NameNode data
             print("Reusing existing HDFS NameNode data (no format needed)...")
-        
-        time.sleep(2)
-        
-        # Ensure all HDFS processes are fully stopped before restarting
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", 
-            "pkill -9 -f namenode || true"], check=False)
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", 
-            "pkill -9 -f datanode || true"], check=False)
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", 
-            "pkill -9 -f secondarynamenode || true"], check=False)
-        time.sleep(3)
-        
-        # Restart HDFS
-        print("Starting HDFS with persistent storage...")
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", "start-dfs.sh"], check=True)
-        
-        # Wait for HDFS to be ready again
-        print("Waiting for HDFS to be ready...")
-        for i in range(10):
-            try:
-                subprocess.run(
-                    ["docker", "exec", container_name, "hdfs", "dfs", "-ls", "/"],
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL
-                )
-                print("HDFS is ready with persistent storage!")
-                break
-            except subprocess.CalledProcessError:
-                print(f"HDFS not ready yet (Attempt {i+1}/10)...")
-                time.sleep(5)
-        
+
+        if not shared:
+            # start-dfs.sh/start-yarn.sh reach the daemons over ssh, so sshd must answer first
+            deadline = time.time() + 10
+            while 22 not in probe_service_ports(container_name, [22]) and time.time() < deadline:
+                time.sleep(0.2)
+            print("Starting Hadoop services...")
+            start_services(container_name, list(config_profile.services))
+
         # 1. Create the user with default home directory
         subprocess.run(["docker", "exec", container_name, "bash", "-c", f"id -u {username} > /dev/null 2>&1 || useradd -m -s /bin/bash {username}"], check=True)
         
@@ -428,8 +1099,10 @@ def provision_container(username, cpus, mem_gb, ram_gb):
         subprocess.run(["docker", "exec", container_name, "bash", "-c", f"rm -rf /home/{username} && ln -s /data/home/{username} /home/{username}"], check=True)
         
         # 3. Setup SSH keys in the persistent home directory (must be done as root for proper permissions)
+        # The gateway's route key for this user is trusted too, it carries the relayed sessions
+        route_pubkey = add_route(username, pubkey_str)
         subprocess.run(["docker", "exec", container_name, "bash", "-c", f"mkdir -p /home/{username}/.ssh && chmod 700 /home/{username}/.ssh"], check=True)
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", f"echo '{pubkey_str}' > /home/{username}/.ssh/authorized_keys && chmod 600 /home/{username}/.ssh/authorized_keys"], check=True)
+        subprocess.run(["docker", "exec", container_name, "bash", "-c", f"printf '%s\\n' '{pubkey_str}' '{route_pubkey}' > /home/{username}/.ssh/authorized_keys && chmod 600 /home/{username}/.ssh/authorized_keys"], check=True)
         subprocess.run(["docker", "exec", container_name, "bash", "-c", f"chown -R {username}:{username} /home/{username}/.ssh"], check=True)
         
         # Verify SSH setup
@@ -443,79 +1116,408 @@ def provision_container(username, cpus, mem_gb, ram_gb):
 
         # 4. Grant Sudo 
         subprocess.run(["docker", "exec", container_name, "usermod", "-aG", "sudo", username], check=True)
-        
-        # 5. Create persistent storage directories for HDFS
-        print("Setting up persistent storage...")
-        subprocess.run(["docker", "exec", container_name, "bash", "-c", f"mkdir -p /data/hdfs && chmod -R 755 /data/hdfs"], check=True)
-
-        # 6. Create and set ownership for the user's HDFS home directory
-        subprocess.run(["docker", "exec", container_name, "hdfs", "dfs", "-mkdir", "-p", f"/user/{username}"], check=True)
-        subprocess.run(["docker", "exec", container_name, "hdfs", "dfs", "-chown", f"{username}:{username}", f"/user/{username}"], check=True)
-
-        print("Starting YARN...")
-        subprocess.run([
-            "docker", "exec", container_name,
-            "bash", "-c",
-            "grep -q YARN_RESOURCEMANAGER_USER $HADOOP_HOME/etc/hadoop/yarn-env.sh || "
-            "echo 'export YARN_RESOURCEMANAGER_USER=root' >> $HADOOP_HOME/etc/hadoop/yarn-env.sh"
-        ], check=True)
-
-        subprocess.run([
-            "docker", "exec", container_name,
-            "bash", "-c",
-            "grep -q YARN_NODEMANAGER_USER $HADOOP_HOME/etc/hadoop/yarn-env.sh || "
-            "echo 'export YARN_NODEMANAGER_USER=root' >> $HADOOP_HOME/etc/hadoop/yarn-env.sh"
-        ], check=True)
-
-        subprocess.run([
-            "docker", "exec", container_name,
-            "bash", "-c",
-            f"""
-            sed -i '/<name>yarn.nodemanager.resource.cpu-vcores<\\/name>/,/<\\/property>/d' $HADOOP_HOME/etc/hadoop/yarn-site.xml
-            sed -i '/<configuration>/a \\
-            <property>\\
-            <name>yarn.nodemanager.resource.cpu-vcores</name>\\
-            <value>1</value>\\
-            </property>' $HADOOP_HOME/etc/hadoop/yarn-site.xml
-            """
-        ], check=True)
-
-
-        subprocess.run(
-            ["docker", "exec", container_name, "bash", "-c", "start-yarn.sh"],
-            check=True
-        )
-
-        print("Waiting for YARN to be ready...")
-        yarn_ready = False
 
-        for i in range(10):
-            try:
-                subprocess.run(
-                    ["docker", "exec", container_name, "bash", "-c", "yarn node -list | grep RUNNING"],
-                    check=True,
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL
-                )
-
-                yarn_ready = True
-                print("YARN is ready!")
-                break
-            except subprocess.CalledProcessError:
-                print(f"YARN not ready yet (Attempt {i+1}/10)...")
-                time.sleep(5)
-
-        if not yarn_ready:
-            raise RuntimeError("HDFS failed to start")
+        # Packages the user apt-installed in a previous container come back from the manifest on /data
+        replay_apt_manifest(container_name)
+        
+        if shared:
+            # 5. HDFS home with a space quota of the disk allocation, and the user's YARN queue
+            register_tenant(username, cpus, ram_mb, mem_gb)
+        else:
+            not_ready = wait_for_services(container_name, list(config_profile.services))
+            if not_ready:
+                raise RuntimeError(f"Services failed to start: {', '.join(not_ready)}")
 
+            # 5. Create and set ownership for the user's HDFS home directory
+            subprocess.run(["docker", "exec", container_name, "bash", "-c",
+                f"{SHORT_JVM}hdfs dfsadmin -safemode wait > /dev/null && hdfs dfs -mkdir -p /user/{username} && "
+                f"hdfs dfs -chown {username}:{username} /user/{username}"], check=True)
 
+        update_route(username)
+        record_provision_result(True)
+        record_event('provision', username, cpu=float(cpus), ram=float(str(ram_gb).lower().rstrip('g')),
+                     disk=int(float(mem_gb)), ok=True)
+        set_desired_state(username, 'running')
         return True, "Container Created Successfully"
 
     except Exception as e:
+        record_provision_result(False)
+        record_event('provision', username, cpu=float(cpus), ram=float(str(ram_gb).lower().rstrip('g')),
+                     disk=int(float(mem_gb)), ok=False)
         # Try to clean up the container if it was created
         try:
             if 'container_name' in locals():
                 subprocess.run(["docker", "rm", "-f", container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                release_cpuset(username)
+                release_tenants([username])
+                remove_routes([username])
+                remove_package_cache_volumes([username])
         except:
             pass
-        return False, str(e)
\ No newline at end of file
+        return False, str(e)
+
+# --- Hibernate / Resume ---
+# Daemons we know how to bring back, in start order. 'processes' are the jps names,
+# 'ports' answer once the service is usable and 'requires' must be ready first.
+HADOOP_SERVICES = {
+    'hdfs': {
+        'processes': ['NameNode', 'DataNode', 'SecondaryNameNode'],
+        'start': 'start-dfs.sh',
+        'ports': [9000, 9866],      # NameNode RPC, DataNode transfer
+        'requires': [],
+    },
+    'yarn': {
+        'processes': ['ResourceManager', 'NodeManager'],
+        'start': 'start-yarn.sh',
+        'ports': [8032, 8042],      # ResourceManager RPC, NodeManager web
+        'requires': [],
+    },
+    'zookeeper': {
+        'processes': ['QuorumPeerMain'],
+        'start': 'KAFKA_HEAP_OPTS="$PDL_ZOOKEEPER_HEAP_OPTS" $KAFKA_HOME/bin/zookeeper-server-start.sh -daemon $KAFKA_HOME/config/zookeeper.properties',
+        'ports': [2181],
+        'requires': [],
+    },
+    'kafka': {
+        'processes': ['Kafka'],
+        'start': 'KAFKA_HEAP_OPTS="$PDL_KAFKA_HEAP_OPTS" $KAFKA_HOME/bin/kafka-server-start.sh -daemon $KAFKA_HOME/config/server.properties',
+        'ports': [9092],
+        'requires': ['zookeeper'],
+    },
+}
+RESTART_READY_TIMEOUT = 90
+HIBERNATE_CHECKPOINT = 'hibernate'
+
+def container_services(cpus, ram_mb):
+    """HADOOP_SERVICES keys a container of this size runs: Kafka and ZooKeeper are left out of
+    small ones. Raises ValueError when not even HDFS and YARN fit."""
+    return compute_hadoop_sizing(cpus, ram_mb, services=list(HADOOP_SERVICES))['services']
+
+def get_running_java_processes(container_name):
+    """Returns the set of JVM main class names (from jps) running in a container."""
+    result = subprocess.run(
+        ["docker", "exec", container_name, "bash", "-c", "jps"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    if result.returncode != 0:
+        return set()
+    # jps prints "<pid> <ClassName>"
+    return {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+
+def get_running_services(container_name):
+    """Returns the HADOOP_SERVICES keys whose main daemon is running."""
+    processes = get_running_java_processes(container_name)
+    return [name for name, svc in HADOOP_SERVICES.items() if svc['processes'][0] in processes]
+
+def get_hibernated():
+    if not os.path.exists(HIBERNATE_FILE): return {}
+    with open(HIBERNATE_FILE, 'r') as f:
+        # Starts pick checkpoint restore or a cold start from this, never from a half-written file
+        fcntl.flock(f, fcntl.LOCK_SH)
+        raw = f.read()
+    try:
+        return json.loads(raw) if raw.strip() else {}
+    except ValueError:
+        return {}
+
+def _update_hibernated(update):
+    with open(HIBERNATE_FILE, 'a+') as f:
+        # Both portals hibernate, resize and delete containers
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        hibernated = json.loads(raw) if raw.strip() else {}
+        result = update(hibernated)
+        f.seek(0)
+        f.truncate()
+        json.dump(hibernated, f)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+def forget_hibernated(username):
+    """Drops the hibernate record, e.g. when the container itself is deleted."""
+    _update_hibernated(lambda hibernated: hibernated.pop(username, None))
+
+def hibernate_container(username):
+    """Snapshots a running container and stops it to free its RAM.
+
+    Uses a CRIU checkpoint when the Docker daemon supports it (experimental mode with
+    criu installed). Otherwise records a manifest of the running services so
+    resume_container() can bring the same stack back after a plain start.
+    """
+    container_name = f"{username}_container"
+    services = get_running_services(container_name)
+
+    # Let HDFS persist its namespace before the processes are frozen or stopped
+    # (not from a client: its hdfs commands would put the shared cluster in safe mode)
+    if not is_shared_client(username):
+        subprocess.run(["docker", "exec", container_name, "bash", "-c", f"{SHORT_JVM}hdfs dfsadmin -safemode enter && hdfs dfsadmin -saveNamespace && hdfs dfsadmin -safemode leave"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    # Remove a stale checkpoint from an earlier hibernate, docker refuses to overwrite it
+    subprocess.run(["docker", "checkpoint", "rm", container_name, HIBERNATE_CHECKPOINT],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    checkpoint = subprocess.run(
+        ["docker", "checkpoint", "create", container_name, HIBERNATE_CHECKPOINT],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    )
+    if checkpoint.returncode == 0:
+        mode = 'checkpoint'
+    else:
+        print(f"CRIU checkpoint unavailable ({checkpoint.stderr.strip()}), falling back to service manifest")
+        mode = 'manifest'
+        result = subprocess.run(["docker", "stop", container_name], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            return False, f"Failed to stop container: {result.stderr.strip()}"
+
+    _update_hibernated(lambda hibernated: hibernated.update({username: {
+        'mode': mode,
+        'services': services,
+        'timestamp': time.time()
+    }}))
+    set_desired_state(username, 'stopped')
+    print(f"Hibernated {container_name} ({mode}, services: {', '.join(services) or 'none'})")
+    return True, mode
+
+def resume_container(username):
+    """Brings a hibernated container back with the same running services."""
+    from app import setup_user_disk
+    container_name = f"{username}_container"
+    hibernated = get_hibernated()
+    manifest = hibernated.get(username, {'mode': 'manifest', 'services': list(HADOOP_SERVICES)})
+
+    # The volume must be mounted before the container (and its /data bind) comes back
+    if manifest['mode'] == 'checkpoint':
+        setup_user_disk(username)
+
+    restored = False
+    if manifest['mode'] == 'checkpoint':
+        result = subprocess.run(
+            ["docker", "start", "--checkpoint", HIBERNATE_CHECKPOINT, container_name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+        restored = result.returncode == 0
+        if restored:
+            reapply_io_profile(username)
+        else:
+            print(f"Checkpoint restore failed ({result.stderr.strip()}), cold starting instead")
+
+    if not restored:
+        success, msg = fast_restart_container(username, services=manifest['services'])
+        if not success:
+            return False, msg
+
+    forget_hibernated(username)
+    # A restored or restarted container may come back with a new address
+    update_route(username)
+    set_desired_state(username, 'running')
+    return True, "Container resumed"
+
+
+def resize_container(username, cpus, ram_gb):
+    """Changes a container's CPU and RAM limits in place, e.g. down to the standard limits when a lease ends.
+
+    The daemons were sized for the old limits, so a running container is stopped, updated
+    and fast-restarted, which re-renders its config for the new limits. A checkpoint can't
+    be restored into a smaller container; a hibernated one resumes from its service
+    manifest instead.
+    """
+    container_name = f"{username}_container"
+    ram_mb = int(float(ram_gb) * 1024)
+    if is_shared_client(username):
+        # The allocation is the queue; the client container only needs its share for the CLIs
+        if not resize_tenant(username, cpus, ram_mb):
+            return False, "Queue refresh failed"
+        run_cpus, run_ram_mb = client_container_limits(cpus, ram_mb)
+        result = subprocess.run(["docker", "update", "--cpus", str(run_cpus), "--memory", f"{run_ram_mb}m",
+                                 "--memory-swap", f"{2 * run_ram_mb}m", container_name],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            return False, f"docker update failed: {result.stderr.strip()}"
+        set_cpu_grant(username, run_cpus)
+        return True, "Queue resized"
+
+    state = subprocess.run(["docker", "inspect", "-f", "{{.State.Status}}", container_name],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if state.returncode != 0:
+        return False, "Container not found"
+    running = state.stdout.strip() == 'running'
+    services = get_running_services(container_name) if running else []
+    if running:
+        subprocess.run(["docker", "stop", container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    # Swap stays at docker's default of twice the memory limit
+    result = subprocess.run(["docker", "update", "--cpus", str(float(cpus)), "--memory", f"{ram_mb}m",
+                             "--memory-swap", f"{2 * ram_mb}m", *shrink_cpuset(username, cpus), container_name],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    updated = result.returncode == 0
+    if updated:
+        set_cpu_grant(username, cpus)
+
+    def drop_checkpoint(hibernated):
+        if hibernated.get(username, {}).get('mode') != 'checkpoint':
+            return False
+        hibernated[username]['mode'] = 'manifest'
+        return True
+    if updated and _update_hibernated(drop_checkpoint):
+        subprocess.run(["docker", "checkpoint", "rm", container_name, HIBERNATE_CHECKPOINT],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    if running:
+        success, msg = fast_restart_container(username, services=services)
+        if not success:
+            return False, msg
+    if not updated:
+        return False, f"docker update failed: {result.stderr.strip()}"
+    print(f"Resized {container_name} to {cpus} CPUs / {ram_gb} GB RAM")
+    record_event('resize', username, cpu=float(cpus), ram=float(ram_gb))
+    return True, "Container resized"
+
+
+# --- Fast Restart ---
+def probe_service_ports(container_name, ports):
+    """Returns the subset of TCP ports accepting connections inside the container (one exec)."""
+    if not ports:
+        return set()
+    script = " ".join(str(p) for p in ports)
+    result = subprocess.run(
+        ["docker", "exec", container_name, "bash", "-c",
+         f"for p in {script}; do (exec 3<>/dev/tcp/127.0.0.1/$p) 2>/dev/null && echo $p; done"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    return {int(p) for p in result.stdout.split() if p.isdigit()}
+
+def get_config_profile(container_name):
+    """The ConfigProfile matching a container's current CPU and memory limits."""
+    username = container_name[:-len('_container')]
+    if is_shared_client(username):
+        # Sized from the user's allocation (their queue), not the client container's own limits
+        tenant = get_tenants()[username]
+        return client_profile(tenant['cpus'], tenant['ram_mb'])
+    result = subprocess.check_output(
+        ["docker", "inspect", "-f", "{{.HostConfig.NanoCpus}} {{.HostConfig.Memory}}", container_name],
+        stderr=subprocess.DEVNULL, text=True
+    ).split()
+    nano_cpus, memory = (int(v or 0) for v in (result + ['0', '0'])[:2])
+    # Sized for the grant, a rebalancer loan doesn't change the daemons' config
+    cpus, ram_mb = get_cpu_grants().get(username, nano_cpus / 1e9), memory // (1024 * 1024)
+    return ConfigProfile.for_limits(cpus, ram_mb, services=container_services(cpus, ram_mb))
+
+def verify_persisted_config(container_name, profile=None):
+    """Checks (and repairs) the config provision_container left in the container, in one exec."""
+    profile = profile or get_config_profile(container_name)
+    result = subprocess.run(
+        ["docker", "exec", container_name, "bash", "-c",
+         f"grep -qs {profile.digest()} $HADOOP_HOME/etc/hadoop/pdl-profile.json && echo config=ok || echo config=stale; "
+         + ("test -f /data/hdfs/namenode/current/VERSION && echo namenode=ok || echo namenode=missing"
+            if 'hdfs' in profile.services else "echo namenode=ok")],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, check=True
+    )
+    checks = dict(line.split('=', 1) for line in result.stdout.split() if '=' in line)
+
+    if checks.get('config') != 'ok':
+        # Missing, hand-edited or rendered for different limits: the bundle is authoritative
+        print(f"{container_name}: Hadoop config does not match profile {profile.digest()}, reinstalling")
+        deliver_config_bundle(container_name, profile)
+    if checks.get('namenode') != 'ok':
+        # Same first-time path as provision_container: the volume has no NameNode metadata yet
+        print(f"{container_name}: no NameNode metadata on the volume, formatting")
+        subprocess.run(["docker", "exec", container_name, "bash", "-c",
+            "mkdir -p /data/hdfs/namenode /data/hdfs/datanode && rm -rf /data/hdfs/datanode/current && "
+            "echo 'Y' | hdfs namenode -format"], check=False)
+    return checks
+
+def start_services(container_name, services):
+    """Starts the given services, independent ones in parallel and dependants once their requirements answer."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def start(name):
+        subprocess.run(["docker", "exec", container_name, "bash", "-c", HADOOP_SERVICES[name]['start']],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+
+    independent = [s for s in services if not HADOOP_SERVICES[s]['requires']]
+    dependent = [s for s in services if HADOOP_SERVICES[s]['requires']]
+    with ThreadPoolExecutor(max_workers=len(HADOOP_SERVICES)) as pool:
+        list(pool.map(start, independent))
+        for name in dependent:
+            wait_for_services(container_name, HADOOP_SERVICES[name]['requires'])
+        list(pool.map(start, dependent))
+
+def wait_for_services(container_name, services, timeout=RESTART_READY_TIMEOUT):
+    """Polls the services' ports until all answer. Returns the list of services still down."""
+    pending = {name: set(HADOOP_SERVICES[name]['ports']) for name in services}
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        open_ports = probe_service_ports(container_name, set().union(*pending.values()))
+        pending = {name: ports for name, ports in pending.items() if not ports <= open_ports}
+        if pending:
+            time.sleep(0.5)
+    return list(pending)
+
+def fast_restart_container(username, services=None):
+    """Starts a stopped user container and brings its Hadoop stack back without reprovisioning.
+
+    entrypoint.sh is told to skip its sequential daemon startup; instead the persisted
+    config is verified, independent daemons are started in parallel and readiness is
+    confirmed with port probes rather than JVM-based CLI calls.
+    """
+    from app import setup_user_disk
+    container_name = f"{username}_container"
+    started_at = time.time()
+    if is_shared_client(username):
+        # A client has no daemons of its own, but is useless without the cluster
+        try:
+            ensure_shared_cluster()
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            return False, f"Shared cluster unavailable: {e}"
+        services = []
+    else:
+        try:
+            fitted = get_config_profile(container_name).services
+        except (subprocess.CalledProcessError, ValueError) as e:
+            return False, f"Could not size the container's services: {e}"
+        # An explicit empty list means start no daemons, only None means all fitted ones
+        services = fitted if services is None else [s for s in fitted if s in services]
+
+    user_folder = setup_user_disk(username)
+    # One-shot flag read (and removed) by entrypoint.sh, the volume is /data in the container
+    skip_flag = os.path.join(user_folder, '.skip_service_start')
+    try:
+        open(skip_flag, 'w').close()
+    except OSError as e:
+        print(f"Could not write skip flag, entrypoint will start services itself: {e}")
+
+    result = subprocess.run(["docker", "start", container_name], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        # Nothing consumed the flag, a later normal start must not skip its services
+        try:
+            os.remove(skip_flag)
+        except OSError:
+            pass
+        return False, f"Failed to start container: {result.stderr.strip()}"
+    reapply_io_profile(username)
+
+    # start-dfs.sh/start-yarn.sh reach the daemons over ssh, so sshd must answer first
+    deadline = time.time() + 10
+    while 22 not in probe_service_ports(container_name, [22]) and time.time() < deadline:
+        time.sleep(0.2)
+
+    try:
+        verify_persisted_config(container_name)
+    except subprocess.CalledProcessError as e:
+        return False, f"Could not verify container configuration: {e}"
+
+    running = get_running_services(container_name)
+    to_start = [s for s in services if s not in running]
+
+    start_services(container_name, to_start)
+
+    not_ready = wait_for_services(container_name, services)
+    elapsed = time.time() - started_at
+    if not_ready:
+        return False, f"Services not ready after {elapsed:.0f}s: {', '.join(not_ready)}"
+    print(f"Restarted {container_name} in {elapsed:.1f}s ({', '.join(services)})")
+    update_route(username)
+    set_desired_state(username, 'running')
+    return True, "Container restarted"
@@ -0,0 +1,270 @@
+# YARN job metrics: polls every running ResourceManager's REST API and aggregates
+# applications, queued work and used vcores/memory per user
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_cluster import SHARED_CLUSTER_CONTAINER, container_ip, get_tenants
+from utils import get_hibernated
+
+RM_WEB_PORT = 8088
+RM_TIMEOUT = 3
+COLLECT_WORKERS = 8
+YARN_METRICS_TTL = 30
+YARN_COLLECT_INTERVAL = 60
+# Finished applications from this far back are counted in the durations
+FINISHED_WINDOW_SECONDS = 24 * 3600
+# Hourly peaks kept per user, to tell reservations that are never used
+YARN_HISTORY_FILE = 'yarn_history.json'
+HISTORY_HOURS = 7 * 24
+
+_cache_lock = threading.Lock()
+_cache = {'timestamp': 0, 'overview': None}
+# Held while polling the RMs, _cache_lock only guards the dict
+_refresh_lock = threading.Lock()
+_collector_lock = threading.Lock()
+_collector_started = False
+
+
+def resource_managers():
+    """{container name: IP} of every running container with its own ResourceManager.
+
+    Shared-cluster clients submit to the cluster's RM, which is polled once for all of them.
+    """
+    container_ids = subprocess.run(["docker", "ps", "-q"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                   text=True).stdout.split()
+    if not container_ids:
+        return {}
+    result = subprocess.run(["docker", "inspect", *container_ids], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL, text=True)
+    try:
+        details = json.loads(result.stdout or '[]')
+    except ValueError:
+        return {}
+    clients = {u for u, t in get_tenants().items() if t.get('queue_state') == 'RUNNING'}
+    hibernated = get_hibernated()
+    targets = {}
+    for d in details:
+        name = d['Name'].lstrip('/')
+        if name.endswith('_container'):
+            username = name[:-len('_container')]
+            if username in clients or username in hibernated:
+                continue
+        elif name != SHARED_CLUSTER_CONTAINER:
+            continue
+        ip = container_ip(d)
+        if ip:
+            targets[name] = ip
+    return targets
+
+
+def _get_json(ip, path):
+    with urllib.request.urlopen(f"http://{ip}:{RM_WEB_PORT}/ws/v1/cluster{path}", timeout=RM_TIMEOUT) as resp:
+        return json.load(resp)
+
+
+def poll_resource_manager(container_name, ip, now=None):
+    """Cluster metrics plus live and recently finished applications of one RM, None if it didn't answer."""
+    now = now or time.time()
+    try:
+        metrics = _get_json(ip, '/metrics')['clusterMetrics']
+        live = (_get_json(ip, '/apps?states=RUNNING,ACCEPTED').get('apps') or {}).get('app', [])
+        since = int((now - FINISHED_WINDOW_SECONDS) * 1000)
+        finished = (_get_json(ip, f'/apps?states=FINISHED,FAILED,KILLED&finishedTimeBegin={since}')
+                    .get('apps') or {}).get('app', [])
+    except Exception:
+        return None
+    return {'metrics': metrics, 'apps': live + finished}
+
+
+def _owner(container_name, app):
+    # On the shared cluster applications run as their user (and in their queue)
+    if container_name == SHARED_CLUSTER_CONTAINER:
+        return app.get('user') or app.get('queue') or 'unknown'
+    return container_name[:-len('_container')]
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def collect_yarn_overview(workers=COLLECT_WORKERS):
+    """Polls every RM (at most `workers` at a time) and aggregates per user and per application type."""
+    now = time.time()
+    targets = resource_managers()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = dict(zip(targets, pool.map(lambda item: poll_resource_manager(*item, now=now), targets.items())))
+
+    users, apps, rm_up = {}, [], {}
+
+    def user(name):
+        return users.setdefault(name, {
+            'running': 0, 'pending': 0, 'used_vcores': 0, 'used_mb': 0, 'total_vcores': None,
+            'total_mb': None, 'finished': 0, 'failed': 0, 'durations': [], 'types': {}})
+
+    for container_name, result in results.items():
+        rm_up[container_name] = result is not None
+        if result is None:
+            continue
+        if container_name != SHARED_CLUSTER_CONTAINER:
+            # A user's own RM: its capacity is their container's
+            u = user(_owner(container_name, {}))
+            u['total_vcores'] = result['metrics'].get('totalVirtualCores')
+            u['total_mb'] = result['metrics'].get('totalMB')
+        for app in result['apps']:
+            u = user(_owner(container_name, app))
+            state = app.get('state')
+            app_type = (app.get('applicationType') or 'unknown').upper()
+            u['types'][app_type] = u['types'].get(app_type, 0) + 1
+            if state == 'RUNNING':
+                u['running'] += 1
+                u['used_vcores'] += app.get('allocatedVCores', 0) or 0
+                u['used_mb'] += app.get('allocatedMB', 0) or 0
+            elif state == 'ACCEPTED':
+                u['pending'] += 1
+            else:
+                u['finished'] += 1
+                if state != 'FINISHED' or app.get('finalStatus') == 'FAILED':
+                    u['failed'] += 1
+                if app.get('elapsedTime'):
+                    u['durations'].append(app['elapsedTime'] / 1000)
+            apps.append({
+                'container': container_name,
+                'user': _owner(container_name, app),
+                'id': app.get('id'),
+                'name': app.get('name'),
+                'type': app_type,
+                'queue': app.get('queue'),
+                'state': state,
+                'progress': round(app.get('progress', 0) or 0, 1),
+                'vcores': app.get('allocatedVCores', 0) or 0,
+                'memory_mb': app.get('allocatedMB', 0) or 0,
+                'elapsed_seconds': (app.get('elapsedTime') or 0) / 1000,
+            })
+
+    for u in users.values():
+        durations = u.pop('durations')
+        u['median_seconds'] = _percentile(durations, 50)
+        u['p95_seconds'] = _percentile(durations, 95)
+        u['vcore_usage_pct'] = (round(u['used_vcores'] / u['total_vcores'] * 100, 1)
+                                if u['total_vcores'] else None)
+    apps.sort(key=lambda a: (a['state'] != 'RUNNING', a['state'] != 'ACCEPTED', -a['elapsed_seconds']))
+    return {'users': users, 'apps': apps, 'resource_managers': rm_up, 'timestamp': now}
+
+
+def get_yarn_overview(max_age=YARN_METRICS_TTL):
+    """The cached overview, re-collected at most once per max_age seconds.
+
+    One thread polls the RMs; meanwhile the others get the previous overview rather than
+    waiting, unless there is none yet or they asked for a fresh one (max_age=0).
+    """
+    with _cache_lock:
+        overview, collected_at = _cache['overview'], _cache['timestamp']
+    if overview is not None and time.time() - collected_at <= max_age:
+        return overview
+    if not _refresh_lock.acquire(blocking=overview is None or max_age == 0):
+        return overview
+    try:
+        with _cache_lock:
+            # Someone else refreshed it while we waited
+            if _cache['timestamp'] != collected_at and time.time() - _cache['timestamp'] <= max_age:
+                return _cache['overview']
+        overview = collect_yarn_overview()
+        with _cache_lock:
+            _cache['overview'], _cache['timestamp'] = overview, time.time()
+        return overview
+    finally:
+        _refresh_lock.release()
+
+
+def get_yarn_history():
+    """{username: {hour: [peak used vcores, peak used MB]}}."""
+    if not os.path.exists(YARN_HISTORY_FILE):
+        return {}
+    try:
+        with open(YARN_HISTORY_FILE, 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def record_peaks(overview):
+    """Folds the overview's usage into the hourly peaks."""
+    hour = int(overview['timestamp'] // 3600)
+    with open(YARN_HISTORY_FILE, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        raw = f.read()
+        history = json.loads(raw) if raw.strip() else {}
+        for username, u in overview['users'].items():
+            peak = history.setdefault(username, {}).setdefault(str(hour), [0, 0])
+            history[username][str(hour)] = [max(peak[0], u['used_vcores']), max(peak[1], u['used_mb'])]
+        for username in list(history):
+            history[username] = {h: v for h, v in history[username].items() if int(h) > hour - HISTORY_HOURS}
+            if not history[username]:
+                del history[username]
+        f.seek(0)
+        f.truncate()
+        json.dump(history, f)
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_weekly_peaks():
+    """{username: {'vcores', 'memory_mb'}}: the most each user's jobs held at once in the last week."""
+    return {u: {'vcores': max(v[0] for v in hours.values()), 'memory_mb': max(v[1] for v in hours.values())}
+            for u, hours in get_yarn_history().items()}
+
+
+def _collector_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            record_peaks(get_yarn_overview(max_age=interval / 2))
+        except Exception as e:
+            print(f"YARN metrics collection failed: {e}")
+
+
+def start_yarn_collector(interval=YARN_COLLECT_INTERVAL):
+    """Starts the background collection (for the weekly peaks) once per process."""
+    global _collector_started
+    with _collector_lock:
+        if _collector_started:
+            return
+        _collector_started = True
+    threading.Thread(target=_collector_loop, args=(interval,), daemon=True).start()
+
+
+def render_yarn_metrics():
+    """Per-user YARN applications and allocations in the Prometheus text format."""
+    overview = get_yarn_overview()
+    lines = ["# HELP pdl_yarn_apps YARN applications by user and state (finished: last 24h)",
+             "# TYPE pdl_yarn_apps gauge"]
+    for username, u in sorted(overview['users'].items()):
+        for state, key in (('running', 'running'), ('pending', 'pending'), ('finished', 'finished'), ('failed', 'failed')):
+            lines.append(f'pdl_yarn_apps{{user="{username}",state="{state}"}} {u[key]}')
+    for name, help_text, key in [
+        ('pdl_yarn_allocated_vcores', 'Vcores held by running YARN containers', 'used_vcores'),
+        ('pdl_yarn_allocated_mb', 'Memory held by running YARN containers in MB', 'used_mb'),
+    ]:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{user="{username}"}} {u[key]}' for username, u in sorted(overview['users'].items())]
+    lines += ["# HELP pdl_yarn_app_duration_seconds Run time of applications finished in the last 24h",
+              "# TYPE pdl_yarn_app_duration_seconds gauge"]
+    for username, u in sorted(overview['users'].items()):
+        for quantile, key in (('0.5', 'median_seconds'), ('0.95', 'p95_seconds')):
+            if u[key] is not None:
+                lines.append(f'pdl_yarn_app_duration_seconds{{user="{username}",quantile="{quantile}"}} {u[key]}')
+    lines += ["# HELP pdl_yarn_rm_up Whether the ResourceManager answered the last poll",
+              "# TYPE pdl_yarn_rm_up gauge"]
+    lines += [f'pdl_yarn_rm_up{{container="{name}"}} {int(up)}'
+              for name, up in sorted(overview['resource_managers'].items())]
+    return "\n".join(lines) + "\n"